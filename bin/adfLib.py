@@ -2,8 +2,20 @@
 import re
 import os
 import sys
+import io
+import json
 import time
+import pickle
+import hashlib
+import itertools
+import functools
+import collections
+import array
+import bisect
 import datetime
+import decimal
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import db
 
 #----------------------------------
@@ -24,15 +36,643 @@ date_re = re.compile(r'(\d\d\d\d)-(\d\d)-(\d\d) (\d\d):(\d\d):(\d\d)')
 #   getTimeStamp("2014-05-01") --> "2014-05-01T00:00:00-04:00"
 #   getTimeStamp("2023-11-15 09:21:20") --> 
 #
+# This is called for every date in every object, so once a day's UTC offset is known (see tzByDay)
+# its timestamps are converted by slicing the string. benchTimestamps.py checks that the result is
+# the same as the original conversion (parseTimeStamp).
+#
 def getTimeStamp(s = None):
     if s:
-        m = date_re.match(s)
-        d = datetime.datetime(int(m.group(1)), int(m.group(2)), int(m.group(3)),  int(m.group(4)), int(m.group(5)), int(m.group(6)))
-        return rfc3339(d)
+        if s[10:11] == 'T': # already formatted, see SERVER_TIMESTAMPS
+            return s
+        tz = tzByDay.get(s[:10]) if len(s) >= 19 else None
+        if tz and s[10] == ' ' and isTimeOfDay(s[11:19]):
+            return s[:10] + 'T' + s[11:19] + tz
+        return parseTimeStamp(s)
     else:
         return rfc3339(time.time())
+
+# The original conversion, via datetime and rfc3339. getTimeStamp falls back to this for
+# days not yet in tzByDay, days with a DST change, and anything that doesn't look like a timestamp.
+def parseTimeStamp (s) :
+    m = date_re.match(s)
+    d = datetime.datetime(int(m.group(1)), int(m.group(2)), int(m.group(3)),  int(m.group(4)), int(m.group(5)), int(m.group(6)))
+    cacheDayTimeZone(m.group(0)[:10], d)
+    return rfc3339(d)
+
+# Converts a whole column of db date-time strings at once. Empty values (NULLs) stay None.
+# Each distinct value is converted only once.
+def getTimeStamps (values) :
+    memo = {}
+    rval = []
+    for s in values:
+        if not s:
+            rval.append(None)
+            continue
+        t = memo.get(s)
+        if t is None:
+            t = memo[s] = getTimeStamp(s)
+        rval.append(t)
+    return rval
+
+# UTC offset ("-05:00") of each day seen so far, by day ("yyyy-mm-dd"). rfc3339 asks the system
+# time zone for the offset of every timestamp, which is slow and, except on the days DST starts or
+# ends, gives the same answer all day. A day is cached once it's known to have one offset from the end
+# of the day before to its own end; days with a change map to None and keep going through rfc3339.
+tzByDay = {}
+def cacheDayTimeZone (day, d) :
+    if day in tzByDay:
+        return
+    start = d.replace(hour=0, minute=0, second=0)
+    try:
+        offsets = set([rfc3339(t)[19:] for t in (start - datetime.timedelta(seconds=1), start, d.replace(hour=23, minute=59, second=59))])
+    except OverflowError: # 0001-01-01
+        offsets = set()
+    tzByDay[day] = offsets.pop() if len(offsets) == 1 else None
+
+# True if t is a valid "hh:mm:ss" time of day, as date_re and datetime would accept it.
+def isTimeOfDay (t) :
+    return t.isascii() and t[2] == ':' and t[5] == ':' and t[0:2].isdigit() and t[3:5].isdigit() and t[6:8].isdigit() \
+        and t[0:2] < '24' and t[3] < '6' and t[6] < '6'
 #-----------------------------------
 
+# Lookup tables shared between generators.
+# When several parts are generated in one process (see pipeline.py), a loader decorated with @shared
+# runs only once and every part reuses its result. Loaders must take no arguments.
+# The cached values are keyed by "module.function" so they can be inspected (or seeded) by the pipeline.
+sharedState = {}
+def shared (loader) :
+    key = loader.__module__ + '.' + loader.__name__
+    def wrapper () :
+        if key not in sharedState:
+            sharedState[key] = loader()
+        return sharedState[key]
+    wrapper.key = key
+    wrapper.__name__ = loader.__name__
+    return wrapper
+
+#----------------------------------
+# Database access.
+#
+# Generators run their queries with sql() rather than calling db.sql directly. Normally sql() just
+# hands the query to db.sql. Once a snapshot has been exported (see exportSnapshot), queries instead run
+# on a connection of our own, inside a read-only repeatable read transaction that has imported that
+# snapshot. Every generator, in every worker process, then sees the same state of the database no
+# matter when it runs.
+#
+# The snapshot id reaches worker processes (and any scripts they start) through the environment.
+SNAPSHOT_VAR = 'ADF_SNAPSHOT'
+
+# A result row from our own connection. Like the rows returned by db.sql, column names are case insensitive
+# (queries alias columns as e.g. "alleleId", which postgres returns as "alleleid"), and has_key is supported.
+class Row (dict) :
+    def __getitem__ (self, k) :
+        return dict.__getitem__(self, k.lower())
+    def __setitem__ (self, k, v) :
+        dict.__setitem__(self, k.lower(), v)
+    def __contains__ (self, k) :
+        return dict.__contains__(self, k.lower())
+    def get (self, k, default=None) :
+        return dict.get(self, k.lower(), default)
+    def has_key (self, k) :
+        return dict.__contains__(self, k.lower())
+
+# Date and time columns are returned as strings, as db.sql does (see getTimeStamp).
+DATETIME_OIDS = (1082, 1083, 1114, 1184, 1266) # date, time, timestamp, timestamptz, timetz
+
+# Opens a new connection to the database named by PG_DBSERVER, PG_DBNAME and PG_DBUSER.
+def openConnection () :
+    import psycopg2
+    import psycopg2.extensions
+    password = None
+    pwfile = os.environ.get('PG_1LINE_PASSFILE')
+    if pwfile:
+        with open(pwfile) as fd:
+            password = fd.read().strip()
+    # A connection with a cache of its prepared statements (see execute).
+    class Connection (psycopg2.extensions.connection) :
+        def __init__ (self, *args, **kwargs) :
+            super().__init__(*args, **kwargs)
+            self.statements = StatementCache()
+    conn = psycopg2.connect(
+        host = os.environ.get('PG_DBSERVER'),
+        dbname = os.environ.get('PG_DBNAME'),
+        user = os.environ.get('PG_DBUSER'),
+        password = password,
+        options = ('-c timezone=' + SERVER_TIME_ZONE) if SERVER_TIMESTAMPS else None,
+        connection_factory = Connection)
+    asText = psycopg2.extensions.new_type(DATETIME_OIDS, 'DATETIME_AS_TEXT', lambda v, cur: v)
+    psycopg2.extensions.register_type(asText, conn)
+    return conn
+
+# Starts a repeatable read transaction, exports its snapshot, and returns the snapshot id.
+# The exporting connection must stay open (it does, until releaseSnapshot) for others to attach.
+snapshotConnection = None
+def exportSnapshot () :
+    global snapshotConnection, connection
+    # A connection opened before the snapshot doesn't see it: this process's is closed, and the next
+    # query opens one that does.
+    if connection is not None and connectionPid == os.getpid():
+        connection.close()
+        connection = None
+    snapshotConnection = openConnection()
+    snapshotConnection.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    cur = snapshotConnection.cursor()
+    cur.execute('SELECT pg_export_snapshot()')
+    sid = cur.fetchone()[0]
+    os.environ[SNAPSHOT_VAR] = sid
+    log("Exported database snapshot " + sid)
+    return sid
+
+def releaseSnapshot () :
+    global snapshotConnection
+    os.environ.pop(SNAPSHOT_VAR, None)
+    closePooledConnections()
+    if snapshotConnection:
+        snapshotConnection.rollback()
+        snapshotConnection.close()
+        snapshotConnection = None
+
+# Opens a new connection, attached to the exported snapshot (if any).
+def openSnapshotConnection () :
+    conn = openConnection()
+    sid = os.environ.get(SNAPSHOT_VAR)
+    if sid:
+        conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        conn.cursor().execute('SET TRANSACTION SNAPSHOT %s', (sid,))
+    return conn
+
+# Returns this process's connection, attached to the exported snapshot.
+# A connection inherited across a fork belongs to the parent; it is set aside (never used or closed,
+# since closing it would end the parent's session) and a new one is opened.
+# A thread running a prefetch loader (see prefetch) gets a connection of its own instead, from the pool.
+connection = None
+connectionPid = None
+inheritedConnections = []
+threadConnection = threading.local()
+def getConnection () :
+    global connection, connectionPid
+    if getattr(threadConnection, 'own', False):
+        if threadConnection.connection is None:
+            threadConnection.connection = takePooledConnection()
+        return threadConnection.connection
+    if connection is not None and connectionPid != os.getpid():
+        inheritedConnections.append(connection)
+        connection = None
+    if connection is None:
+        connection = openSnapshotConnection()
+        connectionPid = os.getpid()
+    return connection
+
+# Connections for prefetch threads, kept for reuse as (pid, snapshot id, connection), at most
+# PREFETCH_CONNECTIONS of them. A pooled connection stays in its transaction, attached to the snapshot, so
+# it is reused only while that snapshot is current; releaseSnapshot closes them.
+connectionPool = []
+connectionPoolLock = threading.Lock()
+def takePooledConnection () :
+    pid = os.getpid()
+    sid = os.environ.get(SNAPSHOT_VAR)
+    with connectionPoolLock:
+        while connectionPool:
+            p, s, conn = connectionPool.pop()
+            if p != pid:
+                inheritedConnections.append(conn)
+            elif s != sid:
+                conn.close()
+            else:
+                return conn
+    return openSnapshotConnection()
+
+def returnPooledConnection (conn) :
+    with connectionPoolLock:
+        if len(connectionPool) < PREFETCH_CONNECTIONS:
+            connectionPool.append((os.getpid(), os.environ.get(SNAPSHOT_VAR), conn))
+            return
+    conn.close()
+
+def closePooledConnections () :
+    with connectionPoolLock:
+        for (p, s, conn) in connectionPool:
+            if p == os.getpid():
+                conn.close()
+        del connectionPool[:]
+
+#----------------------------------
+# Prepared statements.
+#
+# A parameterized query (sql() with args) that runs a second time on the same connection is prepared
+# (PREPARE) on that connection, and from then on executed by name (EXECUTE), so that the database parses and
+# plans it only once. This helps the queries run over and over with different values: resolveRefIds' chunks
+# of ref keys, key restricted queries in delta mode (see sqlForKeys), templates run for several keys (e.g.
+# constructs.loadRelationship). Each connection keeps up to STATEMENT_CACHE_SIZE prepared statements, the
+# most recently used ones. PREPARE_THRESHOLD is the run at which a query is prepared (0: never).
+#
+# Only psycopg2 style positional parameters (%s, with %% for a literal %) are supported; a query using
+# others (%(name)s) is always executed as usual. Streamed queries (streamSql) are not prepared: they run as
+# server side cursors, which can't execute a prepared statement.
+PREPARE_THRESHOLD = int(os.environ.get('PREPARE_THRESHOLD', '2'))
+STATEMENT_CACHE_SIZE = int(os.environ.get('STATEMENT_CACHE_SIZE', '100'))
+statementStats = { "executed": 0, "prepared": 0, "deallocated": 0 }
+statementCounter = itertools.count()
+
+# The prepared statements of a connection, by query: (name, number of parameters), or the number of runs
+# so far of a query not yet prepared (None for a query that can't be).
+class StatementCache :
+    def __init__ (self) :
+        self.prepared = collections.OrderedDict()
+        self.runs = {}
+
+# Returns the query with psycopg2's positional parameters replaced by postgres's ($1, $2, ...), and the
+# number of parameters, or None if the query has other kinds of parameters.
+placeholder_re = re.compile(r'%(.)', re.DOTALL)
+def numberParameters (q) :
+    n = 0
+    def number (m) :
+        nonlocal n
+        c = m.group(1)
+        if c == '%':
+            return '%'
+        if c == 's':
+            n += 1
+            return '$%d' % n
+        raise ValueError(m.group(0))
+    try:
+        return placeholder_re.sub(number, q), n
+    except ValueError:
+        return None
+
+# Executes a parameterized query on a cursor of conn, preparing it on its second run (see above).
+def execute (conn, cur, q, args) :
+    cache = getattr(conn, 'statements', None)
+    if cache is None or PREPARE_THRESHOLD <= 0:
+        cur.execute(q, args)
+        return
+    p = cache.prepared.get(q)
+    if p is None:
+        runs = cache.runs.get(q, 0)
+        if runs is not None:
+            runs += 1
+            cache.runs[q] = runs
+        if runs is None or runs < PREPARE_THRESHOLD:
+            cur.execute(q, args)
+            return
+        numbered = numberParameters(q)
+        if numbered is None or numbered[1] != len(args):
+            cache.runs[q] = None
+            cur.execute(q, args)
+            return
+        p = ('adf_stmt_%d' % next(statementCounter), numbered[1])
+        cur.execute('PREPARE %s AS %s' % (p[0], numbered[0]))
+        del cache.runs[q]
+        cache.prepared[q] = p
+        statementStats["prepared"] += 1
+        while len(cache.prepared) > STATEMENT_CACHE_SIZE:
+            old, (name, n) = cache.prepared.popitem(last=False)
+            cur.execute('DEALLOCATE %s' % name)
+            statementStats["deallocated"] += 1
+    else:
+        cache.prepared.move_to_end(q)
+    cur.execute('EXECUTE %s (%s)' % (p[0], ', '.join(['%s'] * p[1])) if p[1] else 'EXECUTE %s' % p[0], args)
+    statementStats["executed"] += 1
+
+# Returns a one line summary of statementStats, for logging.
+def formatStatementStats () :
+    return "Prepared statements: %(prepared)d prepared, %(executed)d executions, %(deallocated)d deallocated" % statementStats
+
+# Runs a query and returns the list of result rows.
+# If the query cache is enabled (see below), results are taken from / saved to the cache,
+# unless cache is false.
+# If args is given, the query is parameterized (psycopg2 style, e.g. "WHERE _refs_key = ANY(%s)", with args
+# a tuple of values). Such queries always run on our own connection, are never cached, and are prepared if
+# run repeatedly (see execute).
+def sql (q, parser='auto', cache=True, args=None) :
+    if args is None:
+        q = withServerTimeStamps(q)
+        if cache and QUERY_CACHE_DIR:
+            return cachedSql(q, parser)
+        if not os.environ.get(SNAPSHOT_VAR) and not SERVER_TIMESTAMPS:
+            return db.sql(q, parser)
+    conn = getConnection()
+    cur = conn.cursor()
+    if args is None:
+        cur.execute(q)
+    else:
+        execute(conn, cur, q, args)
+    cols = [c[0].lower() for c in cur.description]
+    rows = [Row(zip(cols, r)) for r in cur.fetchall()]
+    cur.close()
+    return rows
+
+# Runs a query and yields its result rows one at a time, without ever holding the whole result.
+# Uses a named (server side) cursor on this process's connection, fetching fetchSize rows per round trip
+# (default: STREAM_FETCH_SIZE). Closing the generator early (see mainQuery) closes the cursor, so the
+# rest of the result is never fetched. Streamed queries bypass the query cache.
+STREAM_FETCH_SIZE = int(os.environ.get('STREAM_FETCH_SIZE', '5000'))
+streamCounter = itertools.count()
+def streamSql (q, fetchSize=None) :
+    q = withServerTimeStamps(q)
+    cur = getConnection().cursor(name='adf_stream_%d_%d' % (os.getpid(), next(streamCounter)))
+    cur.itersize = fetchSize if fetchSize else STREAM_FETCH_SIZE
+    try:
+        cur.execute(q)
+        cols = None
+        for r in cur:
+            if cols is None:
+                cols = [c[0].lower() for c in cur.description]
+            yield Row(zip(cols, r))
+    finally:
+        cur.close()
+
+# Runs a query using COPY ... TO STDOUT, and returns the result rows.
+# For big lookup queries this costs much less Python time than fetching through a cursor: the result
+# arrives as tab separated text that is split here. Column types come from running the query
+# with LIMIT 0 first, and the values are converted as sql() would return them on our own connection:
+# integers, booleans, floats and numerics (as Decimal) to their Python types, text as it is, and dates as
+# strings (see DATETIME_OIDS). NULLs become None. A column of any other type raises RuntimeError.
+# Any indexResults call site can opt in by passing copySql(q) instead of sql(q).
+INT_OIDS = (20, 21, 23, 26) # int8, int2, int4, oid
+TEXT_OIDS = (18, 19, 25, 1042, 1043) # char, name, text, bpchar, varchar
+COPY_CONVERTERS = dict(
+    [(oid, int) for oid in INT_OIDS] +
+    [(oid, None) for oid in TEXT_OIDS + DATETIME_OIDS] + [
+    (16, lambda v: v == 't'), # bool
+    (700, float), # float4
+    (701, float), # float8
+    (1700, decimal.Decimal), # numeric
+])
+def copySql (q) :
+    cols, columns = copyColumns(q)
+    return [Row(zip(cols, t)) for t in zip(*columns)]
+
+# Like copySql, but returns the result by column: a list of column names and a list of column value lists.
+def copyColumns (q) :
+    q = withServerTimeStamps(q)
+    cur = getConnection().cursor()
+    cur.execute('SELECT * FROM (%s) _q LIMIT 0' % q)
+    cols = [c[0].lower() for c in cur.description]
+    for c in cur.description:
+        if c[1] not in COPY_CONVERTERS:
+            cur.close()
+            raise RuntimeError("copySql can't convert column %s (type oid %d); use sql() for this query." % (c[0], c[1]))
+    sink = CopyColumnsSink([COPY_CONVERTERS[c[1]] for c in cur.description])
+    cur.copy_expert('COPY (%s) TO STDOUT' % q, sink)
+    cur.close()
+    sink.finish()
+    return cols, sink.columns
+
+# The file COPY ... TO STDOUT writes to, for copyColumns. psycopg2 writes it a row at a time; the rows
+# are gathered into blocks of about COPY_BLOCK_SIZE characters, and each block is parsed into the column
+# value lists as it fills (keeping back an incomplete last line, if any, for the next one). So the result
+# is held once, as values, rather than also as one block of text and a list of its lines.
+# (A text file, so psycopg2 decodes the rows in the connection's encoding.)
+COPY_BLOCK_SIZE = 1 << 20
+class CopyColumnsSink (io.TextIOBase) :
+    # converters: for each column, the function converting its values from text, or None for text
+    def __init__ (self, converters) :
+        self.converters = converters
+        self.columns = [[] for c in converters]
+        self.chunks = []
+        self.size = 0
+
+    def write (self, data) :
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.size >= COPY_BLOCK_SIZE:
+            self.parse()
+        return len(data)
+
+    def parse (self) :
+        lines = ''.join(self.chunks).split('\n')
+        rest = lines.pop() # '' after a complete line
+        self.chunks = [rest] if rest else []
+        self.size = len(rest)
+        converters = self.converters
+        columns = self.columns
+        for line in lines:
+            for i, v in enumerate(line.split('\t')):
+                if v == '\\N':
+                    v = None
+                elif converters[i]:
+                    v = converters[i](v)
+                elif '\\' in v:
+                    v = decodeCopyText(v)
+                columns[i].append(v)
+
+    # Parses what's left, once COPY is done.
+    def finish (self) :
+        self.parse()
+        if self.chunks:
+            raise RuntimeError("COPY output ends inside a row: %r" % self.chunks[0][:100])
+
+# Undoes the backslash escapes of the COPY text format.
+COPY_ESCAPES = { 'b':'\b', 'f':'\f', 'n':'\n', 'r':'\r', 't':'\t', 'v':'\v', '\\':'\\' }
+copyEscape_re = re.compile(r'\\(x[0-9a-fA-F]{1,2}|[0-7]{1,3}|.)')
+def decodeCopyText (v) :
+    def decode (m) :
+        e = m.group(1)
+        if e[0] == 'x' and len(e) > 1:
+            return chr(int(e[1:], 16))
+        if e[0] in '01234567':
+            return chr(int(e, 8))
+        return COPY_ESCAPES.get(e, e)
+    return copyEscape_re.sub(decode, v)
+
+#----------------------------------
+# Concurrent loading.
+#
+# Before its main loop, a generator loads its lookups (xrefs, synonyms, notes, ...), one query after
+# another, each mostly waiting on the database. prefetch runs them all at once instead, each in a thread with
+# a connection of its own, at most PREFETCH_CONNECTIONS at a time, and returns once they are all loaded.
+# The connections are kept in a pool (see takePooledConnection) for the next prefetch to reuse.
+# The loaders must be independent of each other. Each one's time is logged, and at the end, the total and
+# the slowest one (the critical path: no prefetch can take less).
+#
+# All the connections must see the same state of the database, so loaders run concurrently only once a
+# snapshot has been exported (see exportSnapshot). Otherwise, or with PREFETCH_CONNECTIONS=1, they run one
+# after another, on the usual connection.
+#
+PREFETCH_CONNECTIONS = int(os.environ.get('PREFETCH_CONNECTIONS', '4'))
+
+# Runs a loader in a prefetch thread, on a connection of its own, taken from the pool (see
+# takePooledConnection) and returned to it afterwards, unless the loader failed.
+# Returns its result and how long it took.
+def runLoader (f, args) :
+    threadConnection.own = True
+    threadConnection.connection = None
+    t0 = time.time()
+    ok = False
+    try:
+        result = f(*args)
+        ok = True
+        return result, time.time() - t0
+    finally:
+        conn = threadConnection.connection
+        threadConnection.own = False
+        threadConnection.connection = None
+        if conn is not None:
+            if ok:
+                returnPooledConnection(conn)
+            else:
+                conn.close()
+
+# Returns a loader's name, for logging: the function's name, with its string arguments (if any).
+def getLoaderName (f, args) :
+    names = [a for a in args if isinstance(a, str)]
+    return '%s(%s)' % (f.__name__, ', '.join(names)) if names else f.__name__
+
+# Runs the given loaders, each a tuple (function, arg, ...), and returns the list of their results, in order.
+#   prefetch((getXrefs, keys), (getGeneNotes, keys), (getPantherIDs,))
+def prefetch (*loaders) :
+    t0 = time.time()
+    if PREFETCH_CONNECTIONS <= 1 or not os.environ.get(SNAPSHOT_VAR):
+        return [l[0](*l[1:]) for l in loaders]
+    with ThreadPoolExecutor(min(PREFETCH_CONNECTIONS, len(loaders))) as pool:
+        futures = [pool.submit(runLoader, l[0], l[1:]) for l in loaders]
+        results = []
+        times = []
+        for (l, f) in zip(loaders, futures):
+            result, t = f.result()
+            results.append(result)
+            times.append((t, getLoaderName(l[0], l[1:])))
+            log("Loaded %s in %.2f seconds" % (times[-1][1], t))
+    slowest = max(times)
+    log("Prefetched %d lookups in %.2f seconds, with %d connections (%.2f seconds one after another); slowest: %s, %.2f seconds" %
+        (len(loaders), time.time() - t0, min(PREFETCH_CONNECTIONS, len(loaders)), sum([t for (t, n) in times]), slowest[1], slowest[0]))
+    return results
+
+#----------------------------------
+# Key restricted queries.
+#
+# In delta mode (see delta.py) a generator builds only the objects whose data have changed since the last
+# run, so it loads only the rows for those objects. Its loaders pass the keys to sqlForKeys (or
+# streamSqlForKeys), which wrap the query in one that keeps the rows whose key column is in the list.
+# Postgres applies the condition inside the wrapped query, so only those rows are read.
+# With keys None, the query runs as usual (with sql, copySql or streamSql), unrestricted.
+#
+def restrictQuery (q, col) :
+    return 'SELECT * FROM (%s) _r WHERE _r.%s = ANY(%%s)' % (withServerTimeStamps(q).replace('%', '%%'), col)
+
+def sqlForKeys (q, col, keys, copy=False) :
+    if keys is None:
+        return copySql(q) if copy else sql(q)
+    return sql(restrictQuery(q, col), args=(list(keys),))
+
+def streamSqlForKeys (q, col, keys) :
+    if keys is None:
+        return streamSql(q)
+    return iter(sqlForKeys(q, col, keys))
+
+#----------------------------------
+# Key ordered queries.
+#
+# A generator's main query, ordered by its key column (then by the columns in order, if the key is not
+# unique), and optionally restricted to a range of keys (lo, hi), inclusive. A generator run with
+# several workers (see partition.py) splits its main query into consecutive key ranges, so the ranges,
+# concatenated, give exactly the rows of the whole ordered query, in the same order.
+#
+def orderedQuery (q, col, keyRange=None, order=None) :
+    cond = (' WHERE _o.%s BETWEEN %d AND %d' % (col, keyRange[0], keyRange[1])) if keyRange else ''
+    cols = ', '.join(['_o.' + c for c in [col] + (order or [])])
+    return 'SELECT * FROM (%s) _o%s ORDER BY %s' % (withServerTimeStamps(q), cond, cols)
+
+#----------------------------------
+# Server side timestamps.
+#
+# If SERVER_TIMESTAMPS is set, creation_date and modification_date come back from every query already in
+# RFC 3339 format (as getTimeStamp would make them), formatted by the database rather than in Python.
+# getTimeStamp passes such values through. Each query is wrapped in one that selects the same columns,
+# with to_char applied to those two; the column list comes from running the query with LIMIT 0 once.
+# Queries that return two columns with the same name are left alone (they can't be wrapped).
+# Our connections set their time zone to SERVER_TIME_ZONE so that to_char gives that zone's offset, and
+# sql() always uses our own connection in this mode. The database and rfc3339 may assign a different
+# offset to a time in the hour that is repeated when DST ends.
+SERVER_TIMESTAMPS = os.environ.get('SERVER_TIMESTAMPS', '') not in ('', '0', 'false')
+SERVER_TIME_ZONE = os.environ.get('SERVER_TIME_ZONE', 'America/New_York')
+TIMESTAMP_COLUMNS = ('creation_date', 'modification_date')
+TIMESTAMP_OIDS = (1082, 1114, 1184) # date, timestamp, timestamptz
+serverTimeStampQueries = {} # query -> wrapped query
+def withServerTimeStamps (q) :
+    if not SERVER_TIMESTAMPS:
+        return q
+    if q not in serverTimeStampQueries:
+        cur = getConnection().cursor()
+        cur.execute('SELECT * FROM (%s) _q LIMIT 0' % q)
+        desc = [(c[0], c[1]) for c in cur.description]
+        cur.close()
+        names = [n for (n, oid) in desc]
+        isTimeStamp = [n.lower() in TIMESTAMP_COLUMNS and oid in TIMESTAMP_OIDS for (n, oid) in desc]
+        if len(set(names)) < len(names) or not any(isTimeStamp):
+            serverTimeStampQueries[q] = q
+        else:
+            cols = []
+            for (n, oid), ts in zip(desc, isTimeStamp):
+                if ts:
+                    cols.append('''to_char(_q."%s"::timestamp AT TIME ZONE '%s', 'YYYY-MM-DD"T"HH24:MI:SSTZH:TZM') AS "%s"''' % (n, SERVER_TIME_ZONE, n))
+                else:
+                    cols.append('_q."%s"' % n)
+            serverTimeStampQueries[q] = 'SELECT %s FROM (%s) _q' % (', '.join(cols), q)
+    return serverTimeStampQueries[q]
+
+#----------------------------------
+# Query result cache.
+#
+# If QUERY_CACHE_DIR is set, sql() keeps query results on disk, keyed by a hash of the query text
+# (with whitespace normalized) plus the database release version (see getReleaseVersion). So results
+# are reused by every run until the next database dump, e.g. when re-running after a failed upload.
+# Each entry is a pickled list of column names followed by a list of row tuples.
+# When the cache grows past QUERY_CACHE_MB megabytes, the least recently used entries are removed.
+QUERY_CACHE_DIR = os.environ.get('QUERY_CACHE_DIR', '')
+QUERY_CACHE_MB = int(os.environ.get('QUERY_CACHE_MB', '2000'))
+queryCacheStats = { "hits" : 0, "misses" : 0 }
+
+# Returns the cache file for a query.
+def getQueryCacheFile (q) :
+    key = getReleaseVersion() + '\n' + ' '.join(q.split())
+    return os.path.join(QUERY_CACHE_DIR, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.pickle')
+
+def cachedSql (q, parser='auto') :
+    fname = getQueryCacheFile(q)
+    try:
+        with open(fname, 'rb') as fd:
+            cols = pickle.load(fd)
+            tuples = pickle.load(fd)
+        os.utime(fname) # marks it as recently used
+        queryCacheStats["hits"] += 1
+        return [Row(zip(cols, t)) for t in tuples]
+    except FileNotFoundError:
+        pass
+    queryCacheStats["misses"] += 1
+    rows = sql(q, parser, cache=False)
+    cols = [c.lower() for c in rows[0].keys()] if rows else []
+    tuples = [tuple(r.values()) for r in rows]
+    # Write to a temp file and rename, so that concurrent readers never see a partial entry.
+    os.makedirs(QUERY_CACHE_DIR, exist_ok=True)
+    tmp = '%s.%d.%d.tmp' % (fname, os.getpid(), threading.get_ident())
+    with open(tmp, 'wb') as fd:
+        pickle.dump(cols, fd, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(tuples, fd, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, fname)
+    trimQueryCache()
+    return rows
+
+# Removes least recently used entries until the cache is no bigger than QUERY_CACHE_MB.
+def trimQueryCache () :
+    entries = []
+    for e in os.scandir(QUERY_CACHE_DIR):
+        if e.name.endswith('.pickle'):
+            st = e.stat()
+            entries.append((st.st_mtime, st.st_size, e.path))
+    total = sum([e[1] for e in entries])
+    limit = QUERY_CACHE_MB * 1024 * 1024
+    entries.sort()
+    for (mtime, size, path) in entries:
+        if total <= limit:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
 #
 def log (msg, addTimestamp=True, lineTerminator="\n") :
     if addTimestamp:
@@ -46,21 +686,312 @@ def log (msg, addTimestamp=True, lineTerminator="\n") :
 # (Added in curation_schema v1.11.0)
 # Concatendates public_version and lastdump_date from mgi_dbinfo.
 #
+@shared
 def getReleaseVersion () :
-    dbi = db.sql('select * from mgi_dbinfo')[0]
+    dbi = sql('select * from mgi_dbinfo', cache=False)[0]
     return '%s %s' % (dbi['public_version'],dbi['lastdump_date'])
+
+# Returns the header attributes of a submission file, as a dict.
+def getHeader () :
+    return {
+        "linkml_version" : os.environ.get('AGR_CURATION_SCHEMA_VERSION','default'),
+        "alliance_member_release_version" : getReleaseVersion(),
+    }
+
+# Formats header attributes as the opening lines of a submission file.
+def formatHeaderAttributes (header) :
+    linkml_version = f'''"linkml_version": "{header['linkml_version']}",'''
+    release_version = f'''"alliance_member_release_version" : "{header['alliance_member_release_version']}",'''
+    return '%s\n%s\n' % (linkml_version, release_version)
+
 #
 def getHeaderAttributes () :
-    linkml_version = f'''"linkml_version": "{os.environ.get('AGR_CURATION_SCHEMA_VERSION','default')}",'''
-    release_version = f'''"alliance_member_release_version" : "{getReleaseVersion()}",'''
-    return '%s\n%s\n' % (linkml_version, release_version)
+    return formatHeaderAttributes(getHeader())
+
+
+#----------------------------------
+# Output.
+#
+# Every generator writes its file with emit(): an object holding the header attributes and one or more
+# named ingest sets, each an array of DTOs. DTOs are encoded one at a time and collected in a large
+# buffer that is written to the sink in big chunks.
+#
+WRITE_BUFFER_SIZE = 1 << 20
+
+# Returns the SHA-256 hex digest of a file's contents, read in WRITE_BUFFER_SIZE blocks.
+def getFileHash (fname) :
+    h = hashlib.sha256()
+    with open(fname, 'rb') as fd:
+        for block in iter(lambda: fd.read(WRITE_BUFFER_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+# Opens an output sink, choosing the kind by the file name:
+#   None or '-'     stdout
+#   *.gz            gzip compressed file
+#   *.zst           zstandard compressed file (requires the zstandard package)
+#   otherwise       plain file
+def openSink (fname=None) :
+    if fname is None or fname == '-':
+        return sys.stdout
+    if fname.endswith('.gz'):
+        import gzip
+        return gzip.open(fname, 'wt', encoding='utf-8')
+    if fname.endswith('.zst'):
+        import zstandard
+        return zstandard.open(fname, 'wt', encoding='utf-8')
+    return open(fname, 'w', buffering=WRITE_BUFFER_SIZE)
+
+# A sink that copies everything written to it to several other sinks,
+# e.g., a file plus the stdin of a validator process.
+class TeeSink :
+    def __init__ (self, *sinks) :
+        self.sinks = sinks
+    def write (self, s) :
+        for sk in self.sinks:
+            sk.write(s)
+    def flush (self) :
+        for sk in self.sinks:
+            sk.flush()
+    def close (self) :
+        for sk in self.sinks:
+            if sk is not sys.stdout:
+                sk.close()
+    def __enter__ (self) :
+        return self
+    def __exit__ (self, *args) :
+        self.close()
+
+# Output formats. The format can be chosen for a run by setting OUTPUT_FORMAT.
+#   (unset)     each generator's own choice of indentation
+#   pretty      indented by 2
+#   default     json.dumps defaults (one DTO per line, with a space after separators)
+#   compact     one DTO per line with minimal separators
+#   ndjson      like compact, but without the enclosing submission object, i.e., just one DTO per line.
+#               The header attributes and the name and size of each ingest set go into a sidecar
+#               file (see getNdjsonHeaderFile). Use ndjson2json.py to get back a submission file.
+OUTPUT_FORMATS = ['pretty', 'default', 'compact', 'ndjson']
+OUTPUT_FORMAT = os.environ.get('OUTPUT_FORMAT', '')
+
+# Returns the name of the header sidecar file for an NDJSON file.
+#   getNdjsonHeaderFile("MGI_ps_gene.ndjson") --> "MGI_ps_gene.header.json"
+#   getNdjsonHeaderFile("MGI_ps_gene.ndjson.gz") --> "MGI_ps_gene.header.json"
+def getNdjsonHeaderFile (fname) :
+    for ext in ['.gz', '.zst', '.ndjson']:
+        if fname.endswith(ext):
+            fname = fname[:-len(ext)]
+    return fname + '.header.json'
+
+# Returns the function used to encode each DTO in the given format.
+def getEncoder (fmt, indent=None) :
+    if fmt in ['compact', 'ndjson']:
+        return fragmentEncoder(json.JSONEncoder(separators=(',', ':')))
+    elif fmt == 'pretty':
+        return fragmentEncoder(json.JSONEncoder(indent=2))
+    elif fmt == 'default':
+        return fragmentEncoder(json.JSONEncoder())
+    elif not fmt:
+        return fragmentEncoder(json.JSONEncoder(indent=indent))
+    raise RuntimeError("Unknown output format: " + fmt)
+
+# A DTO fragment that appears in many objects, e.g. a data provider DTO (see "DTO fragments" below).
+# It's an ordinary dict, so anything that looks at DTOs sees no difference. But it remembers its encoding
+# in each format, and emit() splices that text into the DTOs containing it rather than encoding it again.
+# Fragments are shared (by the lru_caches below, and by every DTO holding one) and remember their text, so
+# they refuse to be modified; copy one with dict() to change it.
+class Fragment (dict) :
+    def readOnly (self, *args, **kwargs) :
+        raise RuntimeError("DTO fragments are shared and can't be modified; copy it with dict() first.")
+    __setitem__ = __delitem__ = __ior__ = readOnly
+    update = pop = popitem = setdefault = clear = readOnly
+    def __reduce__ (self) :
+        return (Fragment, (dict(self),))
+    def getJson (self, encoder) :
+        key = (encoder.item_separator, encoder.key_separator, encoder.indent)
+        texts = self.__dict__
+        if key not in texts:
+            texts[key] = encoder.encode(self)
+        return texts[key]
+
+# Wraps a JSON encoder so that Fragments in a DTO are spliced in as already encoded text.
+# Only the DTO attributes in FRAGMENT_KEYS are looked at (checking every value costs more than encoding it).
+# Each fragment there, alone or in a list, is replaced in a copy of the DTO by a placeholder string
+# (a NUL and a random token, which no real value will match) and the text of the fragment is put where the
+# encoder wrote the placeholder. With indentation, the fragment's lines are shifted to the indent of the
+# placeholder's line. The result is identical to encoding the DTO directly.
+FRAGMENT_KEYS = ['data_provider_dto', 'cross_reference_dtos']
+FRAGMENT_TOKEN = os.urandom(6).hex()
+FRAGMENT_MARK = '\x00' + FRAGMENT_TOKEN + '.%d'
+def fragmentEncoder (encoder) :
+    plain = encoder.encode
+    def encode (o) :
+        if type(o) is not dict:
+            return plain(o)
+        frags = []
+        copy = None
+        for k in FRAGMENT_KEYS:
+            v = o.get(k)
+            if type(v) is Fragment:
+                copy = copy or dict(o)
+                copy[k] = FRAGMENT_MARK % len(frags)
+                frags.append(v)
+            elif type(v) is list:
+                l = []
+                for x in v:
+                    if type(x) is Fragment:
+                        l.append(FRAGMENT_MARK % len(frags))
+                        frags.append(x)
+                    else:
+                        l.append(x)
+                if len(frags):
+                    copy = copy or dict(o)
+                    copy[k] = l
+        if not frags:
+            return plain(o)
+        s = plain(copy)
+        parts = []
+        pos = 0
+        for i, f in enumerate(frags):
+            mark = '"\\u0000%s.%d"' % (FRAGMENT_TOKEN, i)
+            j = s.index(mark, pos)
+            text = f.getJson(encoder)
+            if encoder.indent is not None:
+                lineStart = s.rfind('\n', 0, j) + 1
+                line = s[lineStart:j]
+                pad = line[:len(line) - len(line.lstrip(' '))]
+                text = text.replace('\n', '\n' + pad)
+            parts.append(s[pos:j])
+            parts.append(text)
+            pos = j + len(mark)
+        parts.append(s[pos:])
+        return ''.join(parts)
+    return encode
+
+# Serializers generated from the curation schema (see genSerializers.py), if installed.
+# If USE_SERIALIZERS is 1, they replace the generic encoder for the compact and ndjson formats.
+# Otherwise (or in the other formats) their schema checks are run on each DTO before it is encoded, so
+# that a DTO that doesn't match the schema (SchemaDriftError) fails the run either way.
+# Returns the serializers module, or None.
+SERIALIZER_FORMATS = ['compact', 'ndjson']
+USE_SERIALIZERS = os.environ.get('USE_SERIALIZERS', '') == '1'
+def getSerializers () :
+    try:
+        import serializers
+    except ImportError:
+        return None
+    version = os.environ.get('AGR_CURATION_SCHEMA_VERSION')
+    if version and version != serializers.SCHEMA_VERSION:
+        raise RuntimeError("serializers.py was generated from schema v%s, but AGR_CURATION_SCHEMA_VERSION is %s. Rerun genSerializers.py (see Install)." % (serializers.SCHEMA_VERSION, version))
+    if not hasattr(serializers, 'CHECKERS'):
+        raise RuntimeError("serializers.py has no schema checks: it was generated by an older genSerializers.py. Rerun it (see Install).")
+    return serializers
+
+# Returns the function that encodes the DTOs of the named ingest set in the given format.
+def getSetEncoder (name, fmt, indent=None) :
+    encode = getEncoder(fmt, indent)
+    serializers = getSerializers()
+    if serializers is None:
+        return encode
+    if USE_SERIALIZERS and fmt in SERIALIZER_FORMATS:
+        return serializers.INGEST_SETS.get(name, encode)
+    check = serializers.CHECKERS.get(name)
+    if check is None:
+        return encode
+    def checkAndEncode (o) :
+        check(o)
+        return encode(o)
+    return checkAndEncode
+
+# A DTO already encoded, by a worker process (see partition.py), with getSetEncoder. emit() writes it
+# as it is. The worker has already shown the DTO to the observers.
+class Encoded (str) :
+    pass
 
+# Observers added to every emit() call, e.g. the inline validator set up by pipeline.py.
+EMIT_OBSERVERS = []
 
+# Writes a complete submission file.
+# Args:
+#   sets - list of (name, iterable) pairs, one per ingest set. Each iterable yields DTOs (dicts, or Encoded).
+#   sink - where to write (default: stdout). Flushed, but not closed.
+#   indent - the generator's preferred indentation. Used if no output format is set.
+#   observers - optional list of functions called as f(setName, dto) for each DTO written,
+#       e.g. to check DTOs against the schema as they go by (see validator.py). EMIT_OBSERVERS are added.
+#   onEncodeError - optional function called as f(dto, exception) for a DTO that cannot be encoded.
+#       The DTO is skipped. By default, encoding errors are raised. A DTO that doesn't match the schema
+#       (see getSerializers) is always an error.
+#   fmt - output format (default: OUTPUT_FORMAT)
+#   header - header attributes (default: getHeader())
+#   headerSink - for ndjson, where to write the header. Default: the sidecar file next to sink.
+# Returns:
+#   dict from set name to the number of DTOs written
+def emit (sets, sink=None, indent=None, observers=None, onEncodeError=None, fmt=None, header=None, headerSink=None) :
+    sink = sink if sink else sys.stdout
+    observers = (observers if observers else []) + EMIT_OBSERVERS
+    fmt = fmt if fmt is not None else OUTPUT_FORMAT
+    header = header if header else getHeader()
+    serializers = getSerializers()
+    driftError = serializers.SchemaDriftError if serializers else ()
+    ndjson = (fmt == 'ndjson')
+    buf = []
+    bufsize = 0
+    counts = {}
+    def write (s) :
+        nonlocal bufsize
+        buf.append(s)
+        bufsize += len(s)
+        if bufsize >= WRITE_BUFFER_SIZE:
+            sink.write(''.join(buf))
+            buf.clear()
+            bufsize = 0
+    #
+    if not ndjson:
+        write('{\n')
+        write(formatHeaderAttributes(header))
+    for i, (name, objs) in enumerate(sets):
+        if not ndjson:
+            write('%s"%s": [\n' % (',\n' if i else '', name))
+        n = 0
+        enc = getSetEncoder(name, fmt, indent)
+        for o in objs:
+            if type(o) is Encoded:
+                s = o
+            else:
+                try:
+                    s = enc(o)
+                except Exception as e:
+                    if not onEncodeError or isinstance(e, driftError):
+                        raise
+                    onEncodeError(o, e)
+                    continue
+                for f in observers:
+                    f(name, o)
+            write(',' + s + '\n' if n and not ndjson else s + '\n')
+            n += 1
+        if not ndjson:
+            write(']')
+        counts[name] = n
+    if not ndjson:
+        write('\n}\n')
+    sink.write(''.join(buf))
+    sink.flush()
+    #
+    if ndjson:
+        h = dict(header)
+        h["ingest_sets"] = [{"name": name, "count": n} for (name, n) in counts.items()]
+        if headerSink:
+            headerSink.write(json.dumps(h, indent=2) + '\n')
+        elif getattr(sink, 'name', '').startswith('<'):
+            raise RuntimeError("Cannot write NDJSON header: output is not a file.")
+        else:
+            with open(getNdjsonHeaderFile(sink.name), 'w') as fd:
+                fd.write(json.dumps(h, indent=2) + '\n')
+    return counts
 
 # Wraps the execution of the main query so that we can implement a "sample" option, that outputs
 # a small sample of records. Useful for development. At the moment,a sample is just the first 20 records.
 # Args:
-#   results (iterable) Somethat can be iterated over to get the result records
+#   results (iterable) Somethat can be iterated over to get the result records, usually streamSql(q)
 # Yields:
 #   Tuples (n,r) where n is a 0-based count and r is a record
 #
@@ -73,10 +1004,26 @@ def mainQuery(results) :
             break;
         yield n, r
         n += 1
+    # For a streamed query (see streamSql), stop fetching now rather than whenever it's garbage collected.
+    if hasattr(results, 'close'):
+        results.close()
+
+#----------------------------------
+# DTO fragments.
+#
+# Some small pieces of DTOs are built over and over from the same few values: the data provider DTO for a
+# curie (for a gene, in the gene file, again in the allele and disease files...), HTML versions of symbols
+# and strains, cross references. The functions building them are memoized, keeping up to FRAGMENT_CACHE_SIZE
+# of the most recently used results each. The DTOs they return are Fragments (see above), so they are also
+# encoded only once per output format. Hit rates are reported by formatFragmentStats.
+#
+FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE', '50000'))
 
 # Converts "Foo<Bar>" to "Foo<sup>Bar</sup>"
+superscript_re = re.compile(r'<([^>]*)>')
+@functools.lru_cache(maxsize=FRAGMENT_CACHE_SIZE)
 def symbolToHtml (s) :
-    return re.sub(r'<([^>]*)>', r'<sup>\1</sup>', s)
+    return superscript_re.sub(r'<sup>\1</sup>', s)
 
 # Builds a key-value mapping from a list of objects.
 # Args:
@@ -86,43 +1033,197 @@ def symbolToHtml (s) :
 #  multi - if true, returns multivalued index; if false, single valued
 #  mapper - optional. function to map result values to index entries.
 #       Default maps a term to itself.
+#  compact - if true, returns an IntIndex rather than a dict. Keys must be integers.
 # Returns:
 #  If multi is false, a mapping (dict) from keys to single values
 #  If multi is true, a mapping from keys to lists of values
-def indexResults (results, keyfield, valuefield, multi=False, mapper=None) :
-    index = {}
+def indexResults (results, keyfield, valuefield, multi=False, mapper=None, compact=False) :
+    index = IntIndex(multi) if compact else {}
     mapper = mapper if mapper else lambda x:x
     for r in results:
         v = r if valuefield is None else r[valuefield]
         v = mapper(v)
-        if multi:
+        if compact:
+            index.add(r[keyfield], v)
+        elif multi:
             index.setdefault(r[keyfield],[]).append(v)
         else:
             index[r[keyfield]] = v
+    if compact:
+        index.freeze()
     return index
 
+# A compact, read-only mapping from integer keys to values, for the big lookups built by indexResults.
+# A dict of row dicts costs hundreds of bytes per entry. An IntIndex instead keeps
+#  - a sorted array of the keys and, if multivalued, an array of offsets to each key's run of values
+#  - the values by column: an int array for an all-integer column, otherwise a list (strings interned).
+#    Values may be rows (dicts), tuples, or single values.
+# Values are rebuilt on lookup (rows as Row objects), so changes made to a returned value are not kept.
+# Supports get(key, default), [key], in and len, like the dict it replaces.
+#
+# Usage: index = IntIndex(multi); index.add(k, v) ...; index.freeze(); index.get(k)
+class IntIndex :
+    def __init__ (self, multi=False) :
+        self.multi = multi
+        self.keys = array.array('q')
+        self.offsets = None
+        self.kind = None    # 'row', 'tuple', or 'value'
+        self.srcKeys = None # for rows, the keys of the first row
+        self.cols = None    # for rows, the column names
+        self.columns = None
+        self.hint = 0       # where find() starts looking
+
+    def add (self, key, value) :
+        if self.kind is None:
+            if isinstance(value, dict):
+                self.kind = 'row'
+                self.srcKeys = list(value.keys())
+                self.cols = [k.lower() for k in self.srcKeys]
+            elif isinstance(value, tuple):
+                self.kind = 'tuple'
+                self.width = len(value)
+            else:
+                self.kind = 'value'
+            self.columns = [[] for i in range(self.width if self.kind == 'tuple' else len(self.cols) if self.cols else 1)]
+        self.keys.append(key)
+        if self.kind == 'row':
+            if len(value) != len(self.srcKeys):
+                raise RuntimeError("IntIndex: all rows must have the same columns: " + str(value))
+            for c, k in zip(self.columns, self.srcKeys):
+                c.append(value[k])
+        elif self.kind == 'tuple':
+            for c, v in zip(self.columns, value):
+                c.append(v)
+        else:
+            self.columns[0].append(value)
+
+    # Sorts the entries by key and packs the columns. Call once, after the last add().
+    def freeze (self) :
+        order = sorted(range(len(self.keys)), key=self.keys.__getitem__)
+        if not self.multi:
+            # as with a dict, the last value added for a key wins
+            order = [i for j, i in enumerate(order) if j + 1 == len(order) or self.keys[order[j + 1]] != self.keys[i]]
+        keys = [self.keys[i] for i in order]
+        self.columns = [compactColumn([c[i] for i in order]) for c in (self.columns or [])]
+        if self.multi:
+            # keep one copy of each key, plus where its values start
+            self.offsets = array.array('q')
+            distinct = array.array('q')
+            for j, k in enumerate(keys):
+                if not j or k != keys[j - 1]:
+                    distinct.append(k)
+                    self.offsets.append(j)
+            self.offsets.append(len(keys))
+            self.keys = distinct
+        else:
+            self.keys = array.array('q', keys)
+
+    def value (self, j) :
+        if self.kind == 'row':
+            return Row(zip(self.cols, [c[j] for c in self.columns]))
+        elif self.kind == 'tuple':
+            return tuple([c[j] for c in self.columns])
+        return self.columns[0][j]
+
+    # Returns the values from a to b, rebuilt. The columns are sliced and zipped, so that a run of
+    # values costs one pass over the columns rather than one per value.
+    def values (self, a, b) :
+        if self.kind == 'row':
+            cols = self.cols
+            return [Row(zip(cols, t)) for t in zip(*[c[a:b] for c in self.columns])]
+        elif self.kind == 'tuple':
+            return list(zip(*[c[a:b] for c in self.columns]))
+        return self.columns[0][a:b].tolist() if type(self.columns[0]) is array.array else self.columns[0][a:b]
+
+    # Returns the position of key, or -1. Lookups mostly come in key order (the generators' main queries
+    # are ordered by key), so the search starts where the last one left off, and only bisects if the key
+    # isn't there. (Threads may share the hint: a stale one just costs a bisect.)
+    def find (self, key) :
+        if not isinstance(key, int):
+            return -1
+        keys = self.keys
+        n = len(keys)
+        i = self.hint
+        if not (i < n and keys[i] >= key and (i == 0 or keys[i - 1] < key)):
+            i = bisect.bisect_left(keys, key)
+        if i < n and keys[i] == key:
+            self.hint = i + 1
+            return i
+        self.hint = i
+        return -1
+
+    def get (self, key, default=None) :
+        i = self.find(key)
+        if i < 0:
+            return default
+        if self.multi:
+            return self.values(self.offsets[i], self.offsets[i + 1])
+        return self.value(i)
+
+    def __getitem__ (self, key) :
+        v = self.get(key, KeyError)
+        if v is KeyError:
+            raise KeyError(key)
+        return v
+
+    def __contains__ (self, key) :
+        return self.find(key) >= 0
+
+    def __len__ (self) :
+        return len(self.keys)
+
+# Packs a list of values: into an int array if they're all ints, otherwise a list with interned strings.
+def compactColumn (values) :
+    if values and all([type(v) is int for v in values]):
+        return array.array('q', values)
+    return [sys.intern(v) if type(v) is str else v for v in values]
+
 # Returns a "data_provider_dto" object for the given curie and page area.
 # These were introduced in schema version 1.6.0 for diseaseAnnotations, and 
 # for genes, alleles, and agms in 1.7.0.
 # Examples:
 #       getDataProviderDto("DOID:123456", "disease/mgi")
 #       getDataProviderDto("MGI:567890", "gene")
+@functools.lru_cache(maxsize=FRAGMENT_CACHE_SIZE)
 def getDataProviderDto (curie, pageArea):
       i = curie.find(":")
       prefix = curie[:i]
-      dto = {
+      dto = Fragment({
       	"source_organization_abbreviation": "MGI",  
 	"internal" : False,
-        "cross_reference_dto": {
+        "cross_reference_dto": Fragment({
           "referenced_curie": curie,
           "prefix": prefix,
           "page_area": pageArea,
           "display_name": curie,
           "internal": False
-        }  
-      }
+        })
+      })
       return dto 
 
+# Returns a cross_reference_dto for the given curie.
+# Examples:
+#       getCrossReferenceDto("NCBI_Gene:11287", "NCBI_Gene")
+#       getCrossReferenceDto("MGI:87859", "MGI", "gene/references")
+@functools.lru_cache(maxsize=FRAGMENT_CACHE_SIZE)
+def getCrossReferenceDto (curie, prefix, pageArea="default"):
+    return Fragment({
+        "display_name" : curie,
+        "referenced_curie" : curie,
+        "page_area" : pageArea,
+        "prefix" : prefix,
+        "internal" : False,
+    })
+
+# Returns a one line summary of the fragment caches' hit rates, for logging.
+def formatFragmentStats () :
+    stats = []
+    for f in [getDataProviderDto, getCrossReferenceDto, symbolToHtml]:
+        ci = f.cache_info()
+        total = ci.hits + ci.misses
+        stats.append("%s %.0f%% of %d" % (f.__name__, 100.0 * ci.hits / total if total else 0, total))
+    return "Fragment cache hits: " + ", ".join(stats)
+
 # Sets common fields in the object, based on values in the db record
 def setCommonFields (rec, obj, internal=False, obsolete=False) :
     obj["internal"] = internal
@@ -132,9 +1233,16 @@ def setCommonFields (rec, obj, internal=False, obsolete=False) :
     obj["created_by_curie"] = "MGI:curation_staff"
     obj["updated_by_curie"] = "MGI:curation_staff"
 
-# Return a mapping from reference key to the MGI id and PMID (if available).
-def getReferenceIds () :
-    q = '''
+#----------------------------------
+# Reference IDs.
+#
+# Several generators need the preferred ID (PMID if there is one, else MGI id) of the references they cite.
+# Rather than loading IDs for every reference in MGI, only the ref keys actually asked for are fetched,
+# in chunks of REF_FETCH_CHUNK keys per query, and remembered for later lookups.
+# Callers with many keys should resolve them in one batch (resolveRefIds, or withRefIds for a stream
+# of rows) before looking them up one at a time with getPreferredRefId.
+#
+qReferenceIds = '''
         SELECT a1._object_key as _refs_key, a1.accid as mgiid, a2.accid as pubmedid
         FROM acc_accession a1
           LEFT JOIN acc_accession a2
@@ -146,35 +1254,73 @@ def getReferenceIds () :
           AND a1.prefixpart = 'MGI:'
           AND a1._logicaldb_key = 1
           AND a1.preferred = 1
+          AND a1._object_key = ANY(%s)
         '''
-    return indexResults(db.sql(q), '_refs_key', None, multi=False)
+REF_FETCH_CHUNK = 10000
+refIds = {} # _refs_key -> preferred ID
+refIdStats = { "hits": 0, "misses": 0, "queries": 0 }
+
+# Returns a dict from each of the given ref keys (None is skipped) to its preferred ID.
+# Keys not seen before are fetched from the database. Loaders run concurrently (see prefetch) take turns,
+# so that no key is fetched twice, and each chunk's IDs are added to refIds only once all fetched.
+# Every reference must have an MGI id: a key the query doesn't return raises KeyError.
+refIdsLock = threading.Lock()
+def resolveRefIds (rks) :
+    rks = set(rks)
+    rks.discard(None)
+    with refIdsLock:
+        missing = [rk for rk in rks if rk not in refIds]
+        refIdStats["hits"] += len(rks) - len(missing)
+        refIdStats["misses"] += len(missing)
+        missing.sort()
+        for i in range(0, len(missing), REF_FETCH_CHUNK):
+            keys = missing[i:i + REF_FETCH_CHUNK]
+            chunk = {}
+            for r in sql(qReferenceIds, cache=False, args=(keys,)):
+                chunk[r["_refs_key"]] = ("PMID:" + r["pubmedid"]) if r["pubmedid"] else r["mgiid"]
+            refIds.update(chunk)
+            refIdStats["queries"] += 1
+            unknown = [rk for rk in keys if rk not in chunk]
+            if unknown:
+                raise KeyError("No MGI id for reference key(s): %s" % ", ".join(map(str, unknown[:10])))
+    return dict([(rk, refIds[rk]) for rk in rks])
 
 # Return the preferred ID for a reference, given it ref key.
 # The preferred ID is the PMID, if there is one, otherswise the MGI id.
-rk2ids = None
 def getPreferredRefId (rk):
-    global rk2ids
-    if rk2ids is None:
-        rk2ids = getReferenceIds()
     if rk is None: return None
-    ids = rk2ids[rk] # every reference must have an entry, else error
-    if ids["pubmedid"]:
-        return "PMID:" + ids["pubmedid"]
-    else:
-        return ids["mgiid"]
+    if rk in refIds:
+        refIdStats["hits"] += 1
+        return refIds[rk]
+    return resolveRefIds([rk])[rk]
+
+# Passes through a stream of rows, resolving the ref keys (in field) of each batch of rows
+# before yielding them, so that getPreferredRefId finds them already fetched.
+def withRefIds (rows, field='_refs_key', batchSize=REF_FETCH_CHUNK) :
+    rows = iter(rows)
+    try:
+        while True:
+            batch = list(itertools.islice(rows, batchSize))
+            if not batch:
+                break
+            resolveRefIds([r.get(field) for r in batch])
+            yield from batch
+    finally:
+        if hasattr(rows, 'close'):
+            rows.close()
 
+# Returns a one line summary of refIdStats, for logging.
+def formatRefIdStats () :
+    return "Reference IDs: %(hits)d hits, %(misses)d misses, %(queries)d queries" % refIdStats
 
-# Get the MGI notes of the given note type.
+# Get the MGI notes of the given note type (for the objects with the given keys, if keys is not None).
 # Return an index of _object_key to the note record(s) for that object
-def getNotesOfType (noteTypeKey) :
+def getNotesOfType (noteTypeKey, keys=None) :
     q = '''SELECT *
         FROM MGI_Note
         WHERE _noteType_key = %s
         ''' % noteTypeKey
-    k2n = {}
-    for r in db.sql(q) :
-        k2n.setdefault(r['_object_key'], []).append(r)
-    return k2n
+    return indexResults(sqlForKeys(q, '_object_key', keys), '_object_key', None, multi=True, compact=True)
 
 # Turns a note record (from the MGI_Note table) into a NoteDTO object for submission.
 # 
@@ -1,11 +1,18 @@
 
-import db
-import json
 import re
 import argparse
-from adfLib import getHeaderAttributes, symbolToHtml, getDataProviderDto, mainQuery, setCommonFields
+from adfLib import emit, symbolToHtml, getDataProviderDto, mainQuery, setCommonFields, shared, sql, sqlForKeys, streamSqlForKeys
+import delta
 
+# The tables this generator reads, for change detection (see manifest.py).
+TABLES = ["ACC_Accession", "ALL_Allele", "GXD_AllelePair", "GXD_Genotype", "MGI_Note", "PRB_Strain", "VOC_Term"]
+
+@shared
 def getAGMnames () :
+    return loadAGMnames()
+
+# Returns dict from genotype key to name (only for the given keys, if keys is not None).
+def loadAGMnames (keys=None) :
     q = '''
         SELECT g._genotype_key, n.note as alleles
         FROM GXD_Genotype g,
@@ -15,29 +22,31 @@ def getAGMnames () :
         AND n._notetype_key = 1016
         '''
     d = {}
-    for r in db.sql(q, 'auto'):
+    for r in sqlForKeys(q, '_genotype_key', keys):
         d[r['_genotype_key']] = symbolToHtml(r['alleles']).replace('\n', ' ')
     return d
 
-def getAGMs () :
-    q = '''
-        SELECT
-            aa.accid,
-            g.*,
-            s.strain
-        FROM
-            GXD_Genotype g,
-            ACC_Accession aa,
-            PRB_Strain s
-        WHERE
-            g._genotype_key > 0  /* skip the not applicable and not specified genotypes */
-            and g._genotype_key = aa._object_key
-            and aa._mgitype_key = 12
-            and aa._logicaldb_key = 1
-            and aa.preferred = 1
-            and g._strain_key = s._strain_key
-        '''
-    return db.sql(q, 'auto')
+qAGMs = '''
+    SELECT
+        aa.accid,
+        g.*,
+        s.strain
+    FROM
+        GXD_Genotype g,
+        ACC_Accession aa,
+        PRB_Strain s
+    WHERE
+        g._genotype_key > 0  /* skip the not applicable and not specified genotypes */
+        and g._genotype_key = aa._object_key
+        and aa._mgitype_key = 12
+        and aa._logicaldb_key = 1
+        and aa.preferred = 1
+        and g._strain_key = s._strain_key
+    '''
+
+# Returns the genotypes (only those with the given keys, if keys is not None).
+def getAGMs (keys=None) :
+    return streamSqlForKeys(qAGMs, '_genotype_key', keys)
 
 #
 # valid GENO term ids for Alliance submissions
@@ -66,6 +75,7 @@ mgi2geno = {
  "Heteroplasmic" : "GENO:0000603"
 }
 
+@shared
 def getAGMComponents () :
     q = '''
         SELECT
@@ -85,7 +95,7 @@ def getAGMComponents () :
         AND ap._pairstate_key = ps._term_key
         '''
     gk2comps = {}
-    for r in db.sql(q, 'auto'):
+    for r in sql(q, 'auto'):
         gk2comps.setdefault(r["_genotype_key"],[]).append({
             "allele_identifier" : r["accid"],
             "zygosity_curie" : mgi2geno[r["term"]],
@@ -119,33 +129,43 @@ def getOpts () :
 
 def main () :
     opts = getOpts()
-    agmKey2name = getAGMnames()
-    genoKey2comps = getAGMComponents()
-    print('{')
-    print(getHeaderAttributes())
-    if opts.type == "genotypes":
-        print('"agm_ingest_set": [')
+    output(opts.type)
+
+# Yields (genotype key, AGM object) for the genotypes with the given keys, or for all if keys is None.
+def getAGMObjects (keys=None) :
+    agmKey2name = getAGMnames() if keys is None else loadAGMnames(keys)
+    for j,r in mainQuery(getAGMs(keys)):
+        yield r["_genotype_key"], getJsonObject(r, agmKey2name)
+
+# Writes the genotypes file in delta mode (see delta.py).
+def outputDelta (store, mode, sink=None) :
+    delta.outputDelta(store, "agm_ingest_set", qAGMs, "_genotype_key", qChangedAGMs, getAGMObjects, mode, sink)
+
+# Delta mode: the keys of genotypes with data modified after a given time (see delta.py).
+qChangedAGMs = [
+    "SELECT _genotype_key FROM GXD_Genotype WHERE modification_date > %s",
+    "SELECT _object_key FROM ACC_Accession WHERE _mgitype_key = 12 AND modification_date > %s",
+    "SELECT _object_key FROM MGI_Note WHERE _notetype_key = 1016 AND modification_date > %s",
+    "SELECT g._genotype_key FROM GXD_Genotype g, PRB_Strain s WHERE g._strain_key = s._strain_key AND s.modification_date > %s",
+]
+
+# Writes the genotypes (otype == "genotypes") or genotype associations (otype == "associations") file
+# to sink (default: stdout).
+def output (otype, sink=None) :
+    def genotypes () :
+        for k,o in getAGMObjects():
+            yield o
+    def associations () :
+        genoKey2comps = getAGMComponents()
+        for j,r in mainQuery(getAGMs()):
+            for obj in genoKey2comps.get(r["_genotype_key"], []):
+                obj["agm_subject_identifier"] = r["accid"]
+                obj["relation_name"] = "contains"
+                yield obj
+    if otype == "genotypes":
+        emit([("agm_ingest_set", genotypes())], sink)
     else:
-        print('"agm_allele_association_ingest_set": [')  
-    first=True          
-    for j,r in mainQuery(getAGMs()):
-        if opts.type == "associations":
-            objs = genoKey2comps.get(r["_genotype_key"], [])
-            if objs:
-                for obj in objs:
-                    obj["agm_subject_identifier"] = r["accid"]
-                    obj["relation_name"] = "contains"
-                    if not first: print(",", end=' ')
-                    first = False
-                    print(json.dumps(obj))                                        
-            continue
-
-        # else opts.type == "genotypes"...
-        if j: print(',', end='')
-        o = getJsonObject(r, agmKey2name)
-        print(json.dumps(o))
-    print(']')
-    print('}')
+        emit([("agm_allele_association_ingest_set", associations())], sink)
 
 if __name__ == "__main__":
     main()
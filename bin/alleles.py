@@ -1,13 +1,17 @@
 
 import sys
-import db
-import json
 import re
 import argparse
-from adfLib import getHeaderAttributes, symbolToHtml, indexResults, getDataProviderDto, mainQuery, log, setCommonFields, getPreferredRefId, getNotesOfType, getNoteDTO
+from adfLib import openSink, emit, symbolToHtml, indexResults, getDataProviderDto, mainQuery, setCommonFields, getPreferredRefId, resolveRefIds, withRefIds, getNotesOfType, getNoteDTO, prefetch, sql, streamSql, sqlForKeys, streamSqlForKeys
+import delta
+import partition
 from genes import getSubmittedGeneIds
 from constructs import getAlleleConstructRelationships
 
+# The tables this generator reads, for change detection (see manifest.py).
+TABLES = ["ACC_Accession", "ALL_Allele", "ALL_Allele_Mutation", "MGI_Note", "MGI_Organism", "MGI_RefAssocType",
+    "MGI_Reference_Assoc", "MGI_Relationship", "MGI_Relationship_Property", "MGI_Synonym", "MRK_Marker", "VOC_Annot", "VOC_Term"]
+
 # Currently only uploading alleles where status is pproved and autoload.
 APPROVED_ALLELE_STATUS = 847114
 AUTOLOAD_ALLELE_STATUS = 3983021
@@ -15,8 +19,7 @@ IN_PROGRESS_ALLELE_STATUS = 847111
 DELETED_ALLELE_STATUS = 847112
 RESERVED_ALLELE_STATUS = 847113
 
-def getAlleleRefs () :
-    q = '''
+qAlleleRefs = '''
         SELECT distinct ra._object_key as _allele_key, ra._refs_key, ra._refassoctype_key
         FROM MGI_RefAssocType rat,
           MGI_Reference_Assoc ra
@@ -24,12 +27,14 @@ def getAlleleRefs () :
         AND rat._mgitype_key = 11
         AND rat._refassoctype_key != 1014
         '''
-
+def getAlleleRefs (keys=None) :
     def mapper (r) :
         r['preferredRefId'] = getPreferredRefId(r["_refs_key"])
         return r
 
-    return indexResults(db.sql(q), '_allele_key', None, multi=True, mapper=mapper)
+    rows = sqlForKeys(qAlleleRefs, '_allele_key', keys, copy=True)
+    resolveRefIds([r["_refs_key"] for r in rows])
+    return indexResults(rows, '_allele_key', None, multi=True, mapper=mapper, compact=True)
 
 # Returns index from allele MGI id to the _refs_key of its original reference
 def getOriginalRefs () :
@@ -45,47 +50,51 @@ def getOriginalRefs () :
         AND aa._logicaldb_key = 1
         AND aa.preferred = 1
         '''
-    return indexResults(db.sql(q), 'alleleId', None, multi=False, mapper=lambda x:getPreferredRefId(x["_refs_key"]) )
+    rows = sql(q)
+    resolveRefIds([r["_refs_key"] for r in rows])
+    return indexResults(rows, 'alleleId', None, multi=False, mapper=lambda x:getPreferredRefId(x["_refs_key"]) )
 
 
-def getAlleleTransmission () :
+def getAlleleTransmission (keys=None) :
     q = '''
         SELECT a._allele_key, t.term
         FROM all_allele a, voc_term t
         WHERE a._transmission_key = t._term_key
         '''
-    return indexResults(db.sql(q), '_allele_key', 'term', multi=False, mapper=lambda t: t.lower())
+    return indexResults(sqlForKeys(q, '_allele_key', keys), '_allele_key', 'term', multi=False, mapper=lambda t: t.lower(), compact=True)
 
-def getAlleleSynonyms () :
+def getAlleleSynonyms (keys=None) :
     q = '''
         SELECT s._object_key as _allele_key, s.synonym, s._refs_key
         FROM MGI_Synonym s
         WHERE s._synonymtype_key = 1016
         '''
     mapper = lambda r : (r['synonym'], getPreferredRefId(r['_refs_key']))
-    return indexResults(db.sql(q), '_allele_key', None, multi=True, mapper=mapper)
+    rows = sqlForKeys(q, '_allele_key', keys)
+    resolveRefIds([r['_refs_key'] for r in rows])
+    return indexResults(rows, '_allele_key', None, multi=True, mapper=mapper, compact=True)
 
-def getAlleleMolecularNotes () :
-    return getNotesOfType(1021)
+def getAlleleMolecularNotes (keys=None) :
+    return getNotesOfType(1021, keys)
 
-def getAlleleAttributes () :
+def getAlleleAttributes (keys=None) :
     q = '''
         SELECT va._object_key as _allele_key, vt.term
         FROM VOC_Annot va, VOC_Term vt
         WHERE va._annottype_key = 1014
         AND va._term_key = vt._term_key
         '''
-    return indexResults(db.sql(q), '_allele_key', 'term', multi=True)
+    return indexResults(sqlForKeys(q, '_allele_key', keys), '_allele_key', 'term', multi=True, compact=True)
 
-def getAlleleMutations () :
+def getAlleleMutations (keys=None) :
     q = '''
         SELECT m._allele_key, t.term
         FROM all_allele_mutation m, voc_term t
         WHERE m._mutation_key = t._term_key
         '''
-    return indexResults(db.sql(q), '_allele_key', 'term', multi=True, mapper = lambda s: MUTATION_2_SOID.get(s, None))
+    return indexResults(sqlForKeys(q, '_allele_key', keys), '_allele_key', 'term', multi=True, mapper = lambda s: MUTATION_2_SOID.get(s, None), compact=True)
 
-def getAlleleSecondaryIds () :
+def getAlleleSecondaryIds (keys=None) :
     q = '''
         SELECT _object_key as _allele_key, accid
         FROM acc_accession
@@ -93,44 +102,46 @@ def getAlleleSecondaryIds () :
         AND _logicaldb_key = 1
         AND preferred = 0
         '''
-    return indexResults(db.sql(q), '_allele_key', 'accid', multi=True)
-
-def getAlleles () :
-    q = '''
-        SELECT
-            a.*,
-            aa.accid,
-            CASE
-              WHEN m.term = 'Not Specified' THEN ''
-              WHEN m.term = 'Not Applicable' THEN ''
-              WHEN m.term = 'Not Curated' THEN ''
-              ELSE m.term
-            END as mode,
-            CASE
-              WHEN c.term = 'Not Specified' THEN ''
-              ELSE c.term
-            END as collection,
-            CASE
-              WHEN st.term = 'Autoload' THEN 'autoloaded'
-              ELSE st.term
-            END as status
-        FROM
-            ALL_Allele a,
-            ACC_Accession aa,
-            VOC_Term m,
-            VOC_Term c,
-            VOC_Term st
-        WHERE a._allele_status_key in (%d,%d)
-            and a._allele_key = aa._object_key
-            and aa._mgitype_key = 11
-            and aa._logicaldb_key = 1
-            and aa.preferred = 1
-            and aa.private = 0
-            and a._mode_key = m._term_key
-            and a._collection_key = c._term_key
-            and a._allele_status_key = st._term_key
-        ''' % (APPROVED_ALLELE_STATUS, AUTOLOAD_ALLELE_STATUS)
-    return db.sql(q, 'auto')
+    return indexResults(sqlForKeys(q, '_allele_key', keys), '_allele_key', 'accid', multi=True, compact=True)
+
+qAlleles = '''
+    SELECT
+        a.*,
+        aa.accid,
+        CASE
+          WHEN m.term = 'Not Specified' THEN ''
+          WHEN m.term = 'Not Applicable' THEN ''
+          WHEN m.term = 'Not Curated' THEN ''
+          ELSE m.term
+        END as mode,
+        CASE
+          WHEN c.term = 'Not Specified' THEN ''
+          ELSE c.term
+        END as collection,
+        CASE
+          WHEN st.term = 'Autoload' THEN 'autoloaded'
+          ELSE st.term
+        END as status
+    FROM
+        ALL_Allele a,
+        ACC_Accession aa,
+        VOC_Term m,
+        VOC_Term c,
+        VOC_Term st
+    WHERE a._allele_status_key in (%d,%d)
+        and a._allele_key = aa._object_key
+        and aa._mgitype_key = 11
+        and aa._logicaldb_key = 1
+        and aa.preferred = 1
+        and aa.private = 0
+        and a._mode_key = m._term_key
+        and a._collection_key = c._term_key
+        and a._allele_status_key = st._term_key
+    ''' % (APPROVED_ALLELE_STATUS, AUTOLOAD_ALLELE_STATUS)
+
+# Returns the approved and autoload alleles (only those with the given keys, if keys is not None).
+def getAlleles (keys=None) :
+    return streamSqlForKeys(qAlleles, '_allele_key', keys)
 
 def getAlleleJsonObject (r, ak2refs, ak2trans, ak2syns, ak2attrs, ak2muts, ak2secids, ak2mnotes) :
     refs = ak2refs.get(r["_allele_key"], [])
@@ -244,25 +255,54 @@ def getAlleleJsonObject (r, ak2refs, ak2trans, ak2syns, ak2attrs, ak2muts, ak2se
 def getOpts () :
     parser = argparse.ArgumentParser()
     parser.add_argument('-t','--type',choices=['alleles','associations'],help="What to output.")
+    partition.addOptions(parser, "alleles (-t alleles)")
     return parser.parse_args()
 
-def outputAlleles () :
-    print('{')
-    print(getHeaderAttributes())
-    print('"allele_ingest_set": [')
-    ak2refs = getAlleleRefs()
-    ak2trans = getAlleleTransmission()
-    ak2syns = getAlleleSynonyms()
-    ak2attrs = getAlleleAttributes()
-    ak2muts = getAlleleMutations()
-    ak2mnotes = getAlleleMolecularNotes()
-    ak2secids = getAlleleSecondaryIds ()
-    for j,r in mainQuery(getAlleles()):
-        if j: print(',', end='')
-        o = getAlleleJsonObject(r, ak2refs, ak2trans, ak2syns, ak2attrs, ak2muts, ak2secids, ak2mnotes)
-        print(json.dumps(o))
-    print(']')
-    print('}')
+# Loads the lookups used to build allele objects (just for the given allele keys, if keys is not None).
+# Returns them as a tuple of the arguments getAlleleJsonObject takes after the row.
+# The loaders are independent, so they run concurrently (see adfLib.prefetch).
+def loadAlleleLookups (keys=None) :
+    ak2refs, ak2trans, ak2syns, ak2attrs, ak2muts, ak2mnotes, ak2secids = prefetch(
+        (getAlleleRefs, keys),
+        (getAlleleTransmission, keys),
+        (getAlleleSynonyms, keys),
+        (getAlleleAttributes, keys),
+        (getAlleleMutations, keys),
+        (getAlleleMolecularNotes, keys),
+        (getAlleleSecondaryIds, keys))
+    return (ak2refs, ak2trans, ak2syns, ak2attrs, ak2muts, ak2secids, ak2mnotes)
+
+# Yields (allele key, allele object) for the alleles with the given keys, or for all alleles if keys is None.
+def getAlleleObjects (keys=None) :
+    lookups = loadAlleleLookups(keys)
+    for j,r in mainQuery(getAlleles(keys)):
+        yield r["_allele_key"], getAlleleJsonObject(r, *lookups)
+
+# Writes the alleles file to sink (default: stdout), in order of allele key, built by partition.WORKERS processes.
+def outputAlleles (sink=None) :
+    lookups = loadAlleleLookups()
+    def build (rows) :
+        for r in rows:
+            yield getAlleleJsonObject(r, *lookups)
+    emit([("allele_ingest_set", partition.generate("allele_ingest_set", qAlleles, "_allele_key", build))], sink)
+
+# Writes the alleles file in delta mode (see delta.py).
+def outputAllelesDelta (store, mode, sink=None) :
+    delta.outputDelta(store, "allele_ingest_set", qAlleles, "_allele_key", qChangedAlleles, getAlleleObjects, mode, sink)
+
+# Delta mode: the keys of alleles with data modified after a given time (see delta.py).
+qChangedAlleles = [
+    "SELECT _allele_key FROM ALL_Allele WHERE modification_date > %s",
+    "SELECT _object_key FROM ACC_Accession WHERE _mgitype_key = 11 AND modification_date > %s",
+    "SELECT _object_key FROM MGI_Synonym WHERE _mgitype_key = 11 AND modification_date > %s",
+    "SELECT _object_key FROM MGI_Note WHERE _mgitype_key = 11 AND modification_date > %s",
+    "SELECT _object_key FROM MGI_Reference_Assoc WHERE _mgitype_key = 11 AND modification_date > %s",
+    "SELECT _object_key FROM VOC_Annot WHERE _annottype_key = 1014 AND modification_date > %s",
+    "SELECT _allele_key FROM ALL_Allele_Mutation WHERE modification_date > %s",
+    # references and synonyms citing a reference whose ids changed (e.g. it got a PubMed id): evidence_curies
+    "SELECT ra._object_key FROM MGI_Reference_Assoc ra, ACC_Accession a WHERE ra._mgitype_key = 11 AND ra._refs_key = a._object_key AND a._mgitype_key = 1 AND a.modification_date > %s",
+    "SELECT s._object_key FROM MGI_Synonym s, ACC_Accession a WHERE s._mgitype_key = 11 AND s._refs_key = a._object_key AND a._mgitype_key = 1 AND a.modification_date > %s",
+]
 
 def getAlleleOfAssociations () :
     q = '''
@@ -283,7 +323,7 @@ def getAlleleOfAssociations () :
         AND ma.private = 0
         AND a._allele_status_key in (%d,%d)
         ''' % (APPROVED_ALLELE_STATUS, AUTOLOAD_ALLELE_STATUS)
-    return db.sql(q)
+    return streamSql(q)
 
 def getMutationInvolvesAssociations () :
     q = '''
@@ -308,10 +348,11 @@ def getMutationInvolvesAssociations () :
         AND ma.private = 0
         AND a._allele_status_key in (%d,%d)
         ''' % (APPROVED_ALLELE_STATUS, AUTOLOAD_ALLELE_STATUS)
-    return db.sql(q)
+    return streamSql(q)
 
 def getAlleleGeneAssociations () :
-    return getAlleleOfAssociations() + getMutationInvolvesAssociations()
+    yield from getAlleleOfAssociations()
+    yield from withRefIds(getMutationInvolvesAssociations())
 
 def getAlleleConstructAssociations () :
     aid2rels = getAlleleConstructRelationships()
@@ -357,40 +398,31 @@ def getGeneAssociationJsonObject (r, geneIds) :
     setCommonFields(r, jobj)
     return jobj
 
-def outputAssociations () :
+# Writes the allele associations file to sink (default: stdout).
+def outputAssociations (sink=None) :
     geneIds = getSubmittedGeneIds()
-    print('{')
-    print(getHeaderAttributes())
-    print('"allele_gene_association_ingest_set": [')
-
-    # allele-gene associations
-    sep = ''
-    for j,r in mainQuery(getAlleleGeneAssociations()):
-        o = getGeneAssociationJsonObject(r, geneIds)
-        if o:
-            print(sep, end='')
-            print(json.dumps(o))
-            sep = ','
-    print(']')
-
-    # allele-construct associations
-    sep = ''
-    print(',')
-    print('"allele_construct_association_ingest_set": [')
-    for jobj in getAlleleConstructAssociations():
-        print(sep, end='')
-        print(json.dumps(jobj))
-        sep = ','
-    print(']')
-
-    print('}')
+    def geneAssociations () :
+        for j,r in mainQuery(getAlleleGeneAssociations()):
+            o = getGeneAssociationJsonObject(r, geneIds)
+            if o:
+                yield o
+    emit([
+        ("allele_gene_association_ingest_set", geneAssociations()),
+        ("allele_construct_association_ingest_set", getAlleleConstructAssociations()),
+        ], sink)
 
 def main () :
     opts = getOpts()
     if opts.type == "alleles" :
-        outputAlleles()
+        partition.runGenerator(outputAlleles, opts)
     elif opts.type == "associations" :
-        outputAssociations()
+        if opts.shard:
+            raise RuntimeError("Allele associations can't be sharded.")
+        if opts.output:
+            with openSink(opts.output) as fd:
+                outputAssociations(fd)
+        else:
+            outputAssociations()
 
 ######
 # Translation tables 
@@ -0,0 +1,53 @@
+#
+# benchExtract.py
+#
+# Compares fetching the largest lookup queries through sql() (i.e., db.sql, row dicts) with
+# fetching them through copySql (COPY ... TO STDOUT). For each query and method, reports
+# rows, seconds, rows/s and the peak Python memory allocated while loading.
+#
+# Usage:
+#   python benchExtract.py
+#
+import time
+import tracemalloc
+from adfLib import sql, copySql
+from genes import qXrefs, qMgiIds, qGeneSynonyms
+from alleles import qAlleleRefs
+
+QUERIES = [
+    ("qXrefs", qXrefs),
+    ("qMgiIds", qMgiIds),
+    ("qAlleleRefs", qAlleleRefs),
+    ("qGeneSynonyms", qGeneSynonyms),
+]
+
+METHODS = [
+    ("sql", lambda q: sql(q, cache=False)),
+    ("copySql", copySql),
+]
+
+# Returns (rows, seconds) for one load. Timed without tracemalloc, which slows allocation down.
+def timeLoad (method, q) :
+    t0 = time.perf_counter()
+    n = len(method(q))
+    return n, time.perf_counter() - t0
+
+# Returns the peak memory (bytes) allocated during one load.
+def peakLoad (method, q) :
+    tracemalloc.start()
+    rows = method(q)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del rows
+    return peak
+
+def main () :
+    print("%-16s %-8s %10s %8s %10s %10s" % ("query", "method", "rows", "seconds", "rows/s", "peak MB"))
+    for (qname, q) in QUERIES:
+        for (mname, method) in METHODS:
+            n, elapsed = timeLoad(method, q)
+            peak = peakLoad(method, q)
+            print("%-16s %-8s %10d %8.2f %10.0f %10.1f" % (qname, mname, n, elapsed, n / elapsed if elapsed else 0, peak / (1024 * 1024)))
+
+if __name__ == "__main__":
+    main()
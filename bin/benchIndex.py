@@ -0,0 +1,90 @@
+#
+# benchIndex.py
+#
+# Compares the lookups of the alleles generator (see alleles.loadAlleleLookups) built as IntIndexes
+# (indexResults(..., compact=True), as the generator builds them) with the same lookups built as dicts.
+# For each lookup and kind, reports the number of keys, the seconds taken to load it, the memory it holds
+# on to (MB, and bytes per key), and the seconds taken to look up every key once, in key order, as the
+# generator's main loop does. (An IntIndex rebuilds rows as they are looked up, which the dicts' rows
+# cost when loaded.)
+#
+# Usage:
+#   python benchIndex.py
+#
+import gc
+import time
+import tracemalloc
+import adfLib
+import alleles
+
+LOOKUPS = [
+    ("refs", alleles.getAlleleRefs),
+    ("transmission", alleles.getAlleleTransmission),
+    ("synonyms", alleles.getAlleleSynonyms),
+    ("attributes", alleles.getAlleleAttributes),
+    ("mutations", alleles.getAlleleMutations),
+    ("secondary ids", alleles.getAlleleSecondaryIds),
+    ("molecular notes", alleles.getAlleleMolecularNotes),
+]
+
+# Builds the lookups as dicts: indexResults with compact off, wherever the loaders call it.
+def dictIndexResults (*args, **kwargs) :
+    kwargs['compact'] = False
+    return indexResults(*args, **kwargs)
+indexResults = adfLib.indexResults
+
+def setCompact (compact) :
+    f = indexResults if compact else dictIndexResults
+    adfLib.indexResults = f
+    alleles.indexResults = f
+
+# Returns the seconds taken by one load.
+def timeLoad (loader) :
+    t0 = time.perf_counter()
+    index = loader()
+    return time.perf_counter() - t0
+
+# Returns (index, bytes held) for one load. The reference IDs are resolved by a first load, so that
+# their cache isn't counted.
+def measureLoad (loader) :
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    index = loader()
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return index, held
+
+# Returns the seconds taken to look up each of the keys.
+def timeLookups (index, keys) :
+    t0 = time.perf_counter()
+    for k in keys:
+        index.get(k)
+    return time.perf_counter() - t0
+
+def main () :
+    print("%-16s %-8s %10s %8s %10s %10s %9s" % ("lookup", "kind", "keys", "load s", "MB", "bytes/key", "lookup s"))
+    totals = {}
+    for (name, loader) in LOOKUPS:
+        loader()
+        keys = None
+        for (kind, compact) in [("dict", False), ("IntIndex", True)]:
+            setCompact(compact)
+            loadSeconds = timeLoad(loader)
+            index, held = measureLoad(loader)
+            keys = keys if keys is not None else sorted(index.keys())
+            seconds = timeLookups(index, keys)
+            t = totals.setdefault(kind, [0, 0.0, 0, 0.0])
+            t[0] += len(keys)
+            t[1] += loadSeconds
+            t[2] += held
+            t[3] += seconds
+            print("%-16s %-8s %10d %8.2f %10.1f %10.0f %9.2f" % (name, kind, len(keys), loadSeconds, held / 2**20, held / len(keys) if keys else 0, seconds))
+            del index
+    setCompact(True)
+    for (kind, (n, loadSeconds, held, seconds)) in totals.items():
+        print("%-16s %-8s %10d %8.2f %10.1f %10.0f %9.2f" % ("total", kind, n, loadSeconds, held / 2**20, held / n if n else 0, seconds))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+#
+# benchOutput.py
+#
+# Compares the output formats (see adfLib.OUTPUT_FORMATS) on existing submission files.
+# Each file is loaded, then its DTOs are written again in each format, to a sink that just counts
+# characters. Reports, per file and format, the output size and the time spent encoding and writing.
+#
+# Usage:
+#   python benchOutput.py /path/to/output/MGI_ps_*.json
+#
+import sys
+import json
+import time
+from adfLib import emit, OUTPUT_FORMATS
+
+# A sink that discards its input but counts it. (Output is ASCII, so characters == bytes.)
+class CountingSink :
+    def __init__ (self) :
+        self.size = 0
+    def write (self, s) :
+        self.size += len(s)
+    def flush (self) :
+        pass
+
+# Returns (header, sets) for a submission file.
+def load (fname) :
+    with open(fname) as fd:
+        data = json.load(fd)
+    header = {}
+    sets = []
+    for k, v in data.items():
+        if isinstance(v, list):
+            sets.append((k, v))
+        else:
+            header[k] = v
+    return header, sets
+
+def bench (fname) :
+    header, sets = load(fname)
+    ndtos = sum([len(objs) for (name, objs) in sets])
+    print("%s (%d DTOs)" % (fname, ndtos))
+    print("  %-8s %14s %10s %10s" % ("format", "bytes", "seconds", "DTOs/s"))
+    for fmt in OUTPUT_FORMATS:
+        sink = CountingSink()
+        headerSink = CountingSink()
+        t0 = time.perf_counter()
+        emit(sets, sink, fmt=fmt, header=header, headerSink=headerSink)
+        elapsed = time.perf_counter() - t0
+        print("  %-8s %14d %10.2f %10.0f" % (fmt, sink.size + headerSink.size, elapsed, ndtos / elapsed if elapsed else 0))
+
+def main () :
+    for fname in sys.argv[1:]:
+        bench(fname)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+#
+# benchTimestamps.py
+#
+# Checks and times adfLib.getTimeStamp, which caches each day's UTC offset, against the original
+# conversion (date_re + datetime + rfc3339) it replaces.
+# The test data is every N minutes (default 7) of the days around each DST change in the given
+# years, plus a sample of ordinary days, in the given time zone (default America/New_York, which is
+# where the database lives). Every converted value must be identical; the first difference is an error.
+# Then reports conversions/s for the original, getTimeStamp (one value at a time), and getTimeStamps
+# (a whole column at once).
+#
+# Usage:
+#   python benchTimestamps.py [--tz America/New_York] [--years 1999-2026] [--step 7]
+#
+import os
+import re
+import time
+import datetime
+import argparse
+
+def getOpts () :
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tz',default='America/New_York',help="Time zone (TZ) to run in.")
+    parser.add_argument('--years',default='1999-2026',help="Range of years, e.g. 1999-2026.")
+    parser.add_argument('--step',type=int,default=7,help="Minutes between test values.")
+    return parser.parse_args()
+
+# Returns the days (as datetimes) on which the UTC offset changes, in the given years.
+def getTransitionDays (years) :
+    days = []
+    for y in years:
+        d = datetime.datetime(y, 1, 1)
+        prev = time.localtime(time.mktime(d.timetuple())).tm_isdst
+        while d.year == y:
+            d += datetime.timedelta(days=1)
+            cur = time.localtime(time.mktime(d.timetuple())).tm_isdst
+            if cur != prev:
+                days.append(d - datetime.timedelta(days=1))
+            prev = cur
+    return days
+
+# Returns test values ("yyyy-mm-dd hh:mm:ss"), every step minutes from 24 hours before
+# to 48 hours after the start of each day, plus an odd second each time.
+def getValues (days, step) :
+    values = []
+    for day in days:
+        t = day - datetime.timedelta(days=1)
+        end = day + datetime.timedelta(days=2)
+        while t < end:
+            values.append(t.strftime('%Y-%m-%d %H:%M:%S'))
+            t += datetime.timedelta(minutes=step, seconds=1)
+    return values
+
+def rate (n, f) :
+    t0 = time.perf_counter()
+    f()
+    elapsed = time.perf_counter() - t0
+    return n / elapsed if elapsed else 0
+
+def main () :
+    opts = getOpts()
+    os.environ['TZ'] = opts.tz
+    time.tzset()
+    # import after setting TZ, to be sure nothing computed at import time used the old zone
+    import adfLib
+    from rfc3339 import rfc3339
+    date_re = re.compile(r'(\d\d\d\d)-(\d\d)-(\d\d) (\d\d):(\d\d):(\d\d)')
+    def original (s) :
+        m = date_re.match(s)
+        return rfc3339(datetime.datetime(*[int(g) for g in m.groups()]))
+
+    y0, y1 = [int(y) for y in opts.years.split('-')]
+    years = range(y0, y1 + 1)
+    tdays = getTransitionDays(years)
+    odays = [datetime.datetime(y, m, 15) for y in years for m in (1, 4, 7, 10)]
+    values = getValues(tdays + odays, opts.step)
+    print("%s: %d DST changes in %s, %d test values" % (opts.tz, len(tdays), opts.years, len(values)))
+
+    # twice: once filling the day cache, once using it
+    for rnd in (1, 2):
+        for s in values:
+            a, b = original(s), adfLib.getTimeStamp(s)
+            if a != b:
+                raise RuntimeError("Round %d: %s converts to %s, not %s" % (rnd, s, b, a))
+    if adfLib.getTimeStamps(values + [None]) != [original(s) for s in values] + [None]:
+        raise RuntimeError("getTimeStamps differs from getTimeStamp")
+    ndst = len([d for d, tz in adfLib.tzByDay.items() if tz is None])
+    print("All values identical. %d days cached, %d of them with a DST change." % (len(adfLib.tzByDay), ndst))
+
+    n = len(values)
+    print("%-14s %12s" % ("method", "values/s"))
+    print("%-14s %12.0f" % ("original", rate(n, lambda: [original(s) for s in values])))
+    print("%-14s %12.0f" % ("getTimeStamp", rate(n, lambda: [adfLib.getTimeStamp(s) for s in values])))
+    print("%-14s %12.0f" % ("getTimeStamps", rate(n, lambda: adfLib.getTimeStamps(values))))
+
+if __name__ == "__main__":
+    main()
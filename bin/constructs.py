@@ -22,41 +22,49 @@
 #
 
 import sys
-import db
-import json
 import re
 import argparse
-from adfLib import getHeaderAttributes, symbolToHtml, indexResults, getDataProviderDto, mainQuery, log, setCommonFields
+from adfLib import emit, symbolToHtml, indexResults, getDataProviderDto, mainQuery, log, setCommonFields, shared, sql, getPreferredRefId, resolveRefIds
+
+# The tables this generator reads, for change detection (see manifest.py).
+TABLES = ["ACC_Accession", "ALL_Allele", "MGI_Note", "MGI_Organism", "MGI_Relationship", "MGI_Relationship_Property",
+    "MRK_Marker", "VOC_Annot", "VOC_Term"]
 
 MUTATION_INVOLVES_cat_key = 1003
 EXPRESSES_cat_key = 1004
 DRIVER_cat_key = 1006
 ALL_cat_keys = "1003,1004,1006"
 
+# The lookups below are shared loaders, handed on by the pipeline from the constructs part to the parts
+# that depend on it (see pipeline.py), so they return their results rather than filling these directly.
 mk2nmdId = {} # marker key -> non-mouse ID
-def loadNonMouseGeneIds () :
-    for r in db.sql(qConstructNonMouseComponents):
-        mk2nmdId[r['_marker_key']] = r['accid']
-
-rk2id = {} # _refs_key -> either PMID or MGI id
-def loadRefIds () :
-    for r in db.sql(qConstructRefs):
-        rk2id[r['_refs_key']] = ('PMID:' + r['pmid']) if r['pmid'] else r['mgiid']
-        
 rk2note = {} # _relationship_key -> note obj
-def loadConstructNotes () :
-    for n in db.sql(qConstructNotes):
-        rk2note[n['_relationship_key']] = n
+
+# Returns dict from marker key to non-mouse gene ID.
+@shared
+def getNonMouseGeneIds () :
+    d = {}
+    for r in sql(qConstructNonMouseComponents):
+        d[r['_marker_key']] = r['accid']
+    return d
+
+# Returns dict from relationship key to note record.
+@shared
+def getConstructNotes () :
+    d = {}
+    for n in sql(qConstructNotes):
+        d[n['_relationship_key']] = n
         # some notes mistakenly surrounded by double quote characters
         # remove them here
         if n['note'].startswith('"') and n['note'].endswith('"'):
             n['note'] = n['note'][1:-1]
-    log("Loaded notes for %d constructs." % len(rk2note))
+    log("Loaded notes for %d constructs." % len(d))
+    return d
 
 def loadRelationship (key) :
     rels = []
     # read the relationships 
-    for r in db.sql(tConstructRelationships % key):
+    for r in sql(tConstructRelationships, args=(key,)):
         rk = r['_relationship_key']
         rels.append(r)
     return rels
@@ -109,7 +117,7 @@ def rel2constrComp (r, construct_id) :
           "relation_name": reln,
           "genomic_entity_identifier": gid,
           "evidence_curies": [
-            rk2id[r['_refs_key']]
+            getPreferredRefId(r['_refs_key'])
           ],  
         }
         if note_dto: rval["note_dtos"] = [ note_dto ]
@@ -121,7 +129,7 @@ def rel2constrComp (r, construct_id) :
             "relation_name" : reln,
             "component_symbol" : symbol,
             "evidence_curies": [
-              rk2id[r['_refs_key']]
+              getPreferredRefId(r['_refs_key'])
             ],  
         }
         if note_dto: rval["note_dtos"] = [ note_dto ]
@@ -138,9 +146,10 @@ def getOpts () :
     return parser.parse_args()
 
 # Returns mapping from allele MGI id to list of relationship records for components.
+@shared
 def getAlleleConstructRelationships () :
     knockdowns = set()
-    for r in db.sql(qKnockdownAlleles):
+    for r in sql(qKnockdownAlleles):
         knockdowns.add(r['_allele_key'])
 
     aid2rels = {}
@@ -155,21 +164,19 @@ def getAlleleConstructRelationships () :
     
 def main () :
     opts = getOpts()
-    loadNonMouseGeneIds()
-    loadRefIds()
-    loadConstructNotes()
+    output(opts.type)
+
+# Yields the construct objects (otype == "constructs") or construct associations (otype == "associations").
+def getConstructObjects (otype) :
+    global mk2nmdId, rk2note
+    mk2nmdId = getNonMouseGeneIds()
+    rk2note = getConstructNotes()
     # Get all relationship records for alleles (expresses-component and driven-by).
     # Then aggregate them into a single list of components per allele.
     aid2rels = getAlleleConstructRelationships()
+    resolveRefIds([r['_refs_key'] for rels in aid2rels.values() for r in rels])
     aids = list(aid2rels.keys())
     #
-    print('{')
-    print(getHeaderAttributes())
-    if opts.type == "constructs":
-        print('"construct_ingest_set": [')
-    else:
-        print('"construct_genomic_entity_association_ingest_set": [')
-    first=True
     for aid in aids:
         construct_id = aid + '_con'
         arels = aid2rels[aid]
@@ -198,14 +205,12 @@ def main () :
                maxUpdatedDate = obj["date_updated"]
                maxUpdatedBy = obj["created_by_curie"]
 
-        if opts.type == "associations":
+        if otype == "associations":
             for a in cgassocs:
-                if not first: print(",", end=' ')
-                first = False
-                print(json.dumps(a, indent=2))
+                yield a
             continue
 
-        # else opts.type == "constructs"...
+        # else otype == "constructs"...
         symbol = symbolToHtml(arels[0]["allelesymbol"]) + ' construct'
         obj = {
           "internal" : False,
@@ -224,12 +229,16 @@ def main () :
           "data_provider_dto": getDataProviderDto(aid, "allele"),
         }
         if len(ccomps): obj["construct_component_dtos"] = ccomps
-        #
-        if not first: print(",", end=' ')
-        print(json.dumps(obj, indent=2))
-        first=False
-        #
-    print("]}")
+        yield obj
+
+# Writes the constructs (otype == "constructs") or construct associations (otype == "associations") file
+# to sink (default: stdout).
+def output (otype, sink=None) :
+    if otype == "constructs":
+        name = "construct_ingest_set"
+    else:
+        name = "construct_genomic_entity_association_ingest_set"
+    emit([(name, getConstructObjects(otype))], sink, indent=2)
 
 #
 
@@ -244,6 +253,7 @@ qKnockdownAlleles = '''
     AND t.term = 'Knockdown'
 '''
 
+# Relationships of a category. Parameter: category key (see loadRelationship).
 tConstructRelationships = ''' 
     SELECT 
         r._relationship_key,
@@ -328,25 +338,6 @@ qConstructNonMouseComponents = '''
     AND a.preferred = 1
     ''' % ALL_cat_keys
 
-# query to return all construct association references
-qConstructRefs = '''
-    SELECT DISTINCT r._refs_key, a1.accid as mgiid, a2.accid as pmid
-    FROM
-        MGI_Relationship r
-        JOIN ACC_Accession a1
-            ON r._refs_key = a1._object_key
-            AND a1._mgitype_key = 1
-            AND a1._logicaldb_key = 1
-            AND a1.preferred = 1
-            AND a1.prefixPart = 'MGI:'
-        LEFT JOIN ACC_Accession a2
-            ON r._refs_key = a2._object_key
-            AND a2._mgitype_key = 1
-            AND a2._logicaldb_key = 29
-            AND a2.preferred = 1
-    WHERE r._category_key in (%s)
-''' % ALL_cat_keys
-
 # query to returns notes attached to construct associations
 qConstructNotes = '''
     SELECT r._relationship_key, n.*
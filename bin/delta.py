@@ -0,0 +1,198 @@
+#
+# delta.py
+#
+# Incremental ("delta") generation, driven by modification_date.
+#
+# A full run builds every object from scratch. In delta mode, a part's objects are kept from run to run in
+# a store (an sqlite file next to the output, ${root}_${ftype}.delta.sqlite): for each object, keyed by its
+# database key, its JSON and a digest of it. The store also records a watermark, the time up to which the
+# database had been seen. The next run then:
+#   - finds the keys of the objects whose data may have changed since the watermark: the generator's
+#     change queries select the keys of objects that have a row (the object itself, or one of its notes,
+#     synonyms, accession ids, relationships...) with a later modification_date;
+#   - finds the current keys (the generator's key query), to spot objects that appeared or disappeared;
+#   - builds just the changed and new objects (the generator's build function, with its loaders
+#     restricted to those keys; see adfLib.sqlForKeys), and removes the ones that are gone;
+#   - writes either the full file, merged from the store (mode "merged"), or just the objects whose JSON
+#     actually changed (mode "changed"; uploads of such files must pass cleanUp=false, see isComplete).
+# So the time a run takes grows with the amount of change rather than with the size of the database.
+#
+# The watermark is the database's dump date (mgi_dbinfo.lastdump_date) less DELTA_OVERLAP_HOURS, so
+# changes committed around dump time are looked at twice rather than missed.
+#
+# Deleting a row (a synonym, say) doesn't leave a modification_date behind, so it is only noticed when
+# something else about the object changes. To bound that, and anything else modification dates miss, a
+# full build is done when the store is more than DELTA_FULL_DAYS old, was built by different code or
+# for a different schema version, or when one of the generator's input files (e.g. the Panther file)
+# has changed since. A full build writes every object, in mode "changed" too, and the file is then
+# uploaded with cleanup, so objects removed from the database leave the site at least that often.
+# Objects are written in key order in delta mode.
+#
+import os
+import json
+import time
+import sqlite3
+import hashlib
+from adfLib import log, sql, emit
+from manifest import getCodeDigest, getFileStats
+
+DELTA_MODES = ['merged', 'changed']
+DELTA_OVERLAP_HOURS = int(os.environ.get('DELTA_OVERLAP_HOURS', '24'))
+DELTA_FULL_DAYS = float(os.environ.get('DELTA_FULL_DAYS', '7'))
+DELTA_BATCH = 1000
+
+# Set by pipeline.py (--delta).
+DELTA_MODE = ''
+
+encodeCompact = json.JSONEncoder(separators=(',', ':')).encode
+
+def getStoreFileName (fname) :
+    for ext in ['.ndjson', '.json']:
+        if fname.endswith(ext):
+            fname = fname[:-len(ext)]
+    return fname + '.delta.sqlite'
+
+# Returns the watermark for this run: the dump date less the overlap, as text.
+def getWatermark () :
+    q = "SELECT (lastdump_date - interval '%d hours')::text AS watermark FROM mgi_dbinfo" % DELTA_OVERLAP_HOURS
+    return sql(q, cache=False)[0]['watermark']
+
+# The objects of one part, from the last run.
+class DeltaStore :
+    def __init__ (self, fname) :
+        self.fname = fname
+        self.db = sqlite3.connect(fname)
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS dtos (setname TEXT, key INTEGER, digest TEXT, json TEXT, PRIMARY KEY (setname, key))')
+
+    def getMeta (self, name) :
+        r = self.db.execute('SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+        return r[0] if r else None
+
+    def setMeta (self, name, value) :
+        self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (name, value))
+
+    def getKeys (self, setname) :
+        return set([r[0] for r in self.db.execute('SELECT key FROM dtos WHERE setname = ?', (setname,))])
+
+    # Returns dict from key to digest, for the given keys.
+    def getDigests (self, setname, keys) :
+        q = 'SELECT key, digest FROM dtos WHERE setname = ? AND key IN (%s)' % ','.join(['?'] * len(keys))
+        return dict(self.db.execute(q, [setname] + list(keys)).fetchall())
+
+    # Saves objects, given as (key, json) pairs. Returns the keys of those whose json changed.
+    def put (self, setname, items) :
+        old = self.getDigests(setname, [k for (k, j) in items])
+        rows = []
+        changed = []
+        for (k, j) in items:
+            d = hashlib.sha1(j.encode('utf-8')).hexdigest()
+            if old.get(k) != d:
+                rows.append((setname, k, d, j))
+                changed.append(k)
+        self.db.executemany('INSERT OR REPLACE INTO dtos VALUES (?, ?, ?, ?)', rows)
+        return changed
+
+    def delete (self, setname, keys) :
+        self.db.executemany('DELETE FROM dtos WHERE setname = ? AND key = ?', [(setname, k) for k in keys])
+
+    # Yields the stored objects (decoded), in key order; only those with the given keys, if keys is given.
+    def iterObjects (self, setname, keys=None) :
+        if keys is None:
+            for (j,) in self.db.execute('SELECT json FROM dtos WHERE setname = ? ORDER BY key', (setname,)):
+                yield json.loads(j)
+            return
+        keys = sorted(keys)
+        for i in range(0, len(keys), DELTA_BATCH):
+            chunk = keys[i:i + DELTA_BATCH]
+            q = 'SELECT json FROM dtos WHERE setname = ? AND key IN (%s) ORDER BY key' % ','.join(['?'] * len(chunk))
+            for (j,) in self.db.execute(q, [setname] + chunk):
+                yield json.loads(j)
+
+    def commit (self) :
+        self.db.commit()
+
+    def close (self) :
+        self.db.close()
+
+# Returns whether the file last written from the store at fname (see getStoreFileName) holds all of the
+# part's objects, i.e. it was written in mode "merged", or by a full build.
+def isComplete (fname) :
+    if not os.path.exists(fname):
+        return False
+    store = DeltaStore(fname)
+    try:
+        return store.getMeta('complete') == '1'
+    finally:
+        store.close()
+
+# Returns the set of keys returned by the change queries for rows modified after the watermark.
+# Each change query selects a single column of keys, and has one parameter (%s), the watermark.
+def getChangedKeys (queries, since) :
+    keys = set()
+    for q in queries:
+        for r in sql(q, args=(since,)):
+            keys.add(list(r.values())[0])
+    return keys
+
+# Generates one ingest set in delta mode, writing it to sink.
+#   store       the part's DeltaStore
+#   setname     the ingest set name
+#   keyQuery    query returning the keys of all the objects in the set (in a column named keyCol)
+#   keyCol      name of the key column
+#   changeQueries   see getChangedKeys
+#   build       function taking a collection of keys (or None, for all) and yielding (key, object) pairs
+#   mode        "merged" or "changed"
+#   sink, indent    as for emit
+#   files       the input files read by the build; a change to any of them forces a full build
+def outputDelta (store, setname, keyQuery, keyCol, changeQueries, build, mode, sink=None, indent=None, files=()) :
+    t0 = time.time()
+    watermark = getWatermark()
+    version = "%s/%s" % (os.environ.get('AGR_CURATION_SCHEMA_VERSION', ''), getCodeDigest())
+    inputs = json.dumps(dict([(f, getFileStats(f)) for f in files]), sort_keys=True)
+    since = store.getMeta('watermark')
+    built = store.getMeta('full_build_time')
+    stored = store.getKeys(setname)
+    full = (since is None or store.getMeta('version') != version or (store.getMeta('inputs') or '{}') != inputs
+        or not built or time.time() - float(built) > DELTA_FULL_DAYS * 86400)
+    if full:
+        log("Delta: full build of %s (store %s)" % (setname, store.fname))
+        keys = None
+    else:
+        current = set([r[keyCol] for r in sql('SELECT %s FROM (%s) _k' % (keyCol, keyQuery), cache=False)])
+        changed = getChangedKeys(changeQueries, since) & current
+        keys = changed | (current - stored)
+        log("Delta: %s since %s: %d of %d objects to rebuild (%d changed, %d new), %d removed" % (setname, since,
+            len(keys), len(current), len(changed), len(current - stored), len(stored - current)))
+    seen = set()
+    changedKeys = []
+    batch = []
+    for (k, o) in build(keys):
+        seen.add(k)
+        batch.append((k, encodeCompact(o)))
+        if len(batch) >= DELTA_BATCH:
+            changedKeys += store.put(setname, batch)
+            batch = []
+    changedKeys += store.put(setname, batch)
+    removed = (stored - seen) if full else (stored - current)
+    # A key to rebuild that no longer yields an object (filtered out by the build) is gone too.
+    if not full:
+        removed |= (keys - seen) & stored
+    store.delete(setname, removed)
+    log("Delta: %s: %d objects rebuilt, %d changed, %d removed, in %.1f seconds" % (setname, len(seen), len(changedKeys), len(removed), time.time() - t0))
+    # Until a file of them all is uploaded with cleanup, removed objects stay on the site.
+    complete = (mode != 'changed' or full)
+    if complete:
+        objs = store.iterObjects(setname)
+    else:
+        if removed:
+            log("Delta: %d objects of %s were removed; they stay on the site until the next full build's upload." % (len(removed), setname))
+        objs = store.iterObjects(setname, changedKeys)
+    emit([(setname, objs)], sink, indent=indent)
+    store.setMeta('watermark', watermark)
+    store.setMeta('version', version)
+    store.setMeta('inputs', inputs)
+    store.setMeta('complete', '1' if complete else '0')
+    if full:
+        store.setMeta('full_build_time', str(time.time()))
+    store.commit()
@@ -0,0 +1,267 @@
+#
+# diffOutput.py
+#
+# Reports what changed between two runs' output files, e.g. the last submission and the one about to
+# be uploaded: for each ingest set, the records added, removed and changed, and for the changed ones,
+# which fields changed, how often, and (for single-valued fields) from what to what.
+#
+# Files of any size are compared in bounded memory:
+#   - each file is streamed (as validateFiles.py does) and its records written, with their keys, to an
+#     sqlite file in a temporary directory; the two files are loaded in parallel, by two processes;
+#   - sqlite sorts each by (ingest set, key), spilling to temporary files as it needs to (an external sort);
+#   - the two sorted streams are merge-joined by key. Records whose JSON text is identical are
+#     counted as unchanged without being decoded; the others are decoded and compared field by field.
+# What is kept in memory is the counts, at most MAX_TRANSITIONS value changes per field and a few
+# example keys per kind of change. With -o, every difference is also written to a file, one per line.
+#
+# A record's key is its primary ID (primary_external_id, mod_entity_id, curie or mod_internal_id; see
+# validator.ID_FIELDS). Association records have none; their key is made of their *_identifier fields
+# and relation name. Records with the same key in one set are paired in the order they appear.
+#
+# The files can be in any of the output formats (see adfLib.OUTPUT_FORMATS), and gzipped; they need not
+# be in the same format. Reports the time and throughput (records/s, MB/s) of loading and of comparing.
+#
+# Usage:
+#   python diffOutput.py [-e 5] [-o changes.ndjson] [-T /big/tmp] old/MGI_ps_gene.json new/MGI_ps_gene.json
+#
+import os
+import json
+import time
+import shutil
+import sqlite3
+import tempfile
+import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from adfLib import log
+from validator import ID_FIELDS
+from validateFiles import openFile, isNdjson, iterSubmission, iterNdjson
+
+LOAD_BATCH = 5000           # records per insert
+CACHE_KB = 65536            # sqlite page cache, per database
+MAX_TRANSITIONS = 1000      # distinct value changes counted per field; the rest count as (other)
+MAX_VALUE_LENGTH = 60       # value changes show values up to this long
+
+# Fields that, with the *_identifier fields, make up the key of an association record.
+KEY_FIELDS = ['relation_name']
+
+# ---------------------------------------
+# Loading
+
+# Returns the key of a record, as text.
+def getKey (dto) :
+    for f in ID_FIELDS:
+        if dto.get(f):
+            return str(dto[f])
+    parts = ['%s=%s' % (k, v) for (k, v) in sorted(dto.items())
+        if (k.endswith('_identifier') or k in KEY_FIELDS) and not isinstance(v, (list, dict))]
+    return '|'.join(parts)
+
+# Reads a submission or NDJSON file into a new sqlite database, dbfile. Returns (records, bytes, seconds).
+# Runs in a worker process.
+def loadFile (fname, dbfile) :
+    t0 = time.time()
+    db = sqlite3.connect(dbfile)
+    db.execute('PRAGMA journal_mode = OFF')
+    db.execute('PRAGMA synchronous = OFF')
+    db.execute('PRAGMA cache_size = -%d' % CACHE_KB)
+    db.execute('CREATE TABLE recs (setname TEXT, key TEXT, seq INTEGER, json TEXT)')
+    n = 0
+    size = 0
+    batch = []
+    with openFile(fname) as fd:
+        records = iterNdjson(fd, fname) if isNdjson(fname) else iterSubmission(fd)
+        for (name, text) in records:
+            text = text.strip()
+            batch.append((name, getKey(json.loads(text)), n, text))
+            n += 1
+            size += len(text)
+            if len(batch) >= LOAD_BATCH:
+                db.executemany('INSERT INTO recs VALUES (?, ?, ?, ?)', batch)
+                batch = []
+    db.executemany('INSERT INTO recs VALUES (?, ?, ?, ?)', batch)
+    db.commit()
+    db.close()
+    return n, size, time.time() - t0
+
+# Yields ((setname, key, occurrence), text) for the records of a loaded file, sorted.
+# occurrence numbers the records with the same set and key, in file order.
+def iterSorted (dbfile) :
+    db = sqlite3.connect(dbfile)
+    db.execute('PRAGMA cache_size = -%d' % CACHE_KB)
+    db.execute('PRAGMA temp_store = FILE')
+    last = None
+    occ = 0
+    for (setname, key, text) in db.execute('SELECT setname, key, json FROM recs ORDER BY setname, key, seq'):
+        occ = occ + 1 if (setname, key) == last else 0
+        last = (setname, key)
+        yield (setname, key, occ), text
+    db.close()
+
+# ---------------------------------------
+# Comparing
+
+def shorten (v) :
+    s = v if isinstance(v, str) else json.dumps(v)
+    return s if len(s) <= MAX_VALUE_LENGTH else s[:MAX_VALUE_LENGTH - 3] + '...'
+
+# Counts of one field's changes, within one ingest set.
+class FieldStats :
+    def __init__ (self) :
+        self.added = 0          # records that gained the field
+        self.removed = 0        # records that lost it
+        self.changed = 0        # records where its value changed
+        self.itemsAdded = 0     # for list values: items gained
+        self.itemsRemoved = 0   # ... and lost
+        self.transitions = Counter()
+
+    def count (self, old, new) :
+        if old is None:
+            self.added += 1
+        elif new is None:
+            self.removed += 1
+        else:
+            self.changed += 1
+        if isinstance(old, list) or isinstance(new, list):
+            oldItems = Counter([json.dumps(i, sort_keys=True) for i in old or []])
+            newItems = Counter([json.dumps(i, sort_keys=True) for i in new or []])
+            self.itemsAdded += sum((newItems - oldItems).values())
+            self.itemsRemoved += sum((oldItems - newItems).values())
+        elif not isinstance(old, dict) and not isinstance(new, dict):
+            t = (shorten(old), shorten(new))
+            if t in self.transitions or len(self.transitions) < MAX_TRANSITIONS:
+                self.transitions[t] += 1
+            else:
+                self.transitions[('(other)', '(other)')] += 1
+
+# Counts of one ingest set's differences.
+class SetStats :
+    def __init__ (self, maxExamples) :
+        self.old = 0
+        self.new = 0
+        self.counts = Counter()     # added, removed, changed, unchanged
+        self.examples = {}          # from kind of change to a few keys
+        self.fields = {}            # from field name to FieldStats
+        self.maxExamples = maxExamples
+
+    def count (self, kind, key) :
+        self.counts[kind] += 1
+        if kind != 'unchanged':
+            ex = self.examples.setdefault(kind, [])
+            if len(ex) < self.maxExamples:
+                ex.append(key)
+
+# Returns the names of the top level fields that differ between two records.
+def getChangedFields (old, new) :
+    return sorted([f for f in set(old) | set(new) if old.get(f) != new.get(f)])
+
+# Merge-joins two sorted record streams (see iterSorted). Returns dict from set name to SetStats.
+# If out is given, writes each difference to it, as a line of JSON.
+def compare (oldRecs, newRecs, maxExamples, out=None) :
+    stats = {}
+    def getStats (setname) :
+        if setname not in stats:
+            stats[setname] = SetStats(maxExamples)
+        return stats[setname]
+    def record (kind, k, fields=None) :
+        getStats(k[0]).count(kind, k[1])
+        if out and kind != 'unchanged':
+            d = {"set": k[0], "key": k[1], "change": kind}
+            if k[2]:
+                d["occurrence"] = k[2]
+            if fields is not None:
+                d["fields"] = fields
+            out.write(json.dumps(d) + '\n')
+    END = None
+    a = next(oldRecs, END)
+    b = next(newRecs, END)
+    while a is not END or b is not END:
+        if b is END or (a is not END and a[0] < b[0]):
+            getStats(a[0][0]).old += 1
+            record('removed', a[0])
+            a = next(oldRecs, END)
+        elif a is END or b[0] < a[0]:
+            getStats(b[0][0]).new += 1
+            record('added', b[0])
+            b = next(newRecs, END)
+        else:
+            s = getStats(a[0][0])
+            s.old += 1
+            s.new += 1
+            if a[1] == b[1]:
+                record('unchanged', a[0])
+            else:
+                old = json.loads(a[1])
+                new = json.loads(b[1])
+                fields = getChangedFields(old, new)
+                if fields:
+                    for f in fields:
+                        s.fields.setdefault(f, FieldStats()).count(old.get(f), new.get(f))
+                    record('changed', a[0], fields)
+                else:
+                    record('unchanged', a[0])   # same content, formatted differently
+            a = next(oldRecs, END)
+            b = next(newRecs, END)
+    return stats
+
+# ---------------------------------------
+# Report
+
+def report (stats, maxTransitions) :
+    for setname in sorted(stats):
+        s = stats[setname]
+        c = s.counts
+        print("%s: %d old, %d new: %d added, %d removed, %d changed, %d unchanged" % (setname,
+            s.old, s.new, c['added'], c['removed'], c['changed'], c['unchanged']))
+        if s.fields:
+            print("  %-40s %9s %9s %9s %12s %12s" % ("field", "added", "removed", "changed", "items added", "items removed"))
+        for f in sorted(s.fields, key=lambda f: -(s.fields[f].added + s.fields[f].removed + s.fields[f].changed)):
+            fs = s.fields[f]
+            print("  %-40s %9d %9d %9d %12s %12s" % (f, fs.added, fs.removed, fs.changed,
+                fs.itemsAdded or '', fs.itemsRemoved or ''))
+            for ((old, new), n) in fs.transitions.most_common(maxTransitions):
+                print("      %9d  %s -> %s" % (n, old, new))
+        for kind in ['added', 'removed', 'changed']:
+            if kind in s.examples:
+                print("  e.g. %s: %s" % (kind, ", ".join(s.examples[kind])))
+
+def getOpts () :
+    parser = argparse.ArgumentParser()
+    parser.add_argument('old',help="The earlier file (.json or .ndjson, optionally gzipped).")
+    parser.add_argument('new',help="The later file.")
+    parser.add_argument('-e','--examples',type=int,default=5,help="Example keys shown per kind of change (default: 5).")
+    parser.add_argument('-t','--transitions',type=int,default=10,help="Value changes shown per field (default: 10).")
+    parser.add_argument('-o','--output',default=None,help="Write every difference to this file, one JSON object per line.")
+    parser.add_argument('-T','--tmpdir',default=None,help="Directory for the temporary databases and sort files (default: the system's).")
+    return parser.parse_args()
+
+def main () :
+    opts = getOpts()
+    tmpdir = tempfile.mkdtemp(prefix='diffOutput.', dir=opts.tmpdir)
+    # sqlite puts its sort files here.
+    os.environ['SQLITE_TMPDIR'] = tmpdir
+    dbfiles = [os.path.join(tmpdir, 'old.sqlite'), os.path.join(tmpdir, 'new.sqlite')]
+    try:
+        log("Loading %s and %s" % (opts.old, opts.new))
+        with ProcessPoolExecutor(max_workers=2) as pool:
+            loads = [pool.submit(loadFile, f, d) for (f, d) in zip([opts.old, opts.new], dbfiles)]
+            for (f, l) in zip([opts.old, opts.new], loads):
+                n, size, secs = l.result()
+                log("Loaded %s: %d records, %.1f MB in %.1f seconds, %.0f records/s, %.1f MB/s" % (f, n, size / 1e6,
+                    secs, n / max(secs, 0.001), size / 1e6 / max(secs, 0.001)))
+        t0 = time.time()
+        out = open(opts.output, 'w') if opts.output else None
+        try:
+            stats = compare(iterSorted(dbfiles[0]), iterSorted(dbfiles[1]), opts.examples, out)
+        finally:
+            if out:
+                out.close()
+        secs = max(time.time() - t0, 0.001)
+        n = sum([s.old + s.new for s in stats.values()])
+        log("Compared %d records in %.1f seconds, %.0f records/s" % (n, secs, n / secs))
+        report(stats, opts.transitions)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,16 @@
 
 import sys
-import db
-import json
 import re
+import argparse
 from genes import getSubmittedGeneIds
-from adfLib import getHeaderAttributes, symbolToHtml, getDataProviderDto, mainQuery, getTimeStamp, setCommonFields
+from adfLib import emit, symbolToHtml, getDataProviderDto, getTimeStamp, setCommonFields, sql
+import partition
 
-def getDiseaseAnnotations (cfg) :
+# The tables this generator reads, for change detection (see manifest.py).
+TABLES = ["ACC_Accession", "MGI_Note", "MRK_Marker", "VOC_Annot", "VOC_Evidence", "VOC_Evidence_Property", "VOC_Term"]
+
+# Returns the query for the disease annotations of one kind (see output): a row per annotation and evidence.
+def getDiseaseAnnotationsQuery (cfg) :
     q = '''
         SELECT
             va._annot_key,
@@ -47,7 +51,10 @@ def getDiseaseAnnotations (cfg) :
         AND ra._logicaldb_key = 1
         AND ra.accid like 'MGI:%%'
         ''' % cfg
-    return db.sql(q, 'auto')
+    return q
+
+# The rows of an annotation are ordered by these, after _annot_key.
+ANNOTATION_ORDER = ["_annotevidence_key", "mgipubid", "pmid"]
 
 # Returns a mapping from _annot_key to inferred_allele/inferred_gene.
 # The query works by seeing if an _annot_key matches a back-reference for
@@ -63,7 +70,7 @@ def getRollups ():
         where _marker_type_key = 12
         '''
     mouseTgKeys = set()
-    for r in db.sql(q):
+    for r in sql(q):
         mouseTgKeys.add(r['_marker_key'])
 
     annotKey2inferred = {}
@@ -111,7 +118,7 @@ def getRollups ():
     #
     for cfg in cfgs:
         fieldname = cfg['fieldname']
-        for r in db.sql(q % cfg, 'auto'):
+        for r in sql(q % cfg, 'auto'):
             ak = r['_annot_key']
             mgiid = r['accid']
             inferreds = annotKey2inferred.setdefault(ak, {})
@@ -141,7 +148,7 @@ def getPrivateCuratorNotes (cfg) :
         AND va._annottype_key                   = %(_annottype_key)d
         ''' % cfg
     ek2note = {}
-    for r in db.sql(q, 'auto'):
+    for r in sql(q, 'auto'):
         ek2note[r['_object_key']] = r['note']
     return ek2note
 
@@ -178,7 +185,8 @@ def getJsonObject (cfg, r, ek2note, annotKey2inferred, submittedGeneIds) :
     #
     return obj
 
-def main () :
+# Writes the disease annotations file to sink (default: stdout).
+def output (sink=None) :
     submittedGeneIds = getSubmittedGeneIds()
     annotKey2inferred = getRollups()
     cfg = {
@@ -198,18 +206,22 @@ def main () :
         }
     }
 
-    print('{')
-    print(getHeaderAttributes())
-    for i, (section, scfg) in enumerate(cfg.items()):
+    # Yields the annotations of one section, in order of annotation key, built by partition.WORKERS processes.
+    def annotations (section, scfg) :
         ek2note = getPrivateCuratorNotes(scfg)
-        if i: print(',', end='')
-        print('"%s": [' % section)
-        for j,r in mainQuery(getDiseaseAnnotations(scfg)):
-            if j: print(',', end='')
-            o = getJsonObject(scfg, r, ek2note, annotKey2inferred, submittedGeneIds)
-            print(json.dumps(o))
-        print(']')
-    print('}')
+        def build (rows) :
+            for r in rows:
+                yield getJsonObject(scfg, r, ek2note, annotKey2inferred, submittedGeneIds)
+        yield from partition.generate(section, getDiseaseAnnotationsQuery(scfg), "_annot_key", build, order=ANNOTATION_ORDER)
+    emit([(section, annotations(section, scfg)) for (section, scfg) in cfg.items()], sink)
+
+def getOpts () :
+    parser = argparse.ArgumentParser()
+    partition.addOptions(parser, "annotations")
+    return parser.parse_args()
+
+def main () :
+    partition.runGenerator(output, getOpts())
 
 if __name__ == "__main__":
     main()
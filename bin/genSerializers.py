@@ -0,0 +1,284 @@
+#
+# genSerializers.py
+#
+# Generates serializers.py: one function per DTO class in the Alliance curation (LinkML) schema,
+# turning a DTO (dict) into compact JSON. Each function writes the class's slots in the schema's order,
+# with code specialized for each slot's range (string, boolean, integer, nested DTO, list of these),
+# rather than having a generic encoder inspect every value.
+# The functions also check each DTO against the schema: a DTO with an attribute that is not a slot of its
+# class, or missing a required slot, raises SchemaDriftError. So when a new schema version renames or
+# drops a slot, a run fails on the first object rather than producing a file that fails validation.
+#
+# serializers.py maps each ingest set name (from the schema's *_ingest_set slots) to the serializer
+# for its DTO class. With USE_SERIALIZERS=1, emit() uses them for the compact and ndjson output formats
+# (see adfLib.getSetEncoder). It also maps each set to a checker that does just the schema check, which
+# emit() runs on the DTOs it writes with the generic encoder, so drift is caught whatever the format.
+# It also records the schema version it was generated from; emit() refuses to use it for another version.
+#
+# Run by Install, after checking out the schema. Requires PyYAML (installed in the venv).
+#
+# Usage:
+#   python genSerializers.py -s ../agr_curation_schema -V 2.15.0 [-o serializers.py]
+#
+import os
+import sys
+import glob
+import argparse
+import yaml
+
+# Ingest sets written by the generators in this product. Each must be in the schema.
+INGEST_SETS = [
+    "gene_ingest_set",
+    "allele_ingest_set",
+    "allele_gene_association_ingest_set",
+    "allele_construct_association_ingest_set",
+    "construct_ingest_set",
+    "construct_genomic_entity_association_ingest_set",
+    "agm_ingest_set",
+    "agm_allele_association_ingest_set",
+    "variant_ingest_set",
+    "disease_agm_ingest_set",
+    "disease_allele_ingest_set",
+]
+
+# How values of the LinkML built in types are written. Anything else (and any value of an unexpected
+# Python type) goes through the generic encoder.
+STRING_TYPES = set(["string", "str", "uriorcurie", "uri", "curie", "ncname", "objectidentifier", "nodeidentifier",
+    "date", "datetime", "time", "date_or_datetime", "jsonpointer", "jsonpath", "sparqlpath"])
+BOOLEAN_TYPES = set(["boolean", "bool"])
+INTEGER_TYPES = set(["integer", "int"])
+
+# The parts of a LinkML schema needed here, merged from all the schema's yaml files.
+class Schema :
+    def __init__ (self, sdir) :
+        self.classes = {}
+        self.slots = {}
+        self.types = {}
+        self.enums = {}
+        self.defaultRange = "string"
+        files = sorted(glob.glob(os.path.join(sdir, "model", "schema", "**", "*.yaml"), recursive=True))
+        if not files:
+            raise RuntimeError("No LinkML schema files under " + os.path.join(sdir, "model", "schema"))
+        for fname in files:
+            with open(fname) as fd:
+                y = yaml.safe_load(fd) or {}
+            for (attr, key) in [(self.classes, "classes"), (self.slots, "slots"), (self.types, "types"), (self.enums, "enums")]:
+                attr.update(y.get(key) or {})
+            if y.get("default_range") and y.get("name") == "allianceModel":
+                self.defaultRange = y["default_range"]
+
+    # Returns a list of the class's ancestors and itself, most general first.
+    def getLineage (self, cname) :
+        c = self.classes.get(cname)
+        if c is None:
+            raise RuntimeError("Class not in schema: " + cname)
+        c = c or {}
+        lineage = []
+        if c.get("is_a"):
+            lineage += self.getLineage(c["is_a"])
+        for m in c.get("mixins") or []:
+            lineage += [x for x in self.getLineage(m) if x not in lineage]
+        return lineage + [cname]
+
+    # Returns the class's slots, in order, as a list of (name, range, multivalued, required).
+    def getSlots (self, cname) :
+        names = []
+        usage = {}
+        for cn in self.getLineage(cname):
+            c = self.classes[cn] or {}
+            for s in c.get("slots") or []:
+                if s not in names:
+                    names.append(s)
+            for s, a in (c.get("attributes") or {}).items():
+                if s not in names:
+                    names.append(s)
+                usage.setdefault(s, {}).update(a or {})
+            for s, u in (c.get("slot_usage") or {}).items():
+                usage.setdefault(s, {}).update(u or {})
+        slots = []
+        for s in names:
+            d = dict(self.slots.get(s) or {})
+            d.update(usage.get(s, {}))
+            slots.append((s, d.get("range", self.defaultRange), bool(d.get("multivalued")), bool(d.get("required"))))
+        return slots
+
+    # Returns "class", "string", "boolean", "integer", or "other" for a slot range.
+    def getKind (self, rng) :
+        seen = set()
+        while rng in self.types and rng not in seen:
+            seen.add(rng)
+            rng = (self.types[rng] or {}).get("typeof", rng)
+        if rng in self.classes:
+            return "class"
+        if rng in self.enums or rng in STRING_TYPES:
+            return "string"
+        if rng in BOOLEAN_TYPES:
+            return "boolean"
+        if rng in INTEGER_TYPES:
+            return "integer"
+        return "other"
+
+    # Returns dict from ingest set name to DTO class name, from every *_ingest_set slot with a class range.
+    def getIngestSets (self) :
+        isets = {}
+        for cname in self.classes:
+            for (s, rng, multi, req) in self.getSlots(cname):
+                if s.endswith("_ingest_set") and self.getKind(rng) == "class":
+                    isets[s] = rng
+        return isets
+
+# Returns the expression (source code) that writes value v of the given kind.
+def valueExpr (schema, rng, kind, v) :
+    if kind == "string":
+        return "(esc(%s) if type(%s) is str else enc(%s))" % (v, v, v)
+    elif kind == "boolean":
+        return "('true' if %s is True else 'false' if %s is False else enc(%s))" % (v, v, v)
+    elif kind == "integer":
+        return "(repr(%s) if type(%s) is int else enc(%s))" % (v, v, v)
+    elif kind == "class":
+        return "(cached(%s, %s) if isinstance(%s, dict) else enc(%s))" % (funcName(rng), v, v, v)
+    return "enc(%s)" % v
+
+def funcName (cname) :
+    return "ser_" + cname
+
+def checkName (cname) :
+    return "chk_" + cname
+
+# Returns the source code for the serializer of one class.
+def genClass (schema, cname) :
+    slots = schema.getSlots(cname)
+    lines = []
+    lines.append("K_%s = frozenset(%r)" % (cname, sorted([s[0] for s in slots])))
+    lines.append("R_%s = frozenset(%r)" % (cname, sorted([s[0] for s in slots if s[3]])))
+    lines.append("def %s (o) :" % funcName(cname))
+    lines.append("    if not (o.keys() <= K_%s and R_%s <= o.keys()):" % (cname, cname))
+    lines.append("        drift(o, %r, K_%s, R_%s)" % (cname, cname, cname))
+    lines.append("    p = []")
+    for (s, rng, multi, req) in slots:
+        kind = schema.getKind(rng)
+        lines.append("    if %r in o:" % s)
+        lines.append("        v = o[%r]" % s)
+        if multi:
+            lines.append("        p.append(%r + ('[' + ','.join([%s for x in v]) + ']' if type(v) is list else enc(v)))"
+                % (esc(s) + ':', valueExpr(schema, rng, kind, "x")))
+        else:
+            lines.append("        p.append(%r + %s)" % (esc(s) + ':', valueExpr(schema, rng, kind, "v")))
+    lines.append("    return '{' + ','.join(p) + '}'")
+    # The same check on its own, for DTOs written by the generic encoder.
+    lines.append("def %s (o) :" % checkName(cname))
+    lines.append("    if not (o.keys() <= K_%s and R_%s <= o.keys()):" % (cname, cname))
+    lines.append("        drift(o, %r, K_%s, R_%s)" % (cname, cname, cname))
+    for (s, rng, multi, req) in slots:
+        if schema.getKind(rng) != "class":
+            continue
+        lines.append("    v = o.get(%r)" % s)
+        if multi:
+            lines.append("    if type(v) is list:")
+            lines.append("        for x in v:")
+            lines.append("            if isinstance(x, dict): checked(%s, x)" % checkName(rng))
+        else:
+            lines.append("    if isinstance(v, dict): checked(%s, v)" % checkName(rng))
+    return "\n".join(lines) + "\n"
+
+# Returns the names of the classes reachable from the given ones through class ranged slots.
+def getReachable (schema, cnames) :
+    todo = list(cnames)
+    seen = []
+    while todo:
+        cname = todo.pop(0)
+        if cname in seen:
+            continue
+        seen.append(cname)
+        for (s, rng, multi, req) in schema.getSlots(cname):
+            if schema.getKind(rng) == "class" and rng not in seen:
+                todo.append(rng)
+    return seen
+
+HEADER = '''#
+# serializers.py
+#
+# GENERATED by genSerializers.py from agr_curation_schema v%(version)s. Do not edit.
+#
+import json
+from json.encoder import encode_basestring_ascii as esc
+
+SCHEMA_VERSION = %(version)r
+
+enc = json.JSONEncoder(separators=(',', ':')).encode
+
+# Raised for a DTO that doesn't match its class in the schema.
+class SchemaDriftError (RuntimeError) :
+    pass
+
+def drift (o, cname, keys, required) :
+    msg = []
+    extra = sorted(set(o.keys()) - keys)
+    if extra:
+        msg.append("slots not in the schema: " + ", ".join(extra))
+    missing = sorted(required - set(o.keys()))
+    if missing:
+        msg.append("required slots missing: " + ", ".join(missing))
+    raise SchemaDriftError("%%s (schema %%s): %%s. Object: %%s" %% (cname, SCHEMA_VERSION, "; ".join(msg), enc(o)))
+
+# Serializes a nested DTO. One that can hold attributes (see adfLib.Fragment) keeps its serialized form.
+def cached (ser, v) :
+    d = getattr(v, '__dict__', None)
+    if d is None:
+        return ser(v)
+    t = d.get(ser.__name__)
+    if t is None:
+        t = d[ser.__name__] = ser(v)
+    return t
+
+# Checks a nested DTO. One that can hold attributes (see adfLib.Fragment) is only checked once.
+def checked (chk, v) :
+    d = getattr(v, '__dict__', None)
+    if d is None:
+        chk(v)
+    elif chk.__name__ not in d:
+        chk(v)
+        d[chk.__name__] = True
+
+'''
+
+def esc (s) :
+    return '"%s"' % s
+
+def generate (schema, version) :
+    isets = schema.getIngestSets()
+    missing = [s for s in INGEST_SETS if s not in isets]
+    if missing:
+        raise RuntimeError("Ingest sets not in schema v%s: %s" % (version, ", ".join(missing)))
+    classes = getReachable(schema, [isets[s] for s in INGEST_SETS])
+    parts = [HEADER % {"version": version}]
+    for cname in classes:
+        parts.append(genClass(schema, cname))
+    parts.append("INGEST_SETS = {\n")
+    for s in INGEST_SETS:
+        parts.append("    %r: %s,\n" % (s, funcName(isets[s])))
+    parts.append("}\n")
+    parts.append("CHECKERS = {\n")
+    for s in INGEST_SETS:
+        parts.append("    %r: %s,\n" % (s, checkName(isets[s])))
+    parts.append("}\n")
+    return "\n".join(parts), classes
+
+def getOpts () :
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s','--schema',required=True,help="Directory of the agr_curation_schema checkout.")
+    parser.add_argument('-V','--version',required=True,help="Schema version checked out there.")
+    parser.add_argument('-o','--output',default='serializers.py',help="Output file (default: serializers.py).")
+    return parser.parse_args()
+
+def main () :
+    opts = getOpts()
+    schema = Schema(opts.schema)
+    text, classes = generate(schema, opts.version)
+    compile(text, opts.output, 'exec')
+    with open(opts.output, 'w') as fd:
+        fd.write(text)
+    sys.stderr.write("Wrote %d serializers for schema v%s to %s\n" % (len(classes), opts.version, opts.output))
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,17 @@
 
-import db
-import json
 import re
+import argparse
 from subprocess import Popen
 
-from adfLib import getHeaderAttributes, symbolToHtml, getDataProviderDto, mainQuery, setCommonFields, getPreferredRefId
+from adfLib import emit, symbolToHtml, getDataProviderDto, getCrossReferenceDto, mainQuery, setCommonFields, getPreferredRefId, resolveRefIds, shared, prefetch, sql, streamSql, copySql, sqlForKeys, streamSqlForKeys
+import delta
+import partition
+
+# The tables this generator reads, and its input files, for change detection (see manifest.py).
+TABLES = ["ACC_Accession", "ACC_LogicalDB", "GXD_Expression", "MGI_Synonym", "MGI_SynonymType", "MRK_Label",
+    "MRK_Marker", "MRK_MCV_Cache", "MRK_Notes", "MRK_Reference", "VOC_Annot", "VOC_Term"]
+PANTHER_FILE = "RefGenomeOrthologs.tar.gz"
+INPUT_FILES = [PANTHER_FILE]
 
 # ----------------------------------------------------------
 # Mapping from MCV term key to SO id.
@@ -52,7 +59,7 @@ def initMCV2SO () :
             FROM VOC_Term
             WHERE _vocab_key = 79 /* MCV */
             ''' 
-    for r in db.sql(q):
+    for r in sql(q):
         m = so_re.search(r['note'])
         if m and r['_term_key'] not in MCV2SO:
              MCV2SO[r['_term_key']] = m.group(0)
@@ -62,13 +69,13 @@ def initMCV2SO () :
 
 def getMarkerIDs () :
     mid2mk = {}
-    for r in db.sql(qMgiIds):
+    for r in copySql(qMgiIds):
         mid2mk[r['mgiId']] = r['_marker_key']
     return mid2mk
 
-def getSecondaryIDs () :
+def getSecondaryIDs (keys=None) :
     mk2ids = {}
-    for r in db.sql(qMgiSecondaryIds):
+    for r in sqlForKeys(qMgiSecondaryIds, '_marker_key', keys):
         accid = r['mgiId']
         mk2ids.setdefault(r['_marker_key'],[]).append(accid)
     return mk2ids
@@ -76,12 +83,24 @@ def getSecondaryIDs () :
 # ----------------------------------------------------------
 # ----------------------------------------------------------
 
+PANTHERURL="https://data.pantherdb.org/ftp/ortholog/current_release/RefGenomeOrthologs.tar.gz"
+
+# Downloads the Panther file, if PantherDB has a newer one, and unpacks it.
+def downloadPantherFile () :
+    cmd = 'curl -o "%s" -z "%s" "%s"' % (PANTHER_FILE, PANTHER_FILE, PANTHERURL)
+    sp = Popen(cmd, shell=True)
+    rc = sp.wait()
+    # tar outputs file names to stdout. Redirect to /dev/null so these don't end up
+    # in the json file.
+    cmd = 'tar -xvf %s > /dev/null' % PANTHER_FILE
+    sp = Popen(cmd, shell=True)
+    rc = sp.wait()
+
 # Returns a mapping from marker keys to PantherIDs.
 # Unlike other cross refs, this data is not stored in MGD, but has to be downloaded from PantherDB.
 # The following code downloads a file containing Panther-id-to-MGI-id associations,
 # converts the MGI ids to marker keys, and returns a dictionary from marker keys to Panther ids.
 # 
-PANTHERURL="https://data.pantherdb.org/ftp/ortholog/current_release/RefGenomeOrthologs.tar.gz"
 def getPantherIDs () :
     def parseMouseId (s) :
         idPart = s.split("|")[1]
@@ -95,15 +114,7 @@ def getPantherIDs () :
         elif parts[1].startswith('MOUSE'):
             return (parseMouseId(parts[1]), pthrId)
 
-
-    cmd = 'curl -o "RefGenomeOrthologs.tar.gz" -z "RefGenomeOrthologs.tar.gz" "%s"' % PANTHERURL
-    sp = Popen(cmd, shell=True)
-    rc = sp.wait()
-    # tar outputs file names to stdout. Redirect to /dev/null so these don't end up
-    # in the json file.
-    cmd = 'tar -xvf RefGenomeOrthologs.tar.gz > /dev/null'
-    sp = Popen(cmd, shell=True)
-    rc = sp.wait()
+    downloadPantherFile()
 
     # get a map from MGI id to marker key
     mid2mk = getMarkerIDs()
@@ -124,20 +135,22 @@ def getPantherIDs () :
 # ----------------------------------------------------------
 # ----------------------------------------------------------
 
-# Returns a dictionary from name to set of marker keys.
-def getGeneSets () :
-    sets = [
-        (qGeneHasPhenotype,"hasPhenotype"),
-        (qGeneHasImpc,"hasImpc"),
-        (qGeneHasExpression,"hasExpression"),
-        (qGeneHasExpressionImage, "hasExpressionImage"),
-        ]
-    rval = {}
-    for (q,n) in sets:
-        rval[n] = qset = set()
-        for r in db.sql(q):
-            qset.add(r['_marker_key'])
-    return rval
+# Names of the gene sets (see getGeneSet).
+GENE_SETS = ["hasPhenotype", "hasImpc", "hasExpression", "hasExpressionImage"]
+
+# Returns the set of marker keys in the named gene set (only the given keys, if keys is not None).
+def getGeneSet (name, keys=None) :
+    q = {
+        "hasPhenotype" : qGeneHasPhenotype,
+        "hasImpc" : qGeneHasImpc,
+        "hasExpression" : qGeneHasExpression,
+        "hasExpressionImage" : qGeneHasExpressionImage,
+    }[name]
+    return set([r['_marker_key'] for r in sqlForKeys(q, '_marker_key', keys)])
+
+# Returns a dictionary from name to set of marker keys (only the given keys, if keys is not None).
+def getGeneSets (keys=None) :
+    return dict([(n, getGeneSet(n, keys)) for n in GENE_SETS])
 
 # ----------------------------------------------------------
 # Cross References
@@ -151,9 +164,9 @@ LDB2PREFIX = {
 }
 
 # build map from marker key to the list of xrefs for that marker
-def getXrefs () :
+def getXrefs (keys=None) :
     mk2xrefs = {}
-    for r in db.sql(qXrefs, 'auto'):
+    for r in sqlForKeys(qXrefs, '_marker_key', keys, copy=True):
         mk2xrefs.setdefault(r['_marker_key'], []).append(r)
     return mk2xrefs
 
@@ -174,40 +187,20 @@ def getFormattedXrefs (mkey, xrefs, gsets) :
             if mkey in gsets["hasImpc"]:
                 pgs.append('gene/phenotypes_impc')
             for pg in pgs:
-                xrDto = {
-                    "display_name" : xr["accid"],
-                    "referenced_curie" : xr["accid"],
-                    "page_area" : pg,
-                    "prefix" : "MGI",
-                    "internal" : False,
-                } 
-                xrs2.append(xrDto)
+                xrs2.append(getCrossReferenceDto(xr["accid"], "MGI", pg))
         else :
             prefix = LDB2PREFIX[xr["dbname"]]
-            xrDto = {
-                "display_name" : prefix + xr["accid"],
-                "referenced_curie" : prefix + xr["accid"],
-                "page_area" : "default",
-                "prefix" : prefix[:-1],
-                "internal" : False,
-            }
-            xrs2.append(xrDto)
+            xrs2.append(getCrossReferenceDto(prefix + xr["accid"], prefix[:-1]))
 
     pthrId = mk2panther.get(mkey,None)
     if pthrId:
-        xrs2.append({
-            "display_name": "PANTHER:" + pthrId,
-            "referenced_curie" : "PANTHER:" + pthrId,
-            "page_area" : "default",
-            "prefix" : "PANTHER",
-            "internal" : False,
-        })
+        xrs2.append(getCrossReferenceDto("PANTHER:" + pthrId, "PANTHER"))
     return xrs2
 
 # build map from marker key to the list of notes for that marker
-def getGeneNotes () :
+def getGeneNotes (keys=None) :
     gene_notes = {}
-    for r in db.sql(qGeneNotes, 'auto'):
+    for r in sqlForKeys(qGeneNotes, '_marker_key', keys):
         gene_notes.setdefault(r['_marker_key'], []).append(r)
     return gene_notes
 
@@ -232,11 +225,11 @@ def getGeneNoteDtos (mkey, gnotes) :
 
 # build map from marker key to list of synonyms. Combines synonyms in MGI_Synonym and former
 # nomenclature (symbols and names) from MRK_Label
-def getGeneSynonyms () :
+def getGeneSynonyms (keys=None) :
     gene_syns = {}
-    for r in db.sql(qGeneSynonyms, 'auto'):
+    for r in sqlForKeys(qGeneSynonyms, '_marker_key', keys):
         gene_syns.setdefault(r['_marker_key'], []).append(r)
-    for r in db.sql(qGeneOldLabels, 'auto'):
+    for r in sqlForKeys(qGeneOldLabels, '_marker_key', keys):
         syns = gene_syns.setdefault(r['_marker_key'], [])
         # Sometimes a former symbol (or name) is also curated as an exact synonym (often including a reference).
         # Check to see if that's the case, and if so, change the synonym type from "exact" to "old symbol" (or "old name").
@@ -247,6 +240,7 @@ def getGeneSynonyms () :
                 break
         else:
             syns.append(r)
+    resolveRefIds([s['_refs_key'] for syns in gene_syns.values() for s in syns])
     return gene_syns
 
 # get synonyms for a gene in dto format
@@ -315,30 +309,60 @@ def getJsonObject (r, xrefs, gsets, gnotes, gsynonyms, mk2secIds) :
 
     return obj
 
-def main () :
+# Loads the lookups used to build gene objects (just for the given marker keys, if keys is not None).
+# Returns them as a tuple of the arguments getJsonObject takes after the row.
+# The loaders are independent, so they run concurrently (see adfLib.prefetch), the slowest first.
+def loadGeneLookups (keys=None) :
     global mk2panther
-    initMCV2SO()
-    xrefs = getXrefs()
-    gsets = getGeneSets()
-    gnotes = getGeneNotes()
-    gsynonyms = getGeneSynonyms()
-    mk2panther = getPantherIDs()
-    mk2secIds = getSecondaryIDs()
-
-    print('{')
-    print(getHeaderAttributes())
-    print('"gene_ingest_set": [')
-    for j,r in mainQuery(db.sql(qGenes, 'auto')):
-        if j: print(',', end='')
-        o = getJsonObject(r, xrefs, gsets, gnotes, gsynonyms, mk2secIds)
-        print(json.dumps(o, indent=2))
-    print(']')
-    print('}')
+    results = prefetch(
+        (getPantherIDs,),
+        (getXrefs, keys),
+        (getGeneSynonyms, keys),
+        (getGeneNotes, keys),
+        (getSecondaryIDs, keys),
+        (initMCV2SO,),
+        *[(getGeneSet, n, keys) for n in GENE_SETS])
+    mk2panther, xrefs, gsynonyms, gnotes, mk2secIds = results[:5]
+    gsets = dict(zip(GENE_SETS, results[6:]))
+    return (xrefs, gsets, gnotes, gsynonyms, mk2secIds)
+
+# Yields (marker key, gene object) for the genes with the given marker keys, or for all genes if keys is None.
+def getGeneObjects (keys=None) :
+    lookups = loadGeneLookups(keys)
+    for j,r in mainQuery(streamSqlForKeys(qGenes, '_marker_key', keys)):
+        yield r["_marker_key"], getJsonObject(r, *lookups)
+
+# Returns the gene ingest set, in order of marker key, built by partition.WORKERS processes.
+def getIngestSets () :
+    lookups = loadGeneLookups()
+    def build (rows) :
+        for r in rows:
+            yield getJsonObject(r, *lookups)
+    return [("gene_ingest_set", partition.generate("gene_ingest_set", qGenes, "_marker_key", build, indent=2))]
+
+# Writes the genes file to sink (default: stdout).
+def output (sink=None) :
+    emit(getIngestSets(), sink, indent=2)
+
+# Writes the genes file in delta mode (see delta.py).
+# The Panther file is fetched first, so that a new one is seen, and forces a full build, in this run.
+def outputDelta (store, mode, sink=None) :
+    downloadPantherFile()
+    delta.outputDelta(store, "gene_ingest_set", qGenes, "_marker_key", qChangedGenes, getGeneObjects, mode, sink, indent=2, files=INPUT_FILES)
+
+def getOpts () :
+    parser = argparse.ArgumentParser()
+    partition.addOptions(parser, "genes")
+    return parser.parse_args()
+
+def main () :
+    partition.runGenerator(output, getOpts())
 
 # Returns the set of MGI ids for submitted genes
+@shared
 def getSubmittedGeneIds () :
     ids = set()
-    for r in db.sql(qGenes):
+    for r in streamSql(qGenes):
         ids.add(r['accid'])
     return ids
 # ----------------------------------------------------------
@@ -475,6 +499,21 @@ qGeneNotes = '''
     AND m._organism_key = 1 /* mouse, laboratory */
     '''
 
+# Delta mode: the keys of genes with data modified after a given time (see delta.py).
+qChangedGenes = [
+    "SELECT _marker_key FROM MRK_Marker WHERE modification_date > %s",
+    "SELECT _object_key FROM ACC_Accession WHERE _mgitype_key = 2 AND modification_date > %s",
+    "SELECT _object_key FROM MGI_Synonym WHERE _mgitype_key = 2 AND modification_date > %s",
+    "SELECT _marker_key FROM MRK_Notes WHERE modification_date > %s",
+    "SELECT _marker_key FROM MRK_Label WHERE modification_date > %s",
+    "SELECT _marker_key FROM MRK_MCV_Cache WHERE modification_date > %s",
+    "SELECT _marker_key FROM MRK_Reference WHERE modification_date > %s",
+    "SELECT _marker_key FROM GXD_Expression WHERE modification_date > %s",
+    "SELECT _object_key FROM VOC_Annot WHERE _annottype_key = 1015 AND modification_date > %s",
+    # synonyms citing a reference whose ids changed (e.g. it got a PubMed id): evidence_curies
+    "SELECT s._object_key FROM MGI_Synonym s, ACC_Accession a WHERE s._mgitype_key = 2 AND s._refs_key = a._object_key AND a._mgitype_key = 1 AND a.modification_date > %s",
+]
+
 #########################################################
 
 if __name__ == "__main__":
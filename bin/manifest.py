@@ -0,0 +1,210 @@
+#
+# manifest.py
+#
+# Change detection for the pipeline: lets it skip parts whose output would be the same as last time.
+#
+# A part's input fingerprint covers everything its output depends on:
+#   - for each table its generator reads (the module's TABLES), its counts of rows inserted, updated and
+#     deleted, from postgres's statistics, and max(modification_date) where that is indexed (see getTableStats)
+#   - the size and modification time of any input files (e.g. the Panther file for genes)
+#   - the curation schema version, the output format, and whether a sample is being generated
+#   - the database release (public_version and lastdump_date, as in every file's header), so that all the
+#     files of a run carry the same alliance_member_release_version
+#   - a digest of the code (the .py files in this directory)
+#   - the fingerprints of the parts it depends on (e.g. allele associations use the submitted gene ids)
+#
+# The manifest (${root}_manifest.json, next to the output files) records, for each part, the fingerprint
+# it was last generated from and the SHA-256 of each output file, and whether that output was validated.
+# If a part's fingerprint is unchanged and its output files are still there, unaltered, the part is not
+# generated again (nor validated again, if it was already). Uploads are skipped by output hash (see upload.py).
+#
+# Table statistics are cheap to read (see getTableStats), but they are not part of any snapshot: postgres
+# publishes each session's counts within about a second of its commit. So the pipeline reads them before it
+# exports its snapshot: a change the generators see but the fingerprint doesn't yet count only changes the
+# next run's fingerprint, which regenerates the part. (Read after the snapshot, the statistics could count a
+# change the generators don't see, and the part would be skipped from then on without it.)
+#
+# Note the Panther file is only downloaded (when newer) by the gene generator. Its fingerprint is that
+# of the last download, so a new Panther release is picked up the next time the gene tables change.
+#
+import os
+import glob
+import json
+import hashlib
+import threading
+from adfLib import sql, getFileHash
+
+# Returns dict from table name to its statistics, for the given tables:
+#   [rows inserted, updated, deleted, max(modification_date) as text]
+# The row counts are postgres's cumulative activity counters (pg_stat_user_tables), read from the catalog
+# rather than by scanning the tables: any insert, update or delete changes them. The date is read only for
+# tables with an index on modification_date (None for others), where it costs one index probe.
+# The counters start again from zero when statistics are reset (e.g. the database is restored from a dump),
+# so the time of the last reset is added as the statistics of table "*"; a new dump also changes the
+# release version, which is part of every fingerprint (see pipeline.py). A view's statistics are those of
+# the tables it reads (see getViewTables).
+def getTableStats (tables) :
+    tables = sorted(set([t.lower() for t in tables]))
+    if not tables:
+        return {}
+    views = getViewTables(tables)
+    names = tables
+    tables = sorted(set([t for t in tables if t not in views] + [b for v in views.values() for b in v]))
+    q = '''
+        SELECT relname AS table_name, n_tup_ins, n_tup_upd, n_tup_del
+        FROM pg_stat_user_tables
+        WHERE schemaname = current_schema()
+        AND relname = ANY(%s)
+        '''
+    stats = {}
+    for r in sql(q, args=(tables,)):
+        stats[r['table_name']] = [r['n_tup_ins'], r['n_tup_upd'], r['n_tup_del'], None]
+    q = '''
+        SELECT DISTINCT c.relname AS table_name
+        FROM pg_index i, pg_class c, pg_attribute a
+        WHERE i.indrelid = c.oid
+        AND c.relnamespace = current_schema()::regnamespace
+        AND a.attrelid = c.oid
+        AND a.attnum = i.indkey[0]
+        AND a.attname = 'modification_date'
+        AND c.relname = ANY(%s)
+        '''
+    indexed = sorted([r['table_name'] for r in sql(q, args=(tables,))])
+    if indexed:
+        selects = ["SELECT '%s' AS table_name, (SELECT max(modification_date) FROM %s)::text AS mdate" % (t, t) for t in indexed]
+        for r in sql("\nUNION ALL\n".join(selects), cache=False):
+            stats[r['table_name']][3] = r['mdate']
+    q = 'SELECT stats_reset::text AS stats_reset FROM pg_stat_database WHERE datname = current_database()'
+    stats["*"] = sql(q, cache=False)[0]['stats_reset']
+    for v in views:
+        stats[v] = dict([(t, stats.get(t)) for t in views[v]])
+    return dict([(t, stats.get(t)) for t in names + ["*"]])
+
+# Views have no statistics of their own. Returns dict from each of the given names that is a view to the
+# (non view) tables it reads, directly or through other views.
+def getViewTables (names) :
+    q = '''
+        SELECT DISTINCT v.relname AS view_name, t.relname AS table_name, t.relkind
+        FROM pg_class v, pg_rewrite r, pg_depend d, pg_class t
+        WHERE v.relnamespace = current_schema()::regnamespace
+        AND v.relkind IN ('v', 'm')
+        AND v.relname = ANY(%s)
+        AND r.ev_class = v.oid
+        AND d.objid = r.oid
+        AND d.refobjid = t.oid
+        AND t.oid != v.oid
+        AND t.relkind IN ('r', 'p', 'v', 'm')
+        '''
+    reads = {}
+    pending = list(names)
+    while pending:
+        found = {}
+        for r in sql(q, args=(pending,)):
+            found.setdefault(r['view_name'], set()).add((r['table_name'], r['relkind'] in ('v', 'm')))
+        reads.update(found)
+        pending = sorted(set([t for deps in found.values() for (t, isView) in deps if isView and t not in reads]))
+    def baseTables (v, seen) :
+        rval = set()
+        for (t, isView) in reads[v]:
+            if not isView:
+                rval.add(t)
+            elif t not in seen:
+                seen.add(t)
+                rval |= baseTables(t, seen)
+        return rval
+    return dict([(v, sorted(baseTables(v, set([v])))) for v in names if v in reads])
+
+# Returns [size, modification time] of a file, or None if it doesn't exist.
+def getFileStats (fname) :
+    if not os.path.exists(fname):
+        return None
+    st = os.stat(fname)
+    return [st.st_size, st.st_mtime_ns]
+
+# Returns a digest of the code: the .py files in this directory (generated ones included).
+def getCodeDigest () :
+    h = hashlib.sha256()
+    d = os.path.dirname(os.path.abspath(__file__))
+    for fname in sorted(glob.glob(os.path.join(d, '*.py'))):
+        h.update(os.path.basename(fname).encode('utf-8'))
+        h.update(getFileHash(fname).encode('utf-8'))
+    return h.hexdigest()
+
+def digest (obj) :
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+# Computes the input fingerprints of the given parts. Each part is (code, tables, files, deps), with deps
+# the codes of the parts it depends on. Returns dict from code to (fingerprint digest, inputs).
+def getFingerprints (parts, settings) :
+    stats = getTableStats([t for p in parts for t in p[1]])
+    code = getCodeDigest()
+    byCode = dict([(p[0], p) for p in parts])
+    fps = {}
+    def fingerprint (c) :
+        if c not in fps:
+            (c, tables, files, deps) = byCode[c]
+            inputs = {
+                "tables": dict([(t.lower(), stats.get(t.lower())) for t in tables] + [("*", stats.get("*"))]),
+                "files": dict([(f, getFileStats(f)) for f in files]),
+                "settings": settings,
+                "code": code,
+                "deps": dict([(d, fingerprint(d)[0]) for d in deps if d in byCode]),
+            }
+            fps[c] = (digest(inputs), inputs)
+        return fps[c]
+    for p in parts:
+        fingerprint(p[0])
+    return fps
+
+# The manifest file. Jobs finishing in the pipeline's threads update it, so access goes through a lock.
+class Manifest :
+    def __init__ (self, fname) :
+        self.fname = fname
+        self.lock = threading.Lock()
+        self.parts = {}
+        if os.path.exists(fname):
+            with open(fname) as fd:
+                self.parts = json.load(fd)
+
+    def save (self) :
+        tmp = self.fname + '.tmp'
+        with open(tmp, 'w') as fd:
+            json.dump(self.parts, fd, indent=2, sort_keys=True)
+        os.replace(tmp, self.fname)
+
+    # Returns true if the part was last generated from the given fingerprint, and each of the given
+    # output files is still as it was generated.
+    def isUnchanged (self, code, fingerprint, outputs) :
+        entry = self.parts.get(code)
+        if not entry or entry["fingerprint"] != fingerprint:
+            return False
+        for f in outputs:
+            if not os.path.exists(f) or entry["outputs"].get(os.path.basename(f)) != getFileHash(f):
+                return False
+        return True
+
+    # Returns true if the part's current output has been validated.
+    def isValidated (self, code) :
+        return bool(self.parts.get(code, {}).get("validated"))
+
+    # Records that a part has been generated, from the given fingerprint (and inputs, for the curious),
+    # writing the given output files.
+    def recordGenerated (self, code, fingerprint, inputs, outputs) :
+        hashes = dict([(os.path.basename(f), getFileHash(f)) for f in outputs if os.path.exists(f)])
+        with self.lock:
+            self.parts[code] = {
+                "fingerprint": fingerprint,
+                "inputs": inputs,
+                "outputs": hashes,
+                "validated": False,
+            }
+            self.save()
+
+    # Records that a part has been validated, if the given output files are the ones last generated.
+    def recordValidated (self, code, outputs) :
+        hashes = dict([(os.path.basename(f), getFileHash(f)) for f in outputs if os.path.exists(f)])
+        with self.lock:
+            entry = self.parts.get(code)
+            if entry and hashes and not [f for f in hashes if entry["outputs"].get(f) != hashes[f]]:
+                entry["validated"] = True
+                self.save()
@@ -0,0 +1,167 @@
+#
+# mergeShards.py
+#
+# Merges the shard files of a part (see partition.py: genes.py, alleles.py and diseaseAnnotations.py
+# run with --shard i/N, on any number of hosts) into its submission file, with the header attributes
+# of getHeaderAttributes(). The result is the same file the generator would have written unsharded.
+#
+# Before anything is written, the shards' descriptions are checked: there must be exactly one of each of
+# shards 1 to N, all generated in the same format, from the same database release as the one the merge
+# sees, and with the same ingest sets; and for each set, the key ranges must follow on from one another
+# with no gap or overlap. While each shard is copied, the length and SHA-256 of each of its sets are checked
+# against its description. The DTOs are copied as text, not decoded.
+#
+# With -o, the file is written under a temporary name and renamed when complete. In ndjson format
+# (see adfLib.OUTPUT_FORMATS), -o is required, and the header sidecar is written next to it.
+#
+# Usage:
+#   python mergeShards.py -o MGI_ps_gene.json MGI_ps_gene.shard1 MGI_ps_gene.shard2 ...
+#
+import os
+import sys
+import json
+import hashlib
+import argparse
+from adfLib import log, getHeader, formatHeaderAttributes, getNdjsonHeaderFile, openSink, WRITE_BUFFER_SIZE
+from partition import SHARD_HEADER_SIZE
+
+class ShardError (RuntimeError) :
+    pass
+
+# Returns the description of a shard file.
+def readDescription (fname) :
+    with open(fname) as fd:
+        line = fd.read(SHARD_HEADER_SIZE)
+    try:
+        desc = json.loads(line)
+    except ValueError:
+        raise ShardError("%s is not a shard file." % fname)
+    desc["file"] = fname
+    return desc
+
+# Checks that the shards (descriptions) make up a whole part. Returns them in order, 1 to N.
+def checkShards (descs, release) :
+    n = descs[0]["shards"]
+    byIndex = {}
+    for d in descs:
+        if d["shards"] != n:
+            raise ShardError("%s is shard %d of %d, not of %d." % (d["file"], d["shard"], d["shards"], n))
+        if d["shard"] in byIndex:
+            raise ShardError("Shard %d of %d given twice: %s and %s." % (d["shard"], n, byIndex[d["shard"]]["file"], d["file"]))
+        byIndex[d["shard"]] = d
+    missing = [str(i) for i in range(1, n + 1) if i not in byIndex]
+    if missing:
+        raise ShardError("Missing shard(s) %s of %d." % (", ".join(missing), n))
+    shards = [byIndex[i] for i in range(1, n + 1)]
+    first = shards[0]
+    for d in shards:
+        if d["format"] != first["format"]:
+            raise ShardError("%s is in format %r, %s in %r." % (d["file"], d["format"], first["file"], first["format"]))
+        if d["release"] != release:
+            raise ShardError("%s was generated from database release %s, but the database is now at %s." % (d["file"], d["release"], release))
+        if [s["name"] for s in d["sets"]] != [s["name"] for s in first["sets"]]:
+            raise ShardError("%s and %s have different ingest sets." % (d["file"], first["file"]))
+    for j, s in enumerate(first["sets"]):
+        if s["start"] is not None:
+            raise ShardError("%s: %s starts at %s=%s, leaving a gap before it." % (first["file"], s["name"], s["key"], s["start"]))
+        for (a, b) in zip(shards, shards[1:]):
+            end = a["sets"][j]["end"]
+            start = b["sets"][j]["start"]
+            if end != start:
+                what = "a gap" if start is None or end is not None and start > end else "an overlap"
+                raise ShardError("%s: %s ends before %s=%s but %s starts at %s: %s." % (s["name"], a["file"], s["key"], end, b["file"], start, what))
+        if shards[-1]["sets"][j]["end"] is not None:
+            raise ShardError("%s: %s ends at %s=%s, leaving a gap after it." % (s["name"], shards[-1]["file"], s["key"], shards[-1]["sets"][j]["end"]))
+    return shards
+
+# Copies the DTOs of one set of a shard (its description, s) from fd to sink, checking their length and hash.
+def copySet (fd, sink, s, fname) :
+    h = hashlib.sha256()
+    left = s["bytes"]
+    while left > 0:
+        block = fd.read(min(left, WRITE_BUFFER_SIZE))
+        if not block:
+            raise ShardError("%s ends inside %s." % (fname, s["name"]))
+        h.update(block.encode('utf-8'))
+        sink.write(block)
+        left -= len(block)
+    if h.hexdigest() != s["sha256"]:
+        raise ShardError("%s: the DTOs of %s don't match the shard's hash." % (fname, s["name"]))
+
+# Writes the merged file to sink. For ndjson, the header goes to headerSink.
+# Returns dict from ingest set name to number of DTOs.
+def merge (shards, sink, headerSink=None) :
+    header = getHeader()
+    ndjson = (shards[0]["format"] == 'ndjson')
+    names = [s["name"] for s in shards[0]["sets"]]
+    counts = dict([(name, 0) for name in names])
+    fds = [open(d["file"], 'r', buffering=WRITE_BUFFER_SIZE) for d in shards]
+    try:
+        for fd in fds:
+            fd.seek(SHARD_HEADER_SIZE)
+        if not ndjson:
+            sink.write('{\n')
+            sink.write(formatHeaderAttributes(header))
+        for j, name in enumerate(names):
+            if not ndjson:
+                sink.write('%s"%s": [\n' % (',\n' if j else '', name))
+                opening = '"%s": [\n' % name
+            for (d, fd) in zip(shards, fds):
+                s = d["sets"][j]
+                if not ndjson:
+                    # Skip the shard's own header attributes and set opening.
+                    while True:
+                        line = fd.readline()
+                        if not line:
+                            raise ShardError("%s has no %s." % (d["file"], name))
+                        if line == opening:
+                            break
+                    if s["count"] and counts[name]:
+                        sink.write(',')
+                copySet(fd, sink, s, d["file"])
+                if not ndjson and fd.read(1) != ']':
+                    raise ShardError("%s: %s is longer than its description says." % (d["file"], name))
+                counts[name] += s["count"]
+                log("Copied %d DTOs of %s from %s" % (s["count"], name, d["file"]))
+            if not ndjson:
+                sink.write(']')
+        if not ndjson:
+            sink.write('\n}\n')
+    finally:
+        for fd in fds:
+            fd.close()
+    sink.flush()
+    if ndjson:
+        h = dict(header)
+        h["ingest_sets"] = [{"name": name, "count": counts[name]} for name in names]
+        headerSink.write(json.dumps(h, indent=2) + '\n')
+    return counts
+
+def getOpts () :
+    parser = argparse.ArgumentParser()
+    parser.add_argument('shards',nargs='+',help="The shard files of a part.")
+    parser.add_argument('-o','--output',default=None,help="Output file (default: stdout).")
+    return parser.parse_args()
+
+def main () :
+    opts = getOpts()
+    header = getHeader()
+    shards = checkShards([readDescription(f) for f in opts.shards], header["alliance_member_release_version"])
+    ndjson = (shards[0]["format"] == 'ndjson')
+    if not opts.output:
+        if ndjson:
+            raise ShardError("Merging ndjson shards needs an output file (-o), to put the header next to.")
+        merge(shards, sys.stdout)
+        return
+    tmp = opts.output + '.tmp'
+    with openSink(tmp) as fd:
+        if ndjson:
+            with open(getNdjsonHeaderFile(opts.output), 'w') as hfd:
+                counts = merge(shards, fd, hfd)
+        else:
+            counts = merge(shards, fd)
+    os.replace(tmp, opts.output)
+    log("Merged %d shards into %s (%s)" % (len(shards), opts.output, ", ".join(["%s: %d" % x for x in counts.items()])))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+#
+# mockSubmitServer.py
+#
+# A local stand-in for the curation site's /api/data/submit endpoint, for testing uploads (upload.py)
+# offline: throughput, compression, retries and resuming.
+#
+# Accepts POSTs of multipart forms (plain or chunked), with an Authorization header. Each uploaded file
+# is read as a stream, gunzipped if its name ends with .gz, and (with --check) parsed, to count its DTOs.
+# Nothing is kept. Logs, for each request, the bytes received, the file's size and MB/s.
+#
+# Failures can be injected:
+#   --fail-first N      answers the first N requests with --status (default 503)
+#   --fail-rate R       answers a fraction R of the other requests the same way
+#   --drop-rate R       closes the connection halfway through reading a fraction R of requests
+#   --delay S           waits S seconds before answering each request
+#
+# Usage:
+#   python mockSubmitServer.py [-p 8080] [--fail-first 2] [--check]
+#   python upload.py -t http://localhost:8080 GENE:/path/to/MGI_ps_gene.json
+#
+import json
+import time
+import zlib
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from adfLib import log
+
+SUBMIT_PATH = "/api/data/submit"
+BLOCK_SIZE = 1 << 16
+
+requestCount = 0
+countLock = threading.Lock()
+
+class DroppedConnection (Exception) :
+    pass
+
+class SubmitHandler (BaseHTTPRequestHandler) :
+    protocol_version = "HTTP/1.1"
+
+    def log_message (self, fmt, *args) :
+        log("%s %s" % (self.address_string(), fmt % args))
+
+    def reply (self, status, obj) :
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+        self.close_connection = True
+
+    # Yields the request body, a block at a time.
+    def iterBody (self) :
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    return
+                block = self.rfile.read(size)
+                self.rfile.readline()
+                yield block
+        else:
+            left = int(self.headers.get("Content-Length", "0"))
+            while left > 0:
+                block = self.rfile.read(min(left, BLOCK_SIZE))
+                if not block:
+                    return
+                left -= len(block)
+                yield block
+
+    # Reads a multipart body. Returns a list of (field, filename, size, objects) for its files,
+    # where size is the uncompressed size and objects is the number of DTOs (None unless checking).
+    def readParts (self, boundary) :
+        opts = self.server.opts
+        delim = b'\r\n--' + boundary.encode('utf-8')
+        buf = b'\r\n'
+        received = 0
+        dropAt = random.random() < opts.drop_rate
+        parts = []
+        part = None
+        for block in self.iterBody():
+            received += len(block)
+            if dropAt and received > BLOCK_SIZE:
+                raise DroppedConnection()
+            buf += block
+            while True:
+                if part is None:
+                    i = buf.find(delim)
+                    if i < 0:
+                        buf = buf[-len(delim):]
+                        break
+                    j = buf.find(b'\r\n\r\n', i)
+                    if j < 0:
+                        break
+                    part = self.startPart(buf[i + len(delim):j])
+                    buf = buf[j + 4:]
+                else:
+                    i = buf.find(delim)
+                    if i < 0:
+                        keep = len(delim)
+                        self.feedPart(part, buf[:-keep])
+                        buf = buf[-keep:]
+                        break
+                    self.feedPart(part, buf[:i])
+                    parts.append(self.endPart(part))
+                    part = None
+                    buf = buf[i:]
+        self.received = received
+        return parts
+
+    def startPart (self, head) :
+        field = filename = ''
+        for line in head.decode('utf-8', 'replace').split('\r\n'):
+            if line.lower().startswith('content-disposition'):
+                for item in line.split(';'):
+                    k, sep, v = item.strip().partition('=')
+                    if k == 'name':
+                        field = v.strip('"')
+                    elif k == 'filename':
+                        filename = v.strip('"')
+        return {
+            "field": field,
+            "filename": filename,
+            "z": zlib.decompressobj(31) if filename.endswith('.gz') else None,
+            "size": 0,
+            "text": [] if self.server.opts.check else None,
+        }
+
+    def feedPart (self, part, data) :
+        if part["z"]:
+            data = part["z"].decompress(data)
+        part["size"] += len(data)
+        if part["text"] is not None:
+            part["text"].append(data)
+
+    def endPart (self, part) :
+        if part["z"]:
+            z = part["z"]
+            part["z"] = None
+            self.feedPart(part, z.flush())
+        nobjs = None
+        if part["text"] is not None:
+            obj = json.loads(b''.join(part["text"]))
+            nobjs = sum([len(v) for v in obj.values() if isinstance(v, list)])
+        return (part["field"], part["filename"], part["size"], nobjs)
+
+    def do_POST (self) :
+        global requestCount
+        opts = self.server.opts
+        with countLock:
+            requestCount += 1
+            n = requestCount
+        if not self.path.startswith(SUBMIT_PATH):
+            return self.reply(404, {"error": "Not found: " + self.path})
+        if not self.headers.get("Authorization"):
+            return self.reply(401, {"error": "No Authorization header"})
+        ctype = self.headers.get("Content-Type", "")
+        if not ctype.startswith("multipart/form-data") or "boundary=" not in ctype:
+            return self.reply(400, {"error": "Expected multipart/form-data"})
+        if n <= opts.fail_first or random.random() < opts.fail_rate:
+            for block in self.iterBody():
+                pass
+            return self.reply(opts.status, {"error": "Injected failure, request %d" % n})
+        t0 = time.time()
+        try:
+            parts = self.readParts(ctype.split("boundary=", 1)[1].strip('"'))
+        except DroppedConnection:
+            log("Request %d: dropping the connection" % n)
+            self.close_connection = True
+            return
+        except (ValueError, zlib.error) as e:
+            return self.reply(400, {"error": "Bad upload: %s" % e})
+        secs = max(time.time() - t0, 0.001)
+        for (field, filename, size, nobjs) in parts:
+            log("Request %d: %s %s: received %.1f MB, file %.1f MB%s, %.1f MB/s" % (n, field, filename,
+                self.received / 1e6, size / 1e6, "" if nobjs is None else ", %d objects" % nobjs, size / 1e6 / secs))
+        time.sleep(opts.delay)
+        self.reply(200, {"files": [{"field": p[0], "filename": p[1], "size": p[2], "objects": p[3]} for p in parts]})
+
+def getOpts () :
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p','--port',type=int,default=8080,help="Port to listen on (default: 8080).")
+    parser.add_argument('--check',action='store_true',help="Parse each uploaded file and count its objects.")
+    parser.add_argument('--fail-first',type=int,default=0,help="Fail the first N requests.")
+    parser.add_argument('--fail-rate',type=float,default=0.0,help="Fail this fraction of the other requests.")
+    parser.add_argument('--drop-rate',type=float,default=0.0,help="Drop the connection while reading this fraction of requests.")
+    parser.add_argument('--status',type=int,default=503,help="HTTP status for injected failures (default: 503).")
+    parser.add_argument('--delay',type=float,default=0.0,help="Seconds to wait before answering each request.")
+    return parser.parse_args()
+
+def main () :
+    opts = getOpts()
+    server = ThreadingHTTPServer(('localhost', opts.port), SubmitHandler)
+    server.opts = opts
+    log("Listening on http://localhost:%d%s" % (opts.port, SUBMIT_PATH))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+#
+# ndjson2json.py
+#
+# Converts an NDJSON output file (one DTO per line, see adfLib.OUTPUT_FORMATS) and its header sidecar
+# back into a submission file. The DTO lines are copied as they are, not decoded and re-encoded.
+#
+# Usage:
+#   python ndjson2json.py MGI_ps_gene.ndjson > MGI_ps_gene.json
+#   python ndjson2json.py MGI_ps_gene.ndjson.gz -o MGI_ps_gene.json
+#
+import sys
+import json
+import gzip
+import argparse
+from adfLib import formatHeaderAttributes, getNdjsonHeaderFile, openSink, WRITE_BUFFER_SIZE
+
+# Opens an NDJSON file for reading, decompressing it if need be.
+def openNdjson (fname) :
+    if fname.endswith('.gz'):
+        return gzip.open(fname, 'rt', encoding='utf-8')
+    if fname.endswith('.zst'):
+        import zstandard
+        return zstandard.open(fname, 'rt', encoding='utf-8')
+    return open(fname, 'r', buffering=WRITE_BUFFER_SIZE)
+
+# Writes the submission file for ndjson file fname to sink.
+# Returns dict from ingest set name to number of DTOs.
+def convert (fname, sink) :
+    with open(getNdjsonHeaderFile(fname)) as fd:
+        header = json.load(fd)
+    counts = {}
+    with openNdjson(fname) as fd:
+        sink.write('{\n')
+        sink.write(formatHeaderAttributes(header))
+        for i, iset in enumerate(header["ingest_sets"]):
+            name = iset["name"]
+            sink.write('%s"%s": [\n' % (',\n' if i else '', name))
+            for n in range(iset["count"]):
+                line = fd.readline()
+                if not line:
+                    raise RuntimeError("%s ends before the end of %s (expected %d DTOs)." % (fname, name, iset["count"]))
+                sink.write(',' + line if n else line)
+            sink.write(']')
+            counts[name] = iset["count"]
+        if fd.readline():
+            raise RuntimeError("%s has more DTOs than its header says." % fname)
+        sink.write('\n}\n')
+    sink.flush()
+    return counts
+
+def getOpts () :
+    parser = argparse.ArgumentParser()
+    parser.add_argument('ndjson',help="NDJSON file. The header is read from the sidecar file next to it.")
+    parser.add_argument('-o','--output',default='-',help="Output file (default: stdout).")
+    return parser.parse_args()
+
+def main () :
+    opts = getOpts()
+    sink = openSink(opts.output)
+    convert(opts.ndjson, sink)
+    if sink is not sys.stdout:
+        sink.close()
+
+if __name__ == "__main__":
+    main()
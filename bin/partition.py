@@ -0,0 +1,235 @@
+#
+# partition.py
+#
+# Multi-core generation of a single part, and sharding of a part across several hosts.
+#
+# Building DTOs is Python work, done on one core while the database sits mostly idle. With WORKERS > 1,
+# the genes, alleles and disease annotations generators split their main query into ranges of its key
+# (_marker_key, _allele_key, _annot_key) and build the DTOs of each range in a pool of worker processes:
+#   - the generator loads its lookups (xrefs, synonyms, notes, ...) first, in the parent process. The pool is
+#     forked after that, so every worker reads the same lookups, without copying them;
+#   - the distinct keys are split into ranges of at most RANGE_SIZE keys (and at least RANGES_PER_WORKER
+#     ranges per worker, so that the work stays balanced);
+#   - each worker runs the main query for a range (see adfLib.orderedQuery) on its own connection, attached
+#     to the run's database snapshot, builds the DTOs, and encodes them (adfLib.getSetEncoder), fetching
+#     and building in stages (see stages.py);
+#   - the parent writes the encoded DTOs (adfLib.Encoded) through emit(), range by range, in key order,
+#     with at most 2 ranges per worker built ahead of the one being written.
+# The main query is always ordered by key, with or without workers, so the output is the same, byte for
+# byte, whatever the number of workers.
+#
+# With one worker, the generator's own process fetches and builds in stages, and emit() encodes and writes.
+#
+# Objects are shown to the EMIT_OBSERVERS (e.g. the inline validator) in the worker that builds them.
+# An observer with takeCounts/addCounts (see validator.StreamValidator) gets the workers' counts.
+#
+# Sample runs (DO_SAMPLE) always use one worker. Run standalone, a generator with workers (or prefetching
+# its lookups) exports a snapshot for itself (see sharedSnapshot), so that all its connections read the
+# same data.
+#
+# Shards. The same generators can also be run on several hosts at once, each with --shard i/N (i from 1 to N):
+# each ingest set's distinct keys are split into N consecutive ranges of about the same size, and shard i
+# builds just the i-th. A shard is written to a shard file (see writeShard): the generator's usual output,
+# for its range, preceded by a line describing it (SHARD_HEADER_SIZE characters, JSON padded with spaces):
+#   {"shard": i, "shards": N, "format": ..., "release": ..., "sets": [{"name": "gene_ingest_set",
+#     "key": "_marker_key", "start": ..., "end": ..., "count": ..., "bytes": ..., "sha256": ...}, ...]}
+# where the set's range is start <= key < end (null: unbounded), and bytes and sha256 are the length and hash
+# of the text of its DTOs, as it appears in the file. mergeShards.py checks that a set of shards covers
+# each key range exactly once, and stitches them into the submission file.
+#
+import os
+import json
+import hashlib
+import argparse
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import adfLib
+from adfLib import log, sql, streamSql, orderedQuery, getSetEncoder, getHeader, exportSnapshot, releaseSnapshot, openSink, getNdjsonHeaderFile, Encoded, SNAPSHOT_VAR, WRITE_BUFFER_SIZE
+from stages import runStages, StageStats, STAGE_QUEUE_SIZE
+
+WORKERS = int(os.environ.get('PART_WORKERS', '1'))
+RANGE_SIZE = 5000
+RANGES_PER_WORKER = 4
+
+# The shard to generate, as (i, N), or None for everything. Set by runGenerator (--shard).
+SHARD = None
+SHARD_HEADER_SIZE = 4096
+
+# What the workers build, set in the parent just before the pool is forked:
+# (set name, query, key column, order columns, build function, indent)
+current = None
+
+# The description of each ingest set of the shard being written, in order (see countShard).
+shardSets = []
+
+# Returns the distinct keys of a query, in order.
+def getKeys (q, col) :
+    return [r['k'] for r in sql('SELECT DISTINCT _k.%s AS k FROM (%s) _k ORDER BY 1' % (col, q), cache=False)]
+
+# Returns the key ranges (lo, hi) covering the given keys (in order), for n workers.
+def getKeyRanges (keys, n) :
+    size = max(1, min(RANGE_SIZE, -(-len(keys) // (n * RANGES_PER_WORKER))))
+    return [(keys[i], keys[min(i + size, len(keys)) - 1]) for i in range(0, len(keys), size)]
+
+# Returns the keys of shard i of n, from all the keys (in order), and its bounds (start, end).
+def getShardKeys (keys, i, n) :
+    if len(keys) < n:
+        raise RuntimeError("Can't split %d keys into %d shards." % (len(keys), n))
+    bounds = [len(keys) * j // n for j in range(n + 1)]
+    lo, hi = bounds[i - 1], bounds[i]
+    return keys[lo:hi], (keys[lo] if i > 1 else None, keys[hi] if i < n else None)
+
+# Builds and encodes the DTOs of one key range (in stages, see stages.py). Runs in a worker.
+# Returns the encoded DTOs, the counts of the observers that have them, and the stages' counts.
+def buildRange (keyRange) :
+    setname, q, col, order, build, indent = current
+    encode = getSetEncoder(setname, adfLib.OUTPUT_FORMAT, indent)
+    observers = adfLib.EMIT_OBSERVERS
+    texts = []
+    stats = StageStats()
+    for o in runStages(lambda: streamSql(orderedQuery(q, col, keyRange, order)), build, stats):
+        texts.append(encode(o))
+        for f in observers:
+            f(setname, o)
+    return texts, [f.takeCounts() if hasattr(f, 'takeCounts') else None for f in observers], stats
+
+# Yields the DTOs built from the given key ranges by a pool of workers, encoded. Adds the workers' stage
+# counts to stats.
+def buildInWorkers (setname, q, col, build, order, indent, workers, ranges, stats) :
+    global current
+    log("Building %s in %d key ranges, with %d workers" % (setname, len(ranges), workers))
+    current = (setname, q, col, order, build, indent)
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork')) as pool:
+        pending = []
+        n = 0
+        try:
+            while n < len(ranges) or pending:
+                while n < len(ranges) and len(pending) < 2 * workers:
+                    pending.append(pool.submit(buildRange, ranges[n]))
+                    n += 1
+                texts, counts, rangeStats = pending.pop(0).result()
+                stats.add(rangeStats)
+                for (f, c) in zip(adfLib.EMIT_OBSERVERS, counts):
+                    if c is not None:
+                        f.addCounts(c)
+                for s in texts:
+                    yield Encoded(s)
+        finally:
+            # On failure, don't start the ranges still waiting.
+            for f in pending:
+                f.cancel()
+            current = None
+
+# Yields the DTOs of an ingest set, built from the rows of its main query q, in order of key column col
+# (then of the columns in order). build is a function taking an iterator of rows and yielding DTOs.
+# The rows are fetched, and the DTOs built, in stages (see stages.py), whose counts are logged at the end.
+# With workers (default: WORKERS) > 1, yields them already encoded, with the given indent (as given to emit).
+# If a SHARD is set, yields only that shard's DTOs, encoded, and describes them in shardSets.
+def generate (setname, q, col, build, order=None, indent=None, workers=None) :
+    workers = workers or WORKERS
+    keyRange = keys = None
+    if SHARD:
+        keys, bounds = getShardKeys(getKeys(q, col), *SHARD)
+        keyRange = (keys[0], keys[-1])
+        log("Shard %d of %d of %s: %d keys, from %s to %s" % (SHARD[0], SHARD[1], setname, len(keys), keys[0], keys[-1]))
+    stats = StageStats()
+    if workers <= 1 or adfLib.DO_SAMPLE:
+        objs = runStages(lambda: streamSql(orderedQuery(q, col, keyRange, order)), build, stats)
+    else:
+        ranges = getKeyRanges(keys if keys is not None else getKeys(q, col), workers)
+        objs = buildInWorkers(setname, q, col, build, order, indent, workers, ranges, stats)
+    if SHARD:
+        objs = countShard(setname, col, bounds, objs, indent)
+    yield from objs
+    if STAGE_QUEUE_SIZE > 0:
+        log(stats.format(setname))
+
+# Passes through the DTOs of one ingest set of a shard, encoding them (those not already encoded), and
+# adds the set's description to shardSets: its key bounds, and the number, length and hash of its DTOs
+# as emit() writes them.
+def countShard (setname, col, bounds, objs, indent) :
+    encode = getSetEncoder(setname, adfLib.OUTPUT_FORMAT, indent)
+    sep = '' if adfLib.OUTPUT_FORMAT == 'ndjson' else ','
+    h = hashlib.sha256()
+    n = size = 0
+    for o in objs:
+        if type(o) is not Encoded:
+            s = Encoded(encode(o))
+            for f in adfLib.EMIT_OBSERVERS:
+                f(setname, o)
+            o = s
+        text = (sep if n else '') + o + '\n'
+        h.update(text.encode('utf-8'))
+        size += len(text)
+        n += 1
+        yield o
+    shardSets.append({"name": setname, "key": col, "start": bounds[0], "end": bounds[1], "count": n, "bytes": size, "sha256": h.hexdigest()})
+
+# Writes the current SHARD to file fname, with the generator's output function: the description line
+# is reserved first, and filled in once the output has been written.
+def writeShard (fname, output) :
+    del shardSets[:]
+    with open(fname, 'w', buffering=WRITE_BUFFER_SIZE) as fd:
+        fd.write(' ' * (SHARD_HEADER_SIZE - 1) + '\n')
+        output(fd)
+        desc = json.dumps({
+            "shard": SHARD[0],
+            "shards": SHARD[1],
+            "format": adfLib.OUTPUT_FORMAT,
+            "release": getHeader()["alliance_member_release_version"],
+            "sets": shardSets,
+        })
+        if len(desc) >= SHARD_HEADER_SIZE:
+            raise RuntimeError("Shard description too long: " + desc)
+        fd.seek(0)
+        fd.write(desc.ljust(SHARD_HEADER_SIZE - 1))
+    if adfLib.OUTPUT_FORMAT == 'ndjson':
+        os.remove(getNdjsonHeaderFile(fname)) # the description replaces it
+    log("Wrote shard %d of %d: %s (%s)" % (SHARD[0], SHARD[1], fname, ", ".join(["%s: %d" % (s["name"], s["count"]) for s in shardSets])))
+
+# For a generator run standalone with workers, or with its lookups prefetched on several connections
+# (see adfLib.prefetch): exports a database snapshot for the run, unless there is one already (e.g. the
+# pipeline's), and releases it at the end.
+@contextlib.contextmanager
+def sharedSnapshot () :
+    export = (WORKERS > 1 or adfLib.PREFETCH_CONNECTIONS > 1) and not os.environ.get(SNAPSHOT_VAR)
+    if export:
+        exportSnapshot()
+    try:
+        yield
+    finally:
+        if export:
+            releaseSnapshot()
+
+# Parses "i/N".
+def parseShard (arg) :
+    try:
+        i, n = [int(x) for x in arg.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("Expected i/N, e.g. 2/4, got: " + arg)
+    if not 1 <= i <= n:
+        raise argparse.ArgumentTypeError("Shard %d of %d is not between 1 and %d." % (i, n, n))
+    return (i, n)
+
+# Adds the options of a generator that supports workers and shards to its argument parser.
+def addOptions (parser, what) :
+    parser.add_argument('-w','--workers',type=int,default=WORKERS,help="Worker processes building the %s (default: PART_WORKERS, or 1; see partition.py)." % what)
+    parser.add_argument('--shard',type=parseShard,default=None,metavar='i/N',help="Generate just shard i of N of the %s, into a shard file (requires -o; see mergeShards.py)." % what)
+    parser.add_argument('-o','--output',default=None,help="Output file (default: stdout).")
+
+# Runs a generator's output function, as its main program, with the options added by addOptions.
+def runGenerator (output, opts) :
+    global WORKERS, SHARD
+    WORKERS = opts.workers
+    SHARD = opts.shard
+    if SHARD and not opts.output:
+        raise RuntimeError("A shard must be written to a file (-o).")
+    with sharedSnapshot():
+        if SHARD:
+            writeShard(opts.output, output)
+        elif opts.output:
+            with openSink(opts.output) as fd:
+                output(fd)
+        else:
+            output()
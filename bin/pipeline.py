@@ -0,0 +1,411 @@
+#
+# pipeline.py
+#
+# Generates, validates and uploads any or all of the ingest files.
+#
+# Running each generator as its own script means each one reconnects to the database and rebuilds
+# the same lookup tables (submitted gene ids, reference ids, construct relationships, ...).
+# Here the generators are imported as modules, so a lookup declared with adfLib.shared is loaded
+# once per worker process and reused by every part that worker generates.
+#
+# The work is broken into jobs (generate, validate and upload a part) that are run by a scheduler:
+#  - a job starts once the jobs it depends on have finished. Validating a part depends on generating it,
+#    uploading depends on validating. Generating allele associations and disease annotations depends on
+#    generating genes, which hands them the set of submitted gene ids; generating allele and construct
+#    associations depends on generating constructs, which hands them the construct relationships, so that
+#    no lookup is loaded by more than one worker process. (A part's deps must come before it in PARTS.)
+#  - generation jobs run in a pool of worker processes; validation and upload jobs (which mostly wait
+#    on an external command or the network) run in a pool of threads, so they overlap with the generation
+#    of other parts.
+#  - among the jobs that are ready, the one heading the longest chain of remaining work goes first.
+#    Job durations are taken from the timings file written by previous runs.
+#
+# Before generating, the pipeline exports a database snapshot that every worker attaches to (see adfLib.sql),
+# so all the parts are generated from the same, consistent state of the database.
+#
+# Usage:
+#   python pipeline.py -r /path/to/output/MGI_ps [-p g,a,aa,...] [-g] [-v] [-u p,b,a] [-j n] [-t timings.json]
+#
+# With --inline-validation N, objects are validated as they are generated (see validator.py) and the
+# separate validation jobs are skipped.
+#
+# With --skip-unchanged, parts whose inputs haven't changed since the last run are not generated again
+# (see manifest.py). Uploads of files identical to ones already uploaded are skipped (see upload.py), unless
+# --force-upload is given.
+#
+# With --delta merged|changed, the parts that support it (genes, alleles, AGMs) are generated incrementally,
+# rebuilding only the objects whose data changed since the last run (see delta.py).
+#
+# With --part-workers N, the genes, alleles and disease annotations are each built by N worker processes
+# (see partition.py), on top of the -j jobs running at once.
+#
+# Writes one file per part, named ${root}_${ftype}.json, just as bin/refresh names them.
+# With -f ndjson, writes ${root}_${ftype}.ndjson and its header sidecar instead.
+#
+import os
+import sys
+import json
+import time
+import argparse
+from collections import namedtuple
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import adfLib
+from adfLib import log, openSink, sharedState, queryCacheStats, formatRefIdStats, formatFragmentStats, formatStatementStats, exportSnapshot, releaseSnapshot, getNdjsonHeaderFile, OUTPUT_FORMATS
+from ndjson2json import convert
+from validator import StreamValidator, ValidationFailed
+from validateFiles import validateFiles, getDefaultCacheFile
+from upload import uploadFile, UPLOAD_TARGETS
+from manifest import Manifest, getFingerprints
+import delta
+import partition
+import genes
+import alleles
+import constructs
+import variants
+import agms
+import diseaseAnnotations
+
+# A part of the submission.
+#   code        the abbreviation used with -p
+#   ftype       file type, used to name the output file
+#   aftype      the Alliance file type, used when uploading
+#   generate    function that writes the part's json to a sink
+#   deps        codes of the parts whose generation must finish before this part is generated
+#   provides    shared loaders whose results are handed to the parts that depend on this one
+#   tables      the tables read by the generator, for change detection (see manifest.py)
+#   files       the input files read by the generator, likewise
+#   delta       function that writes the part's json in delta mode (see delta.py), or None if the part has none
+Part = namedtuple('Part', ['code', 'ftype', 'aftype', 'generate', 'deps', 'provides', 'tables', 'files', 'delta'])
+
+# The constructs' lookups, also used by the construct and allele associations.
+CONSTRUCT_LOADERS = [constructs.getAlleleConstructRelationships, constructs.getNonMouseGeneIds, constructs.getConstructNotes]
+
+PARTS = [
+    Part("g",  "gene",                  "GENE",                  genes.output, [], [genes.getSubmittedGeneIds], genes.TABLES, genes.INPUT_FILES, genes.outputDelta),
+    Part("a",  "allele",                "ALLELE",                alleles.outputAlleles, [], [], alleles.TABLES, [], alleles.outputAllelesDelta),
+    Part("c",  "construct",             "CONSTRUCT",             partial(constructs.output, "constructs"), [], CONSTRUCT_LOADERS, constructs.TABLES, [], None),
+    Part("aa", "allele_association",    "ALLELE_ASSOCIATION",    alleles.outputAssociations, ["g", "c"], [], alleles.TABLES, [], None),
+    Part("ca", "construct_association", "CONSTRUCT_ASSOCIATION", partial(constructs.output, "associations"), ["c"], [], constructs.TABLES, [], None),
+    Part("v",  "variant",               "VARIANT",               variants.output, [], [], variants.TABLES, [], None),
+    Part("y",  "agm",                   "AGM",                   partial(agms.output, "genotypes"), [], [], agms.TABLES, [], agms.outputDelta),
+    Part("ya", "agm_association",       "AGM_ASSOCIATION",       partial(agms.output, "associations"), [], [], agms.TABLES, [], None),
+    Part("d",  "disease_annotation",    "DISEASE_ANNOTATION",    diseaseAnnotations.output, ["g"], [], diseaseAnnotations.TABLES, [], None),
+]
+CODE2PART = dict([(p.code, p) for p in PARTS])
+
+# Estimated duration (seconds) of a job that has no recorded timing.
+DEFAULT_COST = 60.0
+
+# A validation job stops reading a file after this many invalid objects (see validateFiles.py).
+VALIDATION_MAX_ERRORS = 100
+
+# Returns the output file name for a part. This is the submission file that is validated and uploaded,
+# unless ndjson is true, in which case it's the name of the NDJSON file that is generated.
+def getFileName (root, part, ndjson=False) :
+    return "%s_%s.%s" % (root, part.ftype, "ndjson" if ndjson else "json")
+
+# Returns the names of all the files written when generating a part.
+def getOutputFiles (root, part, toJson) :
+    if adfLib.OUTPUT_FORMAT != 'ndjson':
+        return [getFileName(root, part)]
+    fname = getFileName(root, part, True)
+    return [fname, getNdjsonHeaderFile(fname)] + ([getFileName(root, part)] if toJson else [])
+
+# Generates one part, writing its output file.
+# NDJSON output is converted to a submission file as well if it is to be validated or uploaded.
+# If validation is given, as (schemaDir, maxErrors), each DTO is checked against the schema as it is
+# written (see validator.py), and the part fails if any are invalid.
+def generatePart (root, part, toJson=False, validation=None) :
+    ndjson = (adfLib.OUTPUT_FORMAT == 'ndjson')
+    fname = getFileName(root, part, ndjson)
+    log("Generating %s file: %s" % (part.ftype, fname))
+    t0 = time.time()
+    validator = StreamValidator(*validation) if validation else None
+    if validator:
+        adfLib.EMIT_OBSERVERS.append(validator)
+    try:
+        with openSink(fname) as fd:
+            if delta.DELTA_MODE and part.delta:
+                store = delta.DeltaStore(delta.getStoreFileName(fname))
+                try:
+                    part.delta(store, delta.DELTA_MODE, fd)
+                finally:
+                    store.close()
+            else:
+                part.generate(fd)
+    finally:
+        if validator:
+            adfLib.EMIT_OBSERVERS.remove(validator)
+            log(validator.summary() + " in " + fname)
+    if validator and validator.errors:
+        raise ValidationFailed("%s has %d invalid objects." % (fname, validator.errors))
+    if ndjson and toJson:
+        with openSink(getFileName(root, part)) as fd:
+            convert(fname, fd)
+    log("Generated %s in %.1f seconds" % (fname, time.time() - t0))
+    if adfLib.QUERY_CACHE_DIR:
+        log("Query cache: %(hits)d hits, %(misses)d misses so far in this process" % queryCacheStats)
+    log(formatRefIdStats() + " so far in this process")
+    log(formatFragmentStats() + " so far in this process")
+    log(formatStatementStats() + " so far in this process")
+
+# ---------------------------------------
+# Job functions. Generation jobs run in worker processes, so they (and their arguments) must be picklable.
+# Each returns a dict of shared loader results to be handed to dependent jobs.
+
+def generateJob (root, code, toJson, validation, seed) :
+    sharedState.update(seed)
+    part = CODE2PART[code]
+    generatePart(root, part, toJson, validation)
+    return dict([(f.key, f()) for f in part.provides])
+
+# Validates a part's file against the curation schema in the validator dir (see validateFiles.py), with the
+# cores shared between the jobs that may run at once. Results are cached next to the file, so an unchanged
+# file isn't validated again. ASSUMES the schema is checked out to the correct version!
+def validateJob (root, code, opts) :
+    fname = getFileName(root, CODE2PART[code])
+    nworkers = max(1, (os.cpu_count() or 1) // opts.workers)
+    version = os.environ.get('AGR_CURATION_SCHEMA_VERSION', '')
+    if validateFiles([fname], opts.validator_dir, version, nworkers, VALIDATION_MAX_ERRORS, getDefaultCacheFile(fname)):
+        raise ValidationFailed("%s is invalid." % fname)
+    log("Validated: %s" % fname)
+    if opts.manifest:
+        opts.manifest.recordValidated(code, [fname])
+    return {}
+
+# Uploads a part's file to each of the targets (see upload.py).
+# Uploads are recorded in ${root}_upload_state.json, so a file that has already been uploaded to a target
+# (and hasn't changed since) is skipped: running the pipeline again after a failed upload resumes it.
+# With --force-upload, every file is sent again, e.g. after the curation site rejected or rolled back a load.
+def uploadJob (root, code, opts) :
+    part = CODE2PART[code]
+    fname = getFileName(root, part)
+    # A file of just the changed objects is not the complete set: the curation site must not clean up.
+    # A full build's file is (see delta.py), so the objects removed since the last one are cleaned up then.
+    changedOnly = opts.delta == 'changed' and part.delta and not delta.isComplete(delta.getStoreFileName(fname))
+    cleanUp = not opts.nocleanup and not changedOnly
+    uploadFile(part.aftype, fname, opts.upload, root + "_upload_state.json", cleanUp, force=opts.force_upload)
+    return {}
+
+# ---------------------------------------
+# A unit of work for the scheduler.
+#   jid     job id, e.g. "generate:g". Also the key for the job's timing history.
+#   deps    ids of the jobs that must finish first
+#   inProcess  if true, runs in the process pool; otherwise in the thread pool
+#   onDone  optional function, called (in the scheduler) when the job succeeds
+class Job :
+    def __init__ (self, jid, func, args, deps, inProcess, onDone=None) :
+        self.jid = jid
+        self.func = func
+        self.args = args
+        self.deps = deps
+        self.inProcess = inProcess
+        self.onDone = onDone
+        self.rank = 0.0
+
+# Builds the jobs for the selected parts.
+# With a manifest, parts whose inputs haven't changed since they were last generated (see manifest.py)
+# are not generated again, and not validated again if they were already. fingerprints is from getFingerprints.
+def getJobs (opts, parts, fingerprints=None) :
+    jobs = []
+    generated = set()
+    for p in parts:
+        last = None
+        toJson = bool(opts.validate or opts.upload)
+        unchanged = False
+        if opts.generate and opts.manifest:
+            fp, inputs = fingerprints[p.code]
+            unchanged = opts.manifest.isUnchanged(p.code, fp, getOutputFiles(opts.root, p, toJson))
+            if unchanged:
+                log("Not generating %s: its inputs haven't changed since it was last generated." % p.ftype)
+        if opts.generate and not unchanged:
+            deps = ["generate:" + d for d in p.deps if d in generated]
+            validation = (opts.validator_dir, opts.inline_validation) if opts.inline_validation else None
+            onDone = None
+            if opts.manifest:
+                onDone = partial(recordGenerated, opts, p, fp, inputs, toJson)
+            last = Job("generate:" + p.code, generateJob, (opts.root, p.code, toJson, validation), deps, True, onDone)
+            jobs.append(last)
+            generated.add(p.code)
+        if unchanged and opts.validate and opts.manifest.isValidated(p.code):
+            log("Not validating %s: it was validated after it was last generated." % p.ftype)
+        elif opts.validate and not (opts.generate and opts.inline_validation):
+            deps = [last.jid] if last else []
+            last = Job("validate:" + p.code, validateJob, (opts.root, p.code, opts), deps, False)
+            jobs.append(last)
+        if opts.upload:
+            deps = [last.jid] if last else []
+            last = Job("upload:" + p.code, uploadJob, (opts.root, p.code, opts), deps, False)
+            jobs.append(last)
+    return jobs
+
+# Records a part's generation in the manifest.
+def recordGenerated (opts, part, fingerprint, inputs, toJson) :
+    outputs = getOutputFiles(opts.root, part, toJson)
+    opts.manifest.recordGenerated(part.code, fingerprint, inputs, outputs)
+    if opts.inline_validation:
+        opts.manifest.recordValidated(part.code, outputs)
+
+# Sets each job's rank: its own estimated duration plus that of the longest chain of jobs depending on it.
+def rankJobs (jobs, timings) :
+    dependents = {}
+    for j in jobs:
+        for d in j.deps:
+            dependents.setdefault(d, []).append(j)
+    ranked = {}
+    def rank (j) :
+        if j.jid not in ranked:
+            ranked[j.jid] = timings.get(j.jid, DEFAULT_COST) + max([rank(d) for d in dependents.get(j.jid, [])] + [0.0])
+        return ranked[j.jid]
+    for j in jobs:
+        j.rank = rank(j)
+
+def loadTimings (fname) :
+    if fname and os.path.exists(fname):
+        with open(fname) as fd:
+            return json.load(fd)
+    return {}
+
+def saveTimings (fname, timings) :
+    if fname:
+        with open(fname, 'w') as fd:
+            json.dump(timings, fd, indent=2, sort_keys=True)
+
+# Runs a job, returning its elapsed time and the job function's result.
+def timedCall (func, args) :
+    t0 = time.time()
+    rval = func(*args)
+    return time.time() - t0, rval
+
+# Runs the jobs, at most nworkers at a time in each pool.
+# Returns the list of ids of jobs that failed or could not be run.
+def runJobs (jobs, nworkers, timings) :
+    rankJobs(jobs, timings)
+    pending = dict([(j.jid, j) for j in jobs])
+    done = set()
+    failed = []
+    seed = {}
+    running = {}  # future -> job
+    with ProcessPoolExecutor(nworkers) as procs, ThreadPoolExecutor(nworkers) as threads:
+        while pending or running:
+            # Jobs downstream of a failure can never run.
+            for j in list(pending.values()):
+                if [d for d in j.deps if d in failed]:
+                    log("Not running %s because a job it depends on failed." % j.jid)
+                    failed.append(j.jid)
+                    del pending[j.jid]
+            ready = [j for j in pending.values() if set(j.deps) <= done]
+            ready.sort(key=lambda j: -j.rank)
+            for j in ready:
+                nrunning = len([r for r in running.values() if r.inProcess == j.inProcess])
+                if nrunning >= nworkers:
+                    continue
+                args = j.args + (dict(seed),) if j.func is generateJob else j.args
+                f = (procs if j.inProcess else threads).submit(timedCall, j.func, args)
+                running[f] = j
+                del pending[j.jid]
+                log("Started %s (estimated %.0f seconds, rank %.0f)" % (j.jid, timings.get(j.jid, DEFAULT_COST), j.rank))
+            if not running:
+                break
+            finished, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+            for f in finished:
+                j = running.pop(f)
+                try:
+                    elapsed, provided = f.result()
+                except Exception as e:
+                    log("Job %s failed: %s" % (j.jid, str(e)))
+                    failed.append(j.jid)
+                    continue
+                timings[j.jid] = elapsed
+                seed.update(provided)
+                if j.onDone:
+                    j.onDone()
+                done.add(j.jid)
+                log("Finished %s in %.1f seconds" % (j.jid, elapsed))
+    return failed + list(pending.keys())
+
+# Returns the selected parts, in pipeline order.
+def getSelectedParts (codes) :
+    if not codes:
+        return PARTS
+    codes = codes.split(',')
+    for c in codes:
+        if c not in CODE2PART:
+            raise RuntimeError("Unknown part: " + c)
+    return [p for p in PARTS if p.code in codes]
+
+# Parses a comma-separated list of upload targets.
+def getTargets (arg) :
+    targets = arg.split(',')
+    for t in targets:
+        if t not in UPLOAD_TARGETS:
+            raise argparse.ArgumentTypeError("Unknown upload target: %s (use p, b or a)" % t)
+    return targets
+
+def getOpts () :
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r','--root',required=True,help="Output file path prefix. Files are named ROOT_ftype.json")
+    parser.add_argument('-p','--parts',default='',help="Comma-separated list of parts to process (default: all).")
+    parser.add_argument('-g','--generate',action='store_true',help="Generate the files.")
+    parser.add_argument('-v','--validate',action='store_true',help="Validate the files.")
+    parser.add_argument('-u','--upload',type=getTargets,help="Upload the files to these curation sites: comma-separated list of p, b, a.")
+    parser.add_argument('--nocleanup',action='store_true',help="Pass cleanUp=false when uploading.")
+    parser.add_argument('--force-upload',action='store_true',help="Upload the files even if they have already been uploaded, unchanged.")
+    parser.add_argument('-f','--format',choices=OUTPUT_FORMATS,default=adfLib.OUTPUT_FORMAT or None,help="Output format (default: OUTPUT_FORMAT, if set).")
+    parser.add_argument('-j','--workers',type=int,default=1,help="Maximum number of jobs to run at once (default: 1).")
+    parser.add_argument('-t','--timings',default=None,help="File of job durations, read to order the jobs and updated after the run.")
+    parser.add_argument('--no-snapshot',action='store_true',help="Don't share a database snapshot between the generators.")
+    parser.add_argument('--validator-dir',default='../agr_curation_schema',help="Curation schema checkout holding the validator.")
+    parser.add_argument('--delta',choices=delta.DELTA_MODES,default='',
+        help="Delta mode: rebuild only the genes, alleles and AGMs changed since the last run, and write all of them (merged) or just the changed ones (see delta.py).")
+    parser.add_argument('--part-workers',type=int,default=partition.WORKERS,metavar='N',
+        help="Worker processes building each of the genes, alleles and disease annotations (default: PART_WORKERS, or 1; see partition.py).")
+    parser.add_argument('--skip-unchanged',action='store_true',
+        help="Don't generate parts whose inputs haven't changed since they were last generated (see manifest.py).")
+    parser.add_argument('--inline-validation',type=int,default=0,metavar='N',
+        help="Validate objects as they are generated, stopping after N invalid ones, instead of validating the files afterwards.")
+    return parser.parse_args()
+
+def main () :
+    opts = getOpts()
+    opts.validator_dir = os.path.abspath(opts.validator_dir)
+    opts.root = os.path.abspath(opts.root)
+    adfLib.OUTPUT_FORMAT = opts.format or ''
+    delta.DELTA_MODE = opts.delta
+    partition.WORKERS = max(1, opts.part_workers)
+    opts.manifest = Manifest(opts.root + "_manifest.json") if opts.skip_unchanged else None
+    t0 = time.time()
+    timings = loadTimings(opts.timings)
+    parts = getSelectedParts(opts.parts)
+    # Fingerprints are computed before the snapshot is taken, so that they never count a change
+    # the generators won't see (see manifest.py).
+    fingerprints = None
+    if opts.generate and opts.manifest:
+        settings = {
+            "schema_version": os.environ.get('AGR_CURATION_SCHEMA_VERSION', ''),
+            "format": adfLib.OUTPUT_FORMAT,
+            "sample": adfLib.DO_SAMPLE,
+            "delta": opts.delta,
+            # Every file's header carries it: after a new dump, all parts are generated again.
+            "release": adfLib.getReleaseVersion(),
+        }
+        # Dependencies on parts not selected count too: their results feed this run's parts.
+        needed = set([p.code for p in parts] + [d for p in parts for d in p.deps])
+        fingerprints = getFingerprints([(p.code, p.tables, p.files, p.deps) for p in PARTS if p.code in needed], settings)
+    if opts.generate and not opts.no_snapshot:
+        exportSnapshot()
+    try:
+        jobs = getJobs(opts, parts, fingerprints)
+        failed = runJobs(jobs, max(1, opts.workers), timings)
+    finally:
+        releaseSnapshot()
+    saveTimings(opts.timings, timings)
+    log("Pipeline finished in %.1f seconds" % (time.time() - t0))
+    if failed:
+        log("Failed jobs: " + ", ".join(failed))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+#
+# stages.py
+#
+# Overlapped fetching, building and writing of a generator's DTOs.
+#
+# A generator's main loop fetches rows of its main query, builds a DTO from each, and encodes and writes
+# it (emit). Done in sequence, the database round trips and the Python work never overlap. runStages
+# splits the loop into three stages connected by bounded queues:
+#   fetch         a thread running the main query (streamSql), passing its rows on in batches
+#   build         a thread running the generator's build function over those rows
+#   encode/write  the caller (emit, or a partition.py worker), which takes the DTOs as they come
+# Each queue holds at most STAGE_QUEUE_SIZE batches of STAGE_BATCH_SIZE items; a stage that gets that far
+# ahead waits (backpressure), so memory stays bounded whatever the relative speed of the stages. The DTOs
+# come out in the same order as before, so the output is unchanged.
+#
+# Python threads share one core for Python code (the GIL): the fetch thread's database waits overlap with
+# the rest, but build and encode/write still take turns. Beyond that, one worker process per core (see
+# partition.py) is what scales.
+#
+# Each stage counts the time it spends working (busy), waiting for input (starved) and waiting for room in
+# its output queue (blocked). These are logged at the end of each ingest set (see StageStats.format): the
+# stage that is busy nearly all the time, while the others are starved or blocked, is the bottleneck.
+# A thread's busy time includes its waits for the GIL.
+#
+# Set STAGE_QUEUE_SIZE=0 to run the loop in sequence, as before.
+#
+import os
+import time
+import queue
+import threading
+from adfLib import mainQuery
+
+STAGE_QUEUE_SIZE = int(os.environ.get('STAGE_QUEUE_SIZE', '8'))
+STAGE_BATCH_SIZE = 500
+STAGES = ['fetch', 'build', 'encode/write']
+
+# How long a blocked put or get waits before checking whether the run has been stopped.
+POLL_INTERVAL = 0.1
+
+# The end of a stage's output, or the exception that ended it.
+END = 'END'
+class StageFailed :
+    def __init__ (self, error) :
+        self.error = error
+
+# Item count and busy, starved and blocked seconds of each stage.
+class StageStats :
+    def __init__ (self) :
+        self.stages = dict([(s, [0, 0.0, 0.0, 0.0]) for s in STAGES])
+
+    def count (self, stage, items, busy, starved, blocked) :
+        c = self.stages[stage]
+        c[0] += items
+        c[1] += busy
+        c[2] += starved
+        c[3] += blocked
+
+    # Adds the counts of another StageStats (e.g. a worker's).
+    def add (self, other) :
+        for (s, c) in other.stages.items():
+            self.count(s, *c)
+
+    # Returns a one line summary, for logging.
+    def format (self, setname) :
+        parts = []
+        utilization = {}
+        for s in STAGES:
+            items, busy, starved, blocked = self.stages[s]
+            total = busy + starved + blocked
+            utilization[s] = busy / total if total else 0
+            parts.append("%s %d items, busy %.1fs (%.0f%%), starved %.1fs, blocked %.1fs" % (s, items, busy, 100 * utilization[s], starved, blocked))
+        return "Stages of %s: %s; bottleneck: %s" % (setname, "; ".join(parts), max(STAGES, key=lambda s: utilization[s]))
+
+# A bounded queue between two stages, timing the waits on either side.
+class Channel :
+    def __init__ (self, stop) :
+        self.queue = queue.Queue(STAGE_QUEUE_SIZE)
+        self.stop = stop
+        self.putWaited = 0.0 # by the stage before, blocked
+        self.getWaited = 0.0 # by the stage after, starved
+
+    # Puts an item. Returns False if the run was stopped meanwhile.
+    def put (self, item) :
+        t0 = time.perf_counter()
+        try:
+            while True:
+                try:
+                    self.queue.put(item, timeout=POLL_INTERVAL)
+                    return True
+                except queue.Full:
+                    if self.stop.is_set():
+                        return False
+        finally:
+            self.putWaited += time.perf_counter() - t0
+
+    # Returns the next item, or END if the run was stopped meanwhile.
+    def get (self) :
+        t0 = time.perf_counter()
+        try:
+            while True:
+                try:
+                    return self.queue.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    if self.stop.is_set():
+                        return END
+        finally:
+            self.getWaited += time.perf_counter() - t0
+
+    # Yields the items of the batches put by the stage before, until its END.
+    # Raises the exception that ended that stage, if any.
+    def items (self) :
+        while True:
+            batch = self.get()
+            if batch is END:
+                return
+            if type(batch) is StageFailed:
+                raise batch.error
+            yield from batch
+
+# Runs a stage: passes the items it yields on to the out channel, in batches, then END (or StageFailed).
+def runStage (name, stats, items, out, inp=None) :
+    t0 = time.perf_counter()
+    n = 0
+    batch = []
+    try:
+        for o in items():
+            batch.append(o)
+            if len(batch) >= STAGE_BATCH_SIZE:
+                n += len(batch)
+                if not out.put(batch):
+                    return
+                batch = []
+        n += len(batch)
+        if batch and not out.put(batch):
+            return
+        out.put(END)
+    except BaseException as e:
+        out.put(StageFailed(e))
+    finally:
+        starved = inp.getWaited if inp else 0.0
+        stats.count(name, n, time.perf_counter() - t0 - starved - out.putWaited, starved, out.putWaited)
+
+# Yields the DTOs built by function build from the rows returned by fetch(), in order, with the fetching
+# and the building each in a thread of its own (see above). Both functions are called in their thread.
+# The stages' counts are added to stats (unless STAGE_QUEUE_SIZE is 0, and the loop runs in sequence).
+def runStages (fetch, build, stats) :
+    if STAGE_QUEUE_SIZE <= 0:
+        yield from build(r for j,r in mainQuery(fetch()))
+        return
+    stop = threading.Event()
+    fetched = Channel(stop)
+    built = Channel(stop)
+    def fetchRows () :
+        rows = fetch()
+        try:
+            for j,r in mainQuery(rows):
+                yield r
+        finally:
+            if hasattr(rows, 'close'):
+                rows.close()
+    threads = [
+        threading.Thread(target=runStage, args=('fetch', stats, fetchRows, fetched), daemon=True),
+        threading.Thread(target=runStage, args=('build', stats, lambda: build(fetched.items()), built, fetched), daemon=True),
+    ]
+    t0 = time.perf_counter()
+    n = 0
+    try:
+        for t in threads:
+            t.start()
+        for o in built.items():
+            n += 1
+            yield o
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+        stats.count('encode/write', n, time.perf_counter() - t0 - built.getWaited, built.getWaited, 0.0)
@@ -0,0 +1,237 @@
+#
+# upload.py
+#
+# Uploads submission files to the Alliance curation site(s).
+# See: https://github.com/alliance-genome/agr_curation#submitting-data
+# See: https://${curation_system}.alliancegenome.org/api/version
+#
+# Each file is POSTed to /api/data/submit as a multipart form (field <AFTYPE>_MGI, as curl -F does), but streamed:
+# the body is sent in chunks as the file is read, so files of any size go up in constant memory.
+# With compression on (see UPLOAD_GZIP in Configuration), the file is gzipped on the fly and sent as
+# <name>.json.gz. Only use it with sites whose submission endpoint accepts gzipped files.
+#
+# Failures that may be transient (connection errors, timeouts, HTTP 429 and 5xx) are retried, waiting
+# UPLOAD_BACKOFF seconds, then twice that, and so on, up to UPLOAD_RETRIES times. Other HTTP errors are not.
+#
+# Each successful upload is recorded in a state file (by target, file name, size and SHA-256), and a file
+# already uploaded to a target is skipped. So after a failure, running the same upload again resumes with
+# the first file that did not make it. Use --force to upload everything again.
+#
+# A target is p, b or a (Production, Beta, Alpha), or a URL (e.g. of mockSubmitServer.py).
+# The same files can be sent to several targets: -t p,b,a.
+#
+# Used by pipeline.py for its upload jobs. From the command line:
+#   python upload.py -t p,b [--nocleanup] [--state state.json] GENE:/path/to/MGI_ps_gene.json ALLELE:...
+#
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import argparse
+import threading
+import http.client
+import urllib.parse
+from adfLib import log, getFileHash, WRITE_BUFFER_SIZE
+
+UPLOAD_TARGETS = {
+    "p" : "https://curation.alliancegenome.org",
+    "b" : "https://beta-curation.alliancegenome.org",
+    "a" : "https://alpha-curation.alliancegenome.org",
+}
+SUBMIT_PATH = "/api/data/submit"
+
+UPLOAD_GZIP = os.environ.get('UPLOAD_GZIP', '') == '1'
+UPLOAD_RETRIES = int(os.environ.get('UPLOAD_RETRIES', '5'))
+UPLOAD_BACKOFF = float(os.environ.get('UPLOAD_BACKOFF', '10'))
+UPLOAD_TIMEOUT = float(os.environ.get('UPLOAD_TIMEOUT', '3600'))
+
+# HTTP statuses worth retrying.
+RETRY_STATUSES = set([408, 429, 500, 502, 503, 504])
+
+# Raised for a failed upload. retry is true if the failure may be transient.
+class UploadFailed (RuntimeError) :
+    def __init__ (self, msg, retry) :
+        RuntimeError.__init__(self, msg)
+        self.retry = retry
+
+# Returns the submission URL for a target: p, b, a, or a site URL.
+def getSubmitUrl (target, cleanUp=True) :
+    base = UPLOAD_TARGETS.get(target, target)
+    if not base.startswith('http'):
+        raise RuntimeError("Unknown upload target: " + target)
+    url = base.rstrip('/')
+    if not url.endswith(SUBMIT_PATH):
+        url += SUBMIT_PATH
+    if not cleanUp:
+        url += "?cleanUp=false"
+    return url
+
+# Returns the API token, from TOKEN_FILE.
+def getToken () :
+    with open(os.environ['TOKEN_FILE']) as fd:
+        return fd.read().strip()
+
+# ---------------------------------------
+# Request body
+
+# Yields the multipart body for one file, a block at a time, gzipping the file's contents if compress is true.
+# Updates counts: bytes read from the file and sent.
+def iterBody (fname, field, boundary, compress, counts) :
+    filename = os.path.basename(fname) + (".gz" if compress else "")
+    ctype = "application/gzip" if compress else "application/json"
+    head = ('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\nContent-Type: %s\r\n\r\n'
+        % (boundary, field, filename, ctype)).encode('utf-8')
+    tail = ('\r\n--%s--\r\n' % boundary).encode('utf-8')
+    z = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    counts["sent"] += len(head)
+    yield head
+    with open(fname, 'rb') as fd:
+        while True:
+            block = fd.read(WRITE_BUFFER_SIZE)
+            if not block:
+                break
+            counts["read"] += len(block)
+            if z:
+                block = z.compress(block)
+                if not block:
+                    continue
+            counts["sent"] += len(block)
+            yield block
+    if z:
+        block = z.flush()
+        counts["sent"] += len(block)
+        yield block
+    counts["sent"] += len(tail)
+    yield tail
+
+# POSTs one file. Returns the response body. Raises UploadFailed.
+def postFile (url, token, field, fname, compress) :
+    u = urllib.parse.urlsplit(url)
+    connClass = http.client.HTTPSConnection if u.scheme == 'https' else http.client.HTTPConnection
+    conn = connClass(u.netloc, timeout=UPLOAD_TIMEOUT)
+    boundary = "----adf" + os.urandom(12).hex()
+    counts = {"read": 0, "sent": 0}
+    t0 = time.time()
+    try:
+        conn.putrequest("POST", u.path + ("?" + u.query if u.query else ""))
+        conn.putheader("Authorization", "APIToken %s" % token) # possible values: APIToken, Bearer. For APIToken, use short token. For Bearer, use long.
+        conn.putheader("Content-Type", "multipart/form-data; boundary=" + boundary)
+        conn.putheader("Transfer-Encoding", "chunked")
+        conn.endheaders()
+        for block in iterBody(fname, field, boundary, compress, counts):
+            conn.send(b"%x\r\n%s\r\n" % (len(block), block))
+        conn.send(b"0\r\n\r\n")
+        resp = conn.getresponse()
+        body = resp.read().decode('utf-8', 'replace')
+    except (OSError, http.client.HTTPException) as e:
+        raise UploadFailed("%s: %s" % (type(e).__name__, e), True)
+    finally:
+        conn.close()
+    if resp.status >= 300:
+        raise UploadFailed("HTTP %d: %s" % (resp.status, body[:1000]), resp.status in RETRY_STATUSES)
+    secs = max(time.time() - t0, 0.001)
+    log("Sent %.1f MB (%.1f MB of file) in %.1f seconds, %.1f MB/s" % (counts["sent"] / 1e6, counts["read"] / 1e6, secs, counts["read"] / 1e6 / secs))
+    return body
+
+# POSTs one file, retrying transient failures with exponential backoff. Returns the response body.
+def postWithRetries (url, token, field, fname, compress, retries=None, backoff=None) :
+    retries = UPLOAD_RETRIES if retries is None else retries
+    backoff = UPLOAD_BACKOFF if backoff is None else backoff
+    attempt = 0
+    while True:
+        try:
+            return postFile(url, token, field, fname, compress)
+        except UploadFailed as e:
+            if not e.retry or attempt >= retries:
+                raise
+            wait = backoff * (2 ** attempt) * random.uniform(0.8, 1.2)
+            attempt += 1
+            log("Upload of %s failed (%s). Retry %d of %d in %.1f seconds." % (fname, e, attempt, retries, wait))
+            time.sleep(wait)
+
+# ---------------------------------------
+# Upload state: which files have been uploaded to which targets.
+# Upload jobs run in threads, so access goes through a lock.
+
+stateLock = threading.Lock()
+
+def loadState (fname) :
+    if fname and os.path.exists(fname):
+        with open(fname) as fd:
+            return json.load(fd)
+    return {}
+
+def saveState (fname, state) :
+    tmp = fname + '.tmp'
+    with open(tmp, 'w') as fd:
+        json.dump(state, fd, indent=2)
+    os.replace(tmp, fname)
+
+# Returns true if the file, as it is now, has been uploaded to the url.
+# Only the contents count: a file regenerated with the same contents is not uploaded again.
+# (The file is only hashed if its size matches the recorded one.)
+def isUploaded (stateFile, url, fname) :
+    with stateLock:
+        rec = loadState(stateFile).get(url, {}).get(os.path.abspath(fname))
+    if not rec:
+        return False
+    return rec["size"] == os.path.getsize(fname) and rec["sha256"] == getFileHash(fname)
+
+def recordUpload (stateFile, url, fname) :
+    st = os.stat(fname)
+    rec = {"size": st.st_size, "sha256": getFileHash(fname), "uploaded": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    with stateLock:
+        state = loadState(stateFile)
+        state.setdefault(url, {})[os.path.abspath(fname)] = rec
+        saveState(stateFile, state)
+
+# ---------------------------------------
+
+# Uploads a file of the given Alliance file type (GENE, ALLELE, ...) to each target in turn.
+# Skips targets it has already been uploaded to, according to stateFile (unless force).
+def uploadFile (aftype, fname, targets, stateFile=None, cleanUp=True, compress=None, force=False, token=None) :
+    compress = UPLOAD_GZIP if compress is None else compress
+    token = token or getToken()
+    for t in targets:
+        url = getSubmitUrl(t, cleanUp)
+        if stateFile and not force and isUploaded(stateFile, url, fname):
+            log("Already uploaded %s to %s; skipping." % (fname, url))
+            continue
+        log("Uploading %s to %s%s" % (fname, url, " (gzipped)" if compress else ""))
+        body = postWithRetries(url, token, "%s_MGI" % aftype, fname, compress)
+        log("Uploaded: %s. Response: %s" % (fname, body.strip()[:1000]))
+        if stateFile:
+            recordUpload(stateFile, url, fname)
+
+def getOpts () :
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files',nargs='+',help="Files to upload, each as AFTYPE:path, e.g. GENE:MGI_ps_gene.json")
+    parser.add_argument('-t','--targets',default='p',help="Comma-separated targets: p, b, a, or site URLs (default: p).")
+    parser.add_argument('-s','--state',default=None,help="Upload state file, for resuming (default: upload_state.json next to the first file).")
+    parser.add_argument('--nocleanup',action='store_true',help="Pass cleanUp=false.")
+    parser.add_argument('-z','--gzip',action='store_true',default=UPLOAD_GZIP,help="Gzip the files as they are sent (default: UPLOAD_GZIP).")
+    parser.add_argument('--force',action='store_true',help="Upload even the files already uploaded.")
+    return parser.parse_args()
+
+def main () :
+    opts = getOpts()
+    files = []
+    for f in opts.files:
+        aftype, sep, fname = f.partition(':')
+        if not sep or not fname:
+            raise RuntimeError("Expected AFTYPE:path, got: " + f)
+        files.append((aftype, fname))
+    stateFile = opts.state or os.path.join(os.path.dirname(os.path.abspath(files[0][1])), 'upload_state.json')
+    targets = opts.targets.split(',')
+    token = getToken()
+    for (aftype, fname) in files:
+        try:
+            uploadFile(aftype, fname, targets, stateFile, not opts.nocleanup, opts.gzip, opts.force, token)
+        except UploadFailed as e:
+            log("Upload failed: %s: %s. Run again to resume from this file." % (fname, e))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+#
+# validateFiles.py
+#
+# Validates submission files (or NDJSON files, see adfLib.OUTPUT_FORMATS) against the curation schema,
+# using all the machine's cores, and remembering which files have already been validated.
+#
+# Each file is read as a stream: a JSON file is split into its DTOs with raw_decode, without loading the
+# whole file, and the DTOs are sent in chunks to a pool of worker processes that check them against
+# the compiled validators of validator.py. At most a few chunks per worker are in flight at once.
+#
+# Results are cached by the file's SHA-256 plus the schema version (and a digest of the JSON schema
+# file itself), so running again on a file that hasn't changed just reports the earlier result.
+#
+# Reports, for each file, the number of objects, the number invalid, and objects/s.
+# Exits with status 1 if any file is invalid.
+#
+# pipeline.py (-v) validates each part's file with validateFiles, with the same cache.
+#
+# Requires the jsonschema package: run with the venv's python (see Install).
+#
+# Usage:
+#   venv/bin/python validateFiles.py [-s ../agr_curation_schema] [-j 8] /path/to/output/MGI_ps_*.json
+#
+import os
+import sys
+import json
+import time
+import gzip
+import argparse
+import threading
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from adfLib import log, getNdjsonHeaderFile, getFileHash, WRITE_BUFFER_SIZE
+from validator import StreamValidator, SCHEMA_FILE
+
+CHUNK_SIZE = 500        # objects per chunk sent to a worker
+MAX_MESSAGES = 20       # error messages kept in the cache, per file
+
+# ---------------------------------------
+# Reading files
+
+def openFile (fname) :
+    if fname.endswith('.gz'):
+        return gzip.open(fname, 'rt', encoding='utf-8')
+    if fname.endswith('.zst'):
+        import zstandard
+        return zstandard.open(fname, 'rt', encoding='utf-8')
+    return open(fname, 'r', buffering=WRITE_BUFFER_SIZE)
+
+def isNdjson (fname) :
+    return '.ndjson' in os.path.basename(fname)
+
+# Yields (setName, text) for each DTO of a submission file, where text is the DTO's JSON as it
+# appears in the file. The file is read a block at a time; anything that is not an array at the top
+# level (the header attributes) is skipped.
+WHITESPACE = ' \t\n\r'
+def iterSubmission (fd, blockSize=WRITE_BUFFER_SIZE) :
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+    # Reads another block into buf, dropping what has been consumed. Returns False at end of file.
+    def more () :
+        nonlocal buf, pos, eof
+        if eof:
+            return False
+        block = fd.read(blockSize)
+        if not block:
+            eof = True
+            return False
+        buf = buf[pos:] + block
+        pos = 0
+        return True
+    # Returns the next non-whitespace character (not consumed), or None at the end.
+    def peek () :
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in WHITESPACE:
+                pos += 1
+            if pos < len(buf):
+                return buf[pos]
+            if not more():
+                return None
+    # Decodes the value at pos. Returns (value, text).
+    def value () :
+        nonlocal pos
+        while True:
+            try:
+                v, end = decoder.raw_decode(buf, pos)
+                if end < len(buf) or eof:
+                    text = buf[pos:end]
+                    pos = end
+                    return v, text
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            more()
+    def expect (c) :
+        nonlocal pos
+        if peek() != c:
+            raise ValueError("Expected '%s' at: %s" % (c, buf[pos:pos+80]))
+        pos += 1
+    #
+    expect('{')
+    while True:
+        c = peek()
+        if c == '}':
+            return
+        if c is None:
+            raise ValueError("File ends before its closing brace.")
+        if c == ',':
+            pos += 1
+            continue
+        name, text = value()
+        expect(':')
+        if peek() != '[':
+            value()
+            continue
+        pos += 1
+        while True:
+            c = peek()
+            if c == ']':
+                pos += 1
+                break
+            if c == ',':
+                pos += 1
+                continue
+            if c is None:
+                raise ValueError("File ends inside %s" % name)
+            v, text = value()
+            yield name, text
+
+# Yields (setName, text) for each DTO of an NDJSON file, using the set sizes in its header sidecar.
+def iterNdjson (fd, fname) :
+    with open(getNdjsonHeaderFile(fname)) as hfd:
+        header = json.load(hfd)
+    for iset in header["ingest_sets"]:
+        for i in range(iset["count"]):
+            line = fd.readline()
+            if not line:
+                raise ValueError("%s ends before the end of %s" % (fname, iset["name"]))
+            yield iset["name"], line
+
+# Yields lists of up to size (setName, text) pairs.
+def chunks (records, size) :
+    chunk = []
+    for r in records:
+        chunk.append(r)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+# ---------------------------------------
+# Workers. Each compiles its own validators, once.
+
+workerValidator = None
+def initWorker (schemaDir) :
+    global workerValidator
+    workerValidator = StreamValidator(schemaDir)
+
+# Returns (number of objects, list of error messages) for a chunk.
+def validateChunk (chunk) :
+    errors = []
+    for (name, text) in chunk:
+        msg = workerValidator.check(name, json.loads(text))
+        if msg:
+            errors.append(msg)
+    return len(chunk), errors
+
+# ---------------------------------------
+# Result cache
+
+# Returns the cache key for a file: its hash plus the schema's version and digest.
+# An NDJSON file's header sidecar is part of its content.
+def getCacheKey (fname, schemaKey) :
+    key = getFileHash(fname)
+    if isNdjson(fname):
+        key += '+' + getFileHash(getNdjsonHeaderFile(fname))
+    return key + '/' + schemaKey
+
+def loadCache (fname) :
+    if os.path.exists(fname):
+        with open(fname) as fd:
+            return json.load(fd)
+    return {}
+
+def saveCache (fname, cache) :
+    tmp = fname + '.tmp'
+    with open(tmp, 'w') as fd:
+        json.dump(cache, fd, indent=2)
+    os.replace(tmp, fname)
+
+# Adds a result to the cache file. The pipeline validates several files at once (in threads), so the
+# file is read again, under a lock, rather than overwritten with this run's copy.
+cacheLock = threading.Lock()
+def recordResult (fname, key, result) :
+    with cacheLock:
+        cache = loadCache(fname)
+        cache[key] = result
+        saveCache(fname, cache)
+
+# ---------------------------------------
+
+# Validates one file with the pool. Returns a result dict: ok, objects, invalid, seconds, messages.
+def validateFile (fname, pool, nworkers, maxErrors) :
+    t0 = time.time()
+    nobjs = 0
+    invalid = 0
+    messages = []
+    pending = set()
+    with openFile(fname) as fd:
+        records = iterNdjson(fd, fname) if isNdjson(fname) else iterSubmission(fd)
+        for chunk in chunks(records, CHUNK_SIZE):
+            if len(pending) >= 2 * nworkers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for f in done:
+                    n, errs = f.result()
+                    nobjs += n
+                    invalid += len(errs)
+                    for e in errs:
+                        log("INVALID " + e)
+                    messages += errs[:MAX_MESSAGES - len(messages)]
+            if invalid >= maxErrors:
+                log("Stopping %s after %d invalid objects." % (fname, invalid))
+                break
+            pending.add(pool.submit(validateChunk, chunk))
+        for f in pending:
+            n, errs = f.result()
+            nobjs += n
+            invalid += len(errs)
+            for e in errs:
+                log("INVALID " + e)
+            messages += errs[:MAX_MESSAGES - len(messages)]
+    return {
+        "ok": invalid == 0,
+        "objects": nobjs,
+        "invalid": invalid,
+        "seconds": round(time.time() - t0, 1),
+        "messages": messages,
+    }
+
+def getOpts () :
+    parser = argparse.ArgumentParser()
+    parser.add_argument('files',nargs='+',help="Submission (.json) or NDJSON files, optionally compressed.")
+    parser.add_argument('-s','--schema',default='../agr_curation_schema',help="Curation schema checkout (default: ../agr_curation_schema).")
+    parser.add_argument('-V','--version',default=os.environ.get('AGR_CURATION_SCHEMA_VERSION', ''),help="Schema version (default: AGR_CURATION_SCHEMA_VERSION).")
+    parser.add_argument('-j','--workers',type=int,default=os.cpu_count(),help="Number of worker processes (default: one per core).")
+    parser.add_argument('-m','--max-errors',type=int,default=100,help="Stop validating a file after this many invalid objects (default: 100).")
+    parser.add_argument('-c','--cache',default=None,help="Result cache file (default: .validation_cache.json in the first file's directory).")
+    parser.add_argument('--no-cache',action='store_true',help="Validate every file, even if unchanged.")
+    return parser.parse_args()
+
+# Validates files with nworkers processes (see above), using and updating the result cache in cacheFile,
+# if given. Returns the names of the invalid files.
+def validateFiles (files, schemaDir, version, nworkers, maxErrors, cacheFile=None) :
+    cache = loadCache(cacheFile) if cacheFile else {}
+    schemaKey = version + ':' + getFileHash(os.path.join(schemaDir, SCHEMA_FILE))[:16]
+    failed = []
+    pool = None
+    try:
+        for fname in files:
+            if fname.endswith('.header.json'):
+                continue # an NDJSON header sidecar, read along with its NDJSON file
+            key = getCacheKey(fname, schemaKey)
+            result = cache.get(key)
+            if result:
+                log("%s: %s (cached result, %d objects, %d invalid)" % (fname, "valid" if result["ok"] else "INVALID", result["objects"], result["invalid"]))
+                for m in result["messages"]:
+                    log("INVALID " + m)
+            else:
+                if pool is None:
+                    pool = ProcessPoolExecutor(max_workers=nworkers, initializer=initWorker, initargs=(schemaDir,))
+                log("Validating %s ..." % fname)
+                result = validateFile(fname, pool, nworkers, maxErrors)
+                rate = result["objects"] / result["seconds"] if result["seconds"] else 0
+                log("%s: %s. %d objects, %d invalid, %.1f seconds, %.0f objects/s" % (fname, "valid" if result["ok"] else "INVALID",
+                    result["objects"], result["invalid"], result["seconds"], rate))
+                if cacheFile:
+                    recordResult(cacheFile, key, result)
+            if not result["ok"]:
+                failed.append(fname)
+    finally:
+        if pool:
+            pool.shutdown()
+    return failed
+
+# Returns the default cache file for a file: .validation_cache.json in its directory.
+def getDefaultCacheFile (fname) :
+    return os.path.join(os.path.dirname(os.path.abspath(fname)), '.validation_cache.json')
+
+def main () :
+    opts = getOpts()
+    cacheFile = None if opts.no_cache else (opts.cache or getDefaultCacheFile(opts.files[0]))
+    failed = validateFiles(opts.files, opts.schema, opts.version, opts.workers, opts.max_errors, cacheFile)
+    if failed:
+        log("Invalid files: " + ", ".join(failed))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
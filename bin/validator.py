@@ -0,0 +1,109 @@
+#
+# validator.py
+#
+# Checks DTOs against the curation schema while they are written, rather than validating each file
+# in a separate pass afterwards (validate_agr_schema.py loads the whole file into memory first).
+# A StreamValidator is an emit() observer (see adfLib.emit): it is called with each DTO as it goes by,
+# validates it against the JSON schema of its ingest set's DTO class, and keeps nothing but counts.
+#
+# The validators are compiled from the JSON schema generated from the LinkML model
+# (generated/jsonschema/allianceModel.schema.json in the agr_curation_schema checkout), one per ingest
+# set, on first use. Each invalid DTO is logged with its primary ID. Once maxErrors DTOs have failed,
+# ValidationFailed is raised, which ends the generation of the file.
+#
+# Used by pipeline.py (see --inline-validation). Requires the jsonschema package.
+#
+import os
+import json
+from adfLib import log
+
+SCHEMA_FILE = os.path.join('generated', 'jsonschema', 'allianceModel.schema.json')
+
+# DTO attributes holding an object's primary ID, in order of preference.
+# Associations have none; they are identified by their subject and object.
+ID_FIELDS = ['primary_external_id', 'mod_entity_id', 'curie', 'mod_internal_id']
+
+class ValidationFailed (RuntimeError) :
+    pass
+
+# Returns a string identifying a DTO in error messages.
+def getPrimaryId (dto) :
+    for f in ID_FIELDS:
+        if dto.get(f):
+            return dto[f]
+    ids = [str(v) for (k, v) in dto.items() if k.endswith('_identifier')]
+    if ids:
+        return '|'.join(ids)
+    return '?'
+
+class StreamValidator :
+    def __init__ (self, schemaDir, maxErrors=100) :
+        import jsonschema
+        fname = os.path.join(schemaDir, SCHEMA_FILE)
+        with open(fname) as fd:
+            self.root = json.load(fd)
+        self.validatorClass = jsonschema.validators.validator_for(self.root)
+        self.validators = {}
+        self.maxErrors = maxErrors
+        self.checked = 0
+        self.errors = 0
+        self.errorsBySet = {}
+
+    # Returns the validator for the DTOs of an ingest set. It checks against the set's item schema,
+    # with the rest of the root schema kept so that references (#/$defs/GeneDTO) still resolve.
+    def getValidator (self, setName) :
+        if setName not in self.validators:
+            prop = self.root.get("properties", {}).get(setName)
+            if prop is None:
+                raise ValidationFailed("Ingest set %s is not in the schema." % setName)
+            schema = dict(self.root)
+            for k in ["properties", "required", "additionalProperties", "type", "title", "description"]:
+                schema.pop(k, None)
+            schema.update(prop.get("items", {}))
+            self.validators[setName] = self.validatorClass(schema)
+        return self.validators[setName]
+
+    # Returns a message describing the first problem with the DTO, or None if it is valid.
+    def check (self, setName, dto) :
+        err = next(self.getValidator(setName).iter_errors(dto), None)
+        if err is None:
+            return None
+        path = '/'.join([str(p) for p in err.absolute_path])
+        return "%s %s: %s%s" % (setName, getPrimaryId(dto), err.message[:500], (" (at %s)" % path) if path else "")
+
+    def __call__ (self, setName, dto) :
+        self.checked += 1
+        msg = self.check(setName, dto)
+        if msg is None:
+            return
+        self.errors += 1
+        self.errorsBySet[setName] = self.errorsBySet.get(setName, 0) + 1
+        log("INVALID " + msg)
+        if self.errors >= self.maxErrors:
+            raise ValidationFailed("Stopping after %d invalid objects." % self.errors)
+
+    # When a part is generated by several worker processes (see partition.py), each worker's copy of the
+    # validator checks the DTOs it builds, and hands its counts back to the parent's with these.
+    # Returns the counts so far, and resets them.
+    def takeCounts (self) :
+        counts = (self.checked, self.errors, self.errorsBySet)
+        self.checked = 0
+        self.errors = 0
+        self.errorsBySet = {}
+        return counts
+
+    def addCounts (self, counts) :
+        checked, errors, errorsBySet = counts
+        self.checked += checked
+        self.errors += errors
+        for (s, n) in errorsBySet.items():
+            self.errorsBySet[s] = self.errorsBySet.get(s, 0) + n
+        if errors and self.errors >= self.maxErrors:
+            raise ValidationFailed("Stopping after %d invalid objects." % self.errors)
+
+    # Returns a one line summary, for logging.
+    def summary (self) :
+        s = "Validated %d objects: %d invalid" % (self.checked, self.errors)
+        if self.errorsBySet:
+            s += " (" + ", ".join(["%s: %d" % x for x in sorted(self.errorsBySet.items())]) + ")"
+        return s
@@ -9,9 +9,11 @@ import sys
 import os
 import re
 import subprocess
-import json
-import db
-from adfLib import getHeaderAttributes, log, getDataProviderDto, setCommonFields
+from adfLib import emit, log, getDataProviderDto, setCommonFields, mainQuery, sql, streamSql, resolveRefIds
+
+# The tables this generator reads, for change detection (see manifest.py).
+TABLES = ["ACC_Accession", "ALL_Allele", "ALL_Variant", "ALL_Variant_Sequence", "MGI_Note", "MGI_Reference_Assoc",
+    "MRK_Marker", "VOC_Annot", "VOC_Term"]
 
 # Map of mouse chromosome to ID of the assembly sequency, by assembly name
 #  chr -> assembly -> identifier
@@ -181,51 +183,50 @@ def getJsonObj(r) :
   return rr
 
 #
-#
-def main () :
+# Writes the variants file to sink (default: stdout).
+def output (sink=None) :
     #
     vk2effects = {}
-    for x in db.sql(Q_EFFECTS):
+    for x in sql(Q_EFFECTS):
       vk2effects[x['_variant_key']] = x['accid']
 
     vk2types = {}
-    for x in db.sql(Q_TYPES):
+    for x in sql(Q_TYPES):
       vk2types[x['_variant_key']] = x['accid']
 
     vk2refs = {}
-    for x in db.sql(Q_REFS):
-      rid = ('PMID:' + x['pubmedid']) if x['pubmedid'] else x['mgiid']
-      vk2refs.setdefault(x['_variant_key'], []).append(rid)
+    refs = sql(Q_REFS)
+    rk2id = resolveRefIds([x['_refs_key'] for x in refs])
+    for x in refs:
+      rid = rk2id[x['_refs_key']]
+      if rid:
+        vk2refs.setdefault(x['_variant_key'], []).append(rid)
 
     vk2notes = {}
-    for x in db.sql(Q_VARIANT_NOTES):
+    for x in sql(Q_VARIANT_NOTES):
         vk2notes.setdefault(x['_variant_key'],[]).append(x)
 
-    first = True
-    print('{')
-    print(getHeaderAttributes())
-    print('"variant_ingest_set": [')
-    for x in db.sql(Q_VARIANTS):
-      x['build'] = "GRCm39" # FIXME: should get this from the DB
-      x['type'] = vk2types.get(x['_variant_key'], None)
-      x['effect'] = vk2effects.get(x['_variant_key'], None)
-      x['refs'] = vk2refs.get(x['_variant_key'], [])
-      x['notes'] = vk2notes.get(x['_variant_key'], None)
-      try:
-          j = getJsonObj(x)
-          if not j: continue
-      except:
-          log("\nSkipping variant because of error: key=%s %s" % (x['_variant_key'], str(x)))
-          log("Error=" + str(sys.exc_info()[1]))
-          continue
-      if not first: sys.stdout.write(",")
-      first = False
-      try:
-          sys.stdout.write(json.dumps(j, indent=2))
-      except:
-          log("\nSkipping variant because of encoding error: key=" + str(x['_variant_key']) + " " + str(j))
-          log("Error=" + str(sys.exc_info()[1]))
-    print("]}")
+    def variants () :
+      for j,x in mainQuery(streamSql(Q_VARIANTS)):
+        x['build'] = "GRCm39" # FIXME: should get this from the DB
+        x['type'] = vk2types.get(x['_variant_key'], None)
+        x['effect'] = vk2effects.get(x['_variant_key'], None)
+        x['refs'] = vk2refs.get(x['_variant_key'], [])
+        x['notes'] = vk2notes.get(x['_variant_key'], None)
+        try:
+            j = getJsonObj(x)
+            if not j: continue
+        except:
+            log("\nSkipping variant because of error: key=%s %s" % (x['_variant_key'], str(x)))
+            log("Error=" + str(sys.exc_info()[1]))
+            continue
+        yield j
+
+    def encodeError (j, e) :
+        log("\nSkipping variant because of encoding error: " + str(j))
+        log("Error=" + str(e))
+
+    emit([("variant_ingest_set", variants())], sink, indent=2, onEncodeError=encodeError)
 
 #
 Q_VARIANTS = '''
@@ -302,24 +303,18 @@ Q_EFFECTS = '''
 Q_REFS = '''
   select
       v._variant_key,
-      aa.accid as mgiid,
-      aa2.accid as pubmedid
+      ra._refs_key
   from
       all_variant v
       join mgi_reference_assoc ra
         on v._variant_key = ra._object_key
         and ra._mgitype_key = 45
-      join acc_accession aa
-        on ra._refs_key = aa._object_key
-        and aa._mgitype_key = 1
-        and aa._logicaldb_key = 1
-        and aa.prefixpart = 'MGI:'
-      left outer join acc_accession aa2
-        on aa2._object_key = ra._refs_key
-        and aa2._mgitype_key = 1
-        and aa2._logicaldb_key = 29
   '''
 
 #
-main ()
+def main () :
+    output()
+
 #
+if __name__ == "__main__":
+    main()